@@ -1,5 +1,27 @@
+import importlib
+
 from .version import __version__
 
-from .article import Article
-from .journals import abbreviate_bibtex_journals
 
+# Imported on first use, so that the command line scripts don't pay
+# for dependencies (e.g. pandas) that they don't need
+_lazy_attributes = {
+    'Article': 'article',
+    'abbreviate_bibtex_journals': 'journals',
+}
+
+__all__ = ['__version__', *_lazy_attributes]
+
+
+def __getattr__(name):
+    try:
+        module = _lazy_attributes[name]
+    except KeyError:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name)) from None
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_attributes))
@@ -16,29 +16,135 @@
 import re
 import requests
 import time
-import functools
 import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
-import bibtexparser
-
-from .exceptions import DOIError, PDFNotFoundError, BibtexParseError, BibtexNotDownloaded
-from .publishers import get_publisher
+from .exceptions import (DOIError, PDFNotFoundError, BibtexNotDownloaded,
+                         MetadataNotDownloaded, MetadataParseError,
+                         UnknownPublisherError)
+from .metadata import ArticleMetadata
+from .publishers import get_publisher, get_publisher_by_doi, requires_url
+from .cache import metadata_store, memory_cache, normalize_doi
+from .crossref import get_snapshot
+from .ratelimit import get_limiter
+from . import sessions
 from .version import __version__
+from .config import franklin_config as config
 
 
 log = logging.getLogger(__name__)
 
 
+# Prepare default global configuration values
+config.set_defaults('metadata', {
+    # Either "bibtex" or "csl-json" (faster to parse)
+    'format': 'bibtex',
+})
+
+
+# Content type to request from the DOI server for each metadata format
+metadata_formats = {
+    'bibtex': 'application/x-bibtex',
+    'csl-json': 'application/vnd.citationstyles.csl+json',
+}
+
+
+def _metadata_format():
+    fmt = config['metadata'].get('format', 'bibtex').strip().lower()
+    if fmt not in metadata_formats:
+        log.warning("Unknown metadata format '%s', using bibtex", fmt)
+        fmt = 'bibtex'
+    return fmt
+
+
+# Runs retrievals in the background for :py:meth:`Article.prefetch`
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='franklin-prefetch')
+        return _executor
+
+
 class Article():
     """A publish research article."""
     _doi_resolution = None
     
     def __init__(self, doi=''):
         self.doi = doi
+        self._futures = {}
+        self._futures_lock = threading.Lock()
+    
+    def _result(self, name, func):
+        """Call *func* once and remember its result for next time.
+        
+        If *func* is already running in the background (see
+        :py:meth:`prefetch`), this waits for it to finish instead.
+        
+        """
+        with self._futures_lock:
+            future = self._futures.get(name)
+            is_new = future is None
+            if is_new:
+                future = self._futures[name] = Future()
+        if is_new:
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                if not future.done():
+                    # Interrupted (e.g. KeyboardInterrupt), so don't
+                    # leave other threads waiting forever
+                    future.cancel()
+                    with self._futures_lock:
+                        if self._futures.get(name) is future:
+                            del self._futures[name]
+        try:
+            return future.result()
+        except Exception:
+            # Don't remember failures, so the next call tries again
+            with self._futures_lock:
+                if self._futures.get(name) is future:
+                    del self._futures[name]
+            raise
+    
+    def _start(self, name, func):
+        """Start running *func* in the background, unless it already has."""
+        with self._futures_lock:
+            if name not in self._futures:
+                self._futures[name] = _get_executor().submit(func)
+    
+    def prefetch(self, url=True):
+        """Start retrieving this article's metadata in the background.
+        
+        The handle URL is also resolved, but only if the PDF will
+        need it (and *url* is true). Later calls to e.g.
+        :py:meth:`metadata` will wait for these results instead of
+        starting again.
+        
+        """
+        self._start('record', self._parse_record)
+        if not url:
+            return
+        try:
+            needs_url = get_publisher_by_doi(self.doi) in requires_url
+        except UnknownPublisherError:
+            needs_url = True
+        if needs_url:
+            self._start('url', self._resolve_url)
     
     def url(self):
         """Retrieve the actual URL given the DOI."""
-        response = requests.get('https://doi.org/api/handles/{doi}'.format(doi=self.doi)).json()
+        return self._result('url', self._resolve_url)
+    
+    def _resolve_url(self):
+        response = sessions.get('https://doi.org/api/handles/{doi}'.format(doi=self.doi)).json()
         response_code = response['responseCode']
         if response_code == 1:
             url = response['values'][0]['data']['value']
@@ -48,42 +154,99 @@ class Article():
             raise DOIError("Unexpected DOI error {}".format(response))
         return url
     
-    @functools.lru_cache()
     def _bibtex(self):
+        """Load the raw bibtex, from the local metadata store if possible."""
+        return self._result('bibtex', self._load_bibtex)
+    
+    def _load_bibtex(self):
+        return self._load_metadata('bibtex', self._download_bibtex)
+    
+    def _csl_json(self):
+        """Load the raw CSL-JSON, from the local metadata store if possible."""
+        return self._result('csl-json', self._load_csl_json)
+    
+    def _load_csl_json(self):
+        return self._load_metadata('csl-json', self._download_csl_json)
+    
+    def _load_metadata(self, fmt, download):
+        # Other articles for the same DOI may have already loaded it
+        key = (fmt, normalize_doi(self.doi))
+        value = memory_cache.get(key)
+        if value is not None:
+            return value
+        value = metadata_store.get(self.doi, fmt=fmt)
+        if value is not None:
+            memory_cache.put(key, value)
+            return value
+        try:
+            value = download()
+        except (MetadataNotDownloaded, requests.exceptions.RequestException):
+            # Fall back to an out-of-date entry if the server is unavailable
+            value = metadata_store.get(self.doi, fmt=fmt, allow_stale=True)
+            if value is None:
+                raise
+            log.warning("Could not refresh %s for %s, using cached copy", fmt, self.doi)
+        else:
+            metadata_store.put(self.doi, value, fmt=fmt)
+        memory_cache.put(key, value)
+        return value
+    
+    def _download_bibtex(self):
         """Load the raw bibtex from DOI server."""
+        return self._download_metadata('bibtex', exc=BibtexNotDownloaded)
+    
+    def _download_csl_json(self):
+        """Load the raw CSL-JSON from DOI server."""
+        return self._download_metadata('csl-json')
+    
+    def _download_metadata(self, fmt, exc=MetadataNotDownloaded):
         headers = {
-            'Accept': 'application/x-bibtex',
+            'Accept': metadata_formats[fmt],
             'User-Agent': f'franklin/{__version__}',
         }
-        timeout_options = [1, 2, 3]
-        for idx, timeout in enumerate(timeout_options):
-            url = 'https://dx.doi.org/{doi}'.format(doi=self.doi)
-            log.debug("Attempt %d/%d to retrieve bibtex from %s", idx, len(timeout_options), url)
-            bibtex = requests.get(url, headers=headers, timeout=timeout)
-            if bibtex.status_code == 200:
-                log.info("Retrieved bibtex for %s", self.doi)
-                break
-            else:
-                log.debug("Failed attempt %d/%d to retrieve bibtex from %s", idx, len(timeout_options), url)
-        if bibtex.status_code != 200:
-            import pdb; pdb.set_trace()
-            raise BibtexNotDownloaded(bibtex.status_code)
-        return bibtex.text
+        url = 'https://dx.doi.org/{doi}'.format(doi=self.doi)
+        log.debug("Retrieving %s from %s", fmt, url)
+        response = sessions.get(url, headers=headers)
+        if response.status_code != 200:
+            raise exc("Could not retrieve {} for {} (HTTP {})"
+                      "".format(fmt, self.doi, response.status_code))
+        log.info("Retrieved %s for %s", fmt, self.doi)
+        return response.text
+    
+    def record(self):
+        """Retrieve this article's metadata as a structured record.
+        
+        The metadata are only parsed once, and the same
+        :py:class:`~franklin.metadata.ArticleMetadata` is returned on
+        later calls. If a Crossref snapshot is configured (see
+        :py:mod:`franklin.crossref`), it is checked first. If the
+        ``format`` option in the ``[metadata]``
+        section of the config file is "csl-json", the record is built
+        from CSL-JSON instead of bibtex.
+        
+        """
+        return self._result('record', self._parse_record)
+    
+    def _parse_record(self):
+        # A local copy of the Crossref database avoids the network entirely
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            record = snapshot.record(self.doi)
+            if record is not None:
+                log.debug("Found %s in crossref snapshot", self.doi)
+                return record
+        if _metadata_format() == 'csl-json':
+            try:
+                return ArticleMetadata.from_csl_json(self._csl_json(), doi=self.doi)
+            except (MetadataNotDownloaded, MetadataParseError,
+                    requests.exceptions.RequestException) as e:
+                log.info("Could not use CSL-JSON for %s, falling back to bibtex: %s",
+                         self.doi, e)
+        return ArticleMetadata.from_bibtex(self._bibtex(), doi=self.doi)
     
     def metadata(self):
         """Retrieve metadata about this article and return as a dictionary."""
-        bibtex = self._bibtex()
-        try:
-            bibdb = bibtexparser.loads(bibtex)
-        except:
-            msg = "Could not parse bibtex entry: '{}'".format(bibtex)
-            raise BibtexParseError(msg) from None
-        if len(bibdb.entries) != 1:
-            msg = "Found {} bibtex entries for DOI: '{}'".format(len(bibdb.entries), self.doi)
-            raise DOIError(msg)
-        metadata = bibdb.entries[0]
-        del metadata['ID']
-        return metadata
+        return self.record().as_dict()
     
     def bibtex(self, id=None):
         """Prepare bibtex entry for this article.
@@ -100,40 +263,50 @@ class Article():
           The prepared bibtex entry.
         
         """
-        metadata = self.metadata()
-        metadata['ID'] = id if id is not None else self.default_id()
-        # Convert to bibtex
-        db = bibtexparser.bibdatabase.BibDatabase()
-        db.entries = [metadata]
-        bibtex = bibtexparser.dumps(db)
-        return bibtex
-    
-    def download_pdf(self, fp):
+        id = id if id is not None else self.default_id()
+        return self.record().to_bibtex(id)
+    
+    def download_pdf(self, fp, max_size=None):
         """Retrieve the PDF for the given article resource.
         
+        The PDF is streamed into *fp* as it is downloaded, so the
+        whole file is never held in memory. If *fp* already holds the
+        start of the PDF, only the rest will be downloaded.
+        
         Parameters
         ==========
         fp : File-like object
-          Will receive the PDF contents. Must be writable and in a
-          binary mode.
+          Will receive the PDF contents. Must be writable, seekable
+          and in a binary mode.
+        max_size : int
+          If given, abort if the PDF is larger than this many bytes.
         
         """
-        metadata = self.metadata()
-        get_pdf = get_publisher(metadata['publisher'])
-        pdf_response = get_pdf(doi=self.doi, url=self.url())
-        # Save the PDF
-        fp.write(pdf_response)
+        # Retrieve the metadata at the same time as the PDF
+        self.prefetch()
+        get_pdf = self.get_publisher()
+        url = self.url() if get_pdf in requires_url else None
+        # Don't overwhelm the publisher with requests
+        with get_limiter(get_pdf.__name__):
+            get_pdf(doi=self.doi, url=url, fp=fp, max_size=max_size)
+    
+    def get_publisher(self):
+        """Find the function that retrieves the PDF for this article.
+        
+        The publisher is determined from the DOI if possible,
+        otherwise from the article's metadata.
+        
+        """
+        try:
+            get_pdf = get_publisher_by_doi(self.doi)
+        except UnknownPublisherError:
+            # Fall back to the publisher listed in the metadata
+            get_pdf = get_publisher(self.record().publisher)
+        return get_pdf
     
     def authors(self):
-        metadata = self.metadata()
-        authors = metadata['author'].split(' and ')
-        return authors
+        return list(self.record().authors)
     
     def default_id(self):
         """Prepare a default ID suitable for bibtex."""
-        lead_author = self.authors()[-1]
-        last_name = lead_author.split(',')[0].lower()
-        default_id = '{last_name}{year}'.format(last_name=last_name,
-                                                year=self.metadata()['year'])
-        return default_id
-        
+        return self.record().default_id()
@@ -0,0 +1,273 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""An index of the DOIs and IDs in a bibtex file.
+
+Parsing a large bibtex file is slow, so the IDs and DOIs of its
+entries are kept in a sidecar file next to it (e.g. ``.refs.bib.index``
+for ``refs.bib``). The sidecar records the size and modification time
+of the bibtex file, and a fingerprint of its last few kilobytes. If
+the bibtex file has only been added to since then, only the new part
+is parsed. Otherwise the whole file is parsed again.
+
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+index_version = 1
+# How much of the end of the bibtex file is used to detect changes (bytes)
+fingerprint_size = 4096
+
+
+def sidecar_path(bibpath):
+    """Where the index for the bibtex file *bibpath* is kept."""
+    bibpath = Path(bibpath)
+    return bibpath.parent / '.{}.index'.format(bibpath.name)
+
+
+def fingerprint(fp, size):
+    """Hash the *fingerprint_size* bytes before *size* in a binary file."""
+    start = max(0, size - fingerprint_size)
+    fp.seek(start)
+    return hashlib.sha256(fp.read(size - start)).hexdigest()
+
+
+# The start of each entry, e.g. "@article{wolfman2017,"
+entry_re = re.compile(r'^[ \t]*@[ \t]*(\w+)[ \t]*[{(][ \t]*([^,\s]+)[ \t]*,', re.MULTILINE)
+# The DOI field, e.g. "doi = {10.1021/acs.chemmater.6b05114}"
+doi_re = re.compile(r'(?<![\w-])doi\s*=\s*(?:\{\s*([^{}]*?)\s*\}|"\s*([^"]*?)\s*"|([^\s,{}"]+))',
+                    re.IGNORECASE)
+# Entry types that aren't actually bibliography entries
+ignored_types = {'comment', 'string', 'preamble'}
+
+# Indexes kept in memory between calls to BibIndex.for_file, by path
+_indexes = None
+_indexes_lock = threading.Lock()
+
+
+def keep_in_memory(enabled=True):
+    """Keep indexes in memory between calls to :py:meth:`BibIndex.for_file`.
+
+    Useful for long-running processes (e.g. ``franklind``), which then
+    only need to check the bibtex file for changes, not read the
+    sidecar again.
+
+    """
+    global _indexes
+    with _indexes_lock:
+        _indexes = {} if enabled else None
+
+
+def parse_entries(text):
+    """Extract (ID, DOI) pairs from the bibtex in *text*.
+
+    Only the IDs and DOIs are needed, so this is much faster than
+    parsing the whole bibtex file with bibtexparser.
+
+    """
+    starts = list(entry_re.finditer(text))
+    entries = []
+    for start, next_start in zip(starts, starts[1:] + [None]):
+        if start.group(1).lower() in ignored_types:
+            continue
+        end = next_start.start() if next_start is not None else len(text)
+        match = doi_re.search(text, start.end(), end)
+        doi = next(g for g in match.groups() if g is not None) if match else None
+        entries.append((start.group(2), doi))
+    return entries
+
+
+class BibIndex():
+    """The IDs and DOIs of the entries in one bibtex file.
+
+    Use :py:meth:`for_file` to create an index that is kept up to date
+    on disk.
+
+    Parameters
+    ==========
+    bibpath : str
+      The bibtex file being indexed. If ``None``, the index is only
+      kept in memory.
+
+    """
+    def __init__(self, bibpath=None):
+        self.bibpath = Path(bibpath) if bibpath is not None else None
+        self.ids = set()
+        self.dois = {}
+        # (size, mtime) of the bibtex file when the index was last in sync
+        self._stat = None
+        # Next suffix to try for each base ID (see fetch_doi.IDAllocator)
+        self.next_suffix = {}
+
+    @classmethod
+    def for_file(cls, bibfile):
+        """Load the index for an open bibtex file.
+
+        If *bibfile* is an actual file on disk, the sidecar index is
+        used (and brought up to date). Otherwise, the contents of
+        *bibfile* are parsed.
+
+        """
+        name = getattr(bibfile, 'name', None)
+        if isinstance(name, (str, os.PathLike)) and os.path.isfile(name):
+            bibfile.flush()
+            with _indexes_lock:
+                if _indexes is not None:
+                    key = os.path.realpath(name)
+                    index = _indexes.setdefault(key, cls(bibpath=name))
+                    index.refresh()
+                    return index.copy()
+            index = cls(bibpath=name)
+            index.refresh()
+        else:
+            index = cls()
+            bibfile.seek(0)
+            index.add_entries(parse_entries(bibfile.read()))
+        return index
+
+    @property
+    def path(self):
+        return sidecar_path(self.bibpath)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def entries(self):
+        """The indexed IDs, as minimal bibtex dictionaries."""
+        return ({'ID': id_} for id_ in self.ids)
+
+    def find_doi(self, doi):
+        """List the IDs of entries with this DOI, or ``None`` if there are none."""
+        return self.dois.get(doi.lower())
+
+    def add(self, id_, doi=None):
+        """Include a new entry in the index (in memory only)."""
+        self.ids.add(id_)
+        if doi is not None:
+            self.dois.setdefault(doi.lower(), []).append(id_)
+
+    def add_entries(self, entries):
+        for id_, doi in entries:
+            self.add(id_, doi)
+
+    def clear(self):
+        self.ids.clear()
+        self.dois.clear()
+
+    def copy(self):
+        index = type(self)(bibpath=self.bibpath)
+        index.ids = set(self.ids)
+        index.dois = {doi: list(ids) for doi, ids in self.dois.items()}
+        index._stat = self._stat
+        # Shared, so the suffixes carry over between copies
+        index.next_suffix = self.next_suffix
+        return index
+
+    def refresh(self):
+        """Make sure the index matches the bibtex file on disk.
+
+        The sidecar index is used if it is still valid, and updated if
+        the bibtex file has only been appended to. Otherwise, the
+        whole bibtex file is parsed again.
+
+        """
+        stat = os.stat(self.bibpath)
+        if self._stat == (stat.st_size, stat.st_mtime_ns):
+            # Nothing has changed since the last refresh
+            return
+        saved = self._load()
+        with open(self.bibpath, mode='rb') as fp:
+            if saved is None:
+                log.debug("No valid index for %s", self.bibpath)
+                self._rebuild(fp, stat)
+            elif saved['size'] == stat.st_size and saved['mtime_ns'] == stat.st_mtime_ns:
+                log.debug("Loaded index for %s from %s", self.bibpath, self.path)
+                self._restore(saved)
+            elif (stat.st_size > saved['size']
+                  and fingerprint(fp, saved['size']) == saved['fingerprint']):
+                # Only need to index the new entries at the end
+                log.debug("Indexing new entries in %s", self.bibpath)
+                self._restore(saved)
+                fp.seek(saved['size'])
+                text = fp.read(stat.st_size - saved['size']).decode('utf-8', errors='replace')
+                self.add_entries(parse_entries(text))
+                self.save()
+            else:
+                log.debug("Index for %s is out of date", self.bibpath)
+                self._rebuild(fp, stat)
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+
+    def _restore(self, saved):
+        self.ids = set(saved['ids'])
+        self.dois = saved['dois']
+
+    def _rebuild(self, fp, stat):
+        fp.seek(0)
+        text = fp.read(stat.st_size).decode('utf-8', errors='replace')
+        self.clear()
+        self.add_entries(parse_entries(text))
+        self.save()
+
+    def _load(self):
+        try:
+            with open(self.path, mode='r', encoding='utf-8') as fp:
+                saved = json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("Could not read bibtex index %s: %s", self.path, e)
+            return None
+        if not isinstance(saved, dict) or saved.get('version') != index_version:
+            return None
+        return saved
+
+    def save(self):
+        """Save the index next to the bibtex file.
+
+        This should be called after new entries have been written to
+        the bibtex file and included with :py:meth:`add`.
+
+        """
+        if self.bibpath is None:
+            return
+        stat = os.stat(self.bibpath)
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+        with open(self.bibpath, mode='rb') as fp:
+            saved = {
+                'version': index_version,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'fingerprint': fingerprint(fp, stat.st_size),
+                'ids': sorted(self.ids),
+                'dois': self.dois,
+            }
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.name,
+                                            suffix='.tmp')
+            with os.fdopen(fd, mode='w', encoding='utf-8') as fp:
+                fp.write(json.dumps(saved, separators=(",", ":")))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning("Could not save bibtex index %s: %s", self.path, e)
@@ -0,0 +1,558 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Caching of retrieved metadata so it survives between invocations."""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+from .config import franklin_config as config
+
+
+log = logging.getLogger(__name__)
+
+
+# Prepare default global configuration values
+config.set_defaults('cache', {
+    'enabled': 'yes',
+    'directory': '~/.cache/franklin/',
+    # How long before a cached entry is checked again (seconds)
+    'ttl': str(30 * 24 * 60 * 60),
+    # Maximum size of the on-disk metadata store (bytes)
+    'max_size': str(64 * 1024 * 1024),
+    # Maximum size of the in-memory cache shared by this process (bytes)
+    'memory_size': str(16 * 1024 * 1024),
+    # How long before a saved journal abbreviation is checked again (seconds)
+    'abbreviation_ttl': str(180 * 24 * 60 * 60),
+    # How long a failed abbreviation lookup is remembered (seconds)
+    'negative_ttl': str(7 * 24 * 60 * 60),
+})
+
+
+def normalize_doi(doi):
+    """Convert a DOI to a canonical form suitable for use as a key.
+
+    DOIs are case-insensitive, so ``10.1021/ACS.CHEMMATER.6B05114``
+    and ``10.1021/acs.chemmater.6b05114`` refer to the same object.
+
+    """
+    doi = doi.strip()
+    for prefix in ['https://', 'http://', 'dx.doi.org/', 'doi.org/', 'doi:']:
+        if doi.lower().startswith(prefix):
+            doi = doi[len(prefix):]
+    return doi.lower()
+
+
+class MetadataStore():
+    """A persistent, on-disk store of retrieved DOI metadata.
+
+    Entries are keyed by the normalized DOI and the format of the
+    metadata (e.g. "bibtex"), and saved to a file named by the hash of
+    this key. Entries older than *ttl* seconds are considered stale,
+    and the least recently used entries are removed once the store
+    grows beyond *max_size* bytes.
+
+    Parameters
+    ==========
+    directory : str
+      Where to keep the cached files. If omitted, the ``[cache]``
+      section of the config file is used.
+    ttl : int
+      Age in seconds after which an entry should be revalidated.
+    max_size : int
+      Maximum total size of the cached files, in bytes.
+    enabled : bool
+      If false, nothing will be read from or saved to disk.
+
+    """
+    _total_size = None
+
+    def __init__(self, directory=None, ttl=None, max_size=None, enabled=None):
+        self._directory = directory
+        self._ttl = ttl
+        self._max_size = max_size
+        self._enabled = enabled
+        # Guards the size bookkeeping, since several threads may save at once
+        self._lock = threading.RLock()
+
+    @property
+    def directory(self):
+        if self._directory is not None:
+            return Path(self._directory)
+        return Path(config['cache']['directory']).expanduser() / 'metadata'
+
+    @property
+    def ttl(self):
+        return self._ttl if self._ttl is not None else config['cache'].getint('ttl')
+
+    @property
+    def max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        return config['cache'].getint('max_size')
+
+    @property
+    def enabled(self):
+        if self._enabled is not None:
+            return self._enabled
+        return config['cache'].getboolean('enabled')
+
+    def path(self, doi, fmt='bibtex'):
+        """Determine the file that holds the entry for this DOI."""
+        key = '{}:{}'.format(fmt, normalize_doi(doi))
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return self.directory / digest[:2] / '{}.json'.format(digest[2:])
+
+    def get(self, doi, fmt='bibtex', allow_stale=False):
+        """Retrieve the cached metadata for *doi*.
+
+        Returns
+        =======
+        value : str
+          The cached metadata, or ``None`` if no entry exists or the
+          entry is older than ``self.ttl`` (unless *allow_stale* is
+          true).
+
+        """
+        if not self.enabled:
+            return None
+        path = self.path(doi, fmt=fmt)
+        try:
+            with open(path, mode='r', encoding='utf-8') as fp:
+                entry = json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("Could not read cached metadata %s: %s", path, e)
+            return None
+        age = time.time() - entry['timestamp']
+        if age > self.ttl and not allow_stale:
+            log.debug("Cached %s for %s is stale (%d s old)", fmt, doi, age)
+            return None
+        # Mark this entry as recently used for later eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        log.debug("Loaded cached %s for %s", fmt, doi)
+        return entry['value']
+
+    def put(self, doi, value, fmt='bibtex'):
+        """Save *value* as the metadata for *doi*."""
+        if not self.enabled:
+            return
+        path = self.path(doi, fmt=fmt)
+        entry = {
+            'doi': normalize_doi(doi),
+            'format': fmt,
+            'timestamp': time.time(),
+            'value': value,
+        }
+        data = json.dumps(entry).encode('utf-8')
+        with self._lock:
+            try:
+                old_size = path.stat().st_size
+            except OSError:
+                old_size = 0
+            # Write to a temporary file first so readers never see partial entries
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+                with os.fdopen(fd, mode='wb') as fp:
+                    fp.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                log.warning("Could not save metadata for %s to cache: %s", doi, e)
+                return
+            log.debug("Saved %s for %s to %s", fmt, doi, path)
+            # Keep the store within its size limits
+            if self._total_size is None:
+                self._total_size = self._scan_size()
+            else:
+                self._total_size += len(data) - old_size
+            if self._total_size > self.max_size:
+                self.evict()
+
+    def _entries(self):
+        for path in self.directory.glob('*/*.json'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            yield path, stat
+
+    def _scan_size(self):
+        return sum(stat.st_size for path, stat in self._entries())
+
+    def evict(self, target_size=None):
+        """Remove the least recently used entries.
+
+        Entries are removed until the store is smaller than
+        *target_size* (default, 90% of ``self.max_size``).
+
+        """
+        if target_size is None:
+            target_size = int(0.9 * self.max_size)
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+            total_size = sum(stat.st_size for path, stat in entries)
+            for path, stat in entries:
+                if total_size <= target_size:
+                    break
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+                total_size -= stat.st_size
+                log.debug("Evicted %s from metadata cache", path)
+            self._total_size = total_size
+
+    def clear(self):
+        """Remove all entries from the store."""
+        self.evict(target_size=0)
+
+
+metadata_store = MetadataStore()
+
+
+def _sizeof(obj):
+    """Estimate the memory used by *obj*, including its contents."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        size += sum(_sizeof(item) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(_sizeof(k) + _sizeof(v) for k, v in obj.items())
+    return size
+
+
+class MemoryCache():
+    """An in-memory cache shared by everything in this process.
+
+    Keys should include what kind of value is being stored, e.g.
+    ``('bibtex', normalize_doi(doi))`` or ``('cassi', journal)``. Once
+    the values take up more than *max_size* bytes, the least recently
+    used entries are discarded.
+
+    Parameters
+    ==========
+    max_size : int
+      Maximum (approximate) memory used by the cached values, in
+      bytes. If omitted, the ``[cache]`` section of the config file is
+      used.
+
+    """
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        return config['cache'].getint('memory_size')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Retrieve the value for *key*, or *default* if it's not cached."""
+        with self._lock:
+            try:
+                value, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Save *value* for *key*, evicting older entries if necessary."""
+        size = _sizeof(key) + _sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                # Would push everything else out, so don't bother
+                log.debug("Not caching %s in memory (%d bytes)", key, size)
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                old_key, (old_value, old_size) = self._entries.popitem(last=False)
+                self.size -= old_size
+                log.debug("Evicted %s from memory cache", old_key)
+
+    def discard(self, kind):
+        """Remove the entries whose key starts with *kind* (e.g. ``"ltwa"``)."""
+        with self._lock:
+            for key in [k for k in self._entries if isinstance(k, tuple) and k[:1] == (kind,)]:
+                self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Summarize the cache's usage as a dictionary."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+memory_cache = MemoryCache()
+
+
+def normalize_title(title):
+    """Convert a journal title to the form used as a cache key."""
+    return ' '.join(title.split()).lower()
+
+
+class AbbreviationStore():
+    """Journal abbreviations saved on disk between invocations.
+
+    Entries are kept in a sqlite database, keyed by the source of the
+    abbreviation (e.g. ``"cassi"``) and the normalized journal
+    title. Lookups that find nothing are saved as negative entries, so
+    that journals missing from a source are not searched for again
+    every time. Negative entries expire sooner, after
+    ``negative_ttl`` seconds.
+
+    Parameters
+    ==========
+    path : str
+      The sqlite database. If omitted, ``abbreviations.sqlite`` in the
+      directory given by the ``[cache]`` section of the config file.
+    ttl : int
+      Seconds before an abbreviation is looked up again.
+    negative_ttl : int
+      Seconds before a failed lookup is tried again.
+    enabled : bool
+      If false, nothing will be read from or saved to disk.
+
+    """
+    def __init__(self, path=None, ttl=None, negative_ttl=None, enabled=None):
+        self._path = path
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._enabled = enabled
+        self._connection = None
+        self._connection_path = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        if self._path is not None:
+            return Path(self._path)
+        return Path(config['cache']['directory']).expanduser() / 'abbreviations.sqlite'
+
+    @property
+    def ttl(self):
+        if self._ttl is not None:
+            return self._ttl
+        return config['cache'].getint('abbreviation_ttl')
+
+    @property
+    def negative_ttl(self):
+        if self._negative_ttl is not None:
+            return self._negative_ttl
+        return config['cache'].getint('negative_ttl')
+
+    @property
+    def enabled(self):
+        if self._enabled is not None:
+            return self._enabled
+        return config['cache'].getboolean('enabled')
+
+    def _connect(self):
+        path = self.path
+        if self._connection is None or self._connection_path != path:
+            self.close()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+            connection.execute("CREATE TABLE IF NOT EXISTS abbreviations ("
+                               "source TEXT NOT NULL, "
+                               "title TEXT NOT NULL, "
+                               "abbreviation TEXT, "
+                               "error TEXT, "
+                               "timestamp REAL NOT NULL, "
+                               "PRIMARY KEY (source, title))")
+            self._connection = connection
+            self._connection_path = path
+        return self._connection
+
+    def _execute(self, sql, params=()):
+        """Run one SQL statement and return (rows, number of rows changed)."""
+        with self._lock:
+            try:
+                connection = self._connect()
+                with connection:
+                    cursor = connection.execute(sql, params)
+                    return cursor.fetchall(), cursor.rowcount
+            except (OSError, sqlite3.Error) as e:
+                log.warning("Could not use abbreviation cache %s: %s", self.path, e)
+                return [], 0
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def get(self, source, title):
+        """Retrieve the saved abbreviation of *title* from *source*.
+
+        Returns
+        =======
+        abbreviation : str
+          The saved abbreviation, or ``None`` if there is no
+          up-to-date entry.
+
+        Raises
+        ======
+        KeyError
+          A recent lookup found no abbreviation for *title*.
+
+        """
+        if not self.enabled:
+            return None
+        rows, _ = self._execute("SELECT abbreviation, error, timestamp FROM abbreviations "
+                                "WHERE source = ? AND title = ?",
+                                (source, normalize_title(title)))
+        if not rows:
+            return None
+        abbreviation, error, timestamp = rows[0]
+        age = time.time() - timestamp
+        if abbreviation is None:
+            if age > self.negative_ttl:
+                return None
+            raise KeyError("No {} abbreviation for '{}' ({} s ago): {}".format(
+                source, title, int(age), error))
+        if age > self.ttl:
+            return None
+        return abbreviation
+
+    def put(self, source, title, abbreviation):
+        """Save *abbreviation* as the abbreviation of *title* from *source*."""
+        self._put(source, title, abbreviation, None)
+
+    def put_negative(self, source, title, error=''):
+        """Remember that *source* has no abbreviation for *title*."""
+        self._put(source, title, None, str(error))
+
+    def _put(self, source, title, abbreviation, error):
+        if not self.enabled:
+            return
+        self._execute("INSERT OR REPLACE INTO abbreviations VALUES (?, ?, ?, ?, ?)",
+                      (source, normalize_title(title), abbreviation, error, time.time()))
+
+    def entries(self):
+        """List all saved entries.
+
+        Returns
+        =======
+        entries : list
+          (source, title, abbreviation, error, timestamp) for each
+          entry. *abbreviation* is ``None`` for negative entries.
+
+        """
+        rows, _ = self._execute("SELECT source, title, abbreviation, error, timestamp "
+                                "FROM abbreviations ORDER BY source, title")
+        return rows
+
+    def _expired_sql(self):
+        now = time.time()
+        sql = ("(abbreviation IS NOT NULL AND timestamp < ?) "
+               "OR (abbreviation IS NULL AND timestamp < ?)")
+        return sql, (now - self.ttl, now - self.negative_ttl)
+
+    def stats(self):
+        """Count the saved entries for each source.
+
+        Returns
+        =======
+        stats : dict
+          For each source, a dictionary with the number of ``found``
+          and ``missing`` (negative) entries, and how many of these
+          have ``expired``.
+
+        """
+        expired, params = self._expired_sql()
+        rows, _ = self._execute("SELECT source, "
+                                "COUNT(abbreviation), "
+                                "COUNT(*) - COUNT(abbreviation), "
+                                "SUM(CASE WHEN {} THEN 1 ELSE 0 END) "
+                                "FROM abbreviations GROUP BY source ORDER BY source".format(expired),
+                                params)
+        return {source: {'found': found, 'missing': missing, 'expired': n_expired}
+                for source, found, missing, n_expired in rows}
+
+    def prune(self, which='expired', source=None):
+        """Remove saved entries.
+
+        Parameters
+        ==========
+        which : str
+          ``"expired"`` to remove out-of-date entries, ``"missing"``
+          for all negative entries, or ``"all"`` for everything.
+        source : str
+          Only remove entries from this source (e.g. ``"ltwa"``).
+
+        Returns
+        =======
+        count : int
+          How many entries were removed.
+
+        """
+        if which == 'expired':
+            where, params = self._expired_sql()
+        elif which == 'missing':
+            where, params = "abbreviation IS NULL", ()
+        elif which == 'all':
+            where, params = "1", ()
+        else:
+            raise ValueError("Cannot prune '{}' entries".format(which))
+        if source is not None:
+            where, params = "source = ? AND ({})".format(where), (source,) + tuple(params)
+        _, count = self._execute("DELETE FROM abbreviations WHERE {}".format(where), params)
+        log.debug("Pruned %d %s entries from abbreviation cache", count, which)
+        return count
+
+
+abbreviation_store = AbbreviationStore()
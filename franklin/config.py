@@ -10,6 +10,19 @@ class FranklinConfig(configparser.ConfigParser):
             filenames = self.default_filename
         return super().read(filenames, *args, **kwargs)
 
+    def set_defaults(self, section, values):
+        """Fill in default *values* for *section*.
+
+        Options that are already set, e.g. from a config file read
+        before the module providing the defaults was imported, are
+        kept.
+
+        """
+        if not self.has_section(section):
+            self.add_section(section)
+        for key, value in values.items():
+            self[section].setdefault(key, value)
+
 
 franklin_config = FranklinConfig()
 
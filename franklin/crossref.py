@@ -0,0 +1,335 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Look up metadata in a local snapshot of the Crossref database.
+
+Crossref publishes its metadata as gzipped JSON-lines files, one work
+per line. ``index-crossref`` reads these files once and builds a
+snapshot directory holding:
+
+``records.jsonl``
+  Each work, trimmed to the fields franklin uses, one per line.
+``index.bin``
+  A table of (DOI hash, offset, length) entries sorted by hash, so a
+  DOI can be found by binary search without reading the records into
+  memory.
+
+Set the ``snapshot`` option in the ``[crossref]`` section of the
+config file to use the snapshot in place of the DOI server::
+
+  [crossref]
+  snapshot = ~/crossref-2024/
+
+"""
+
+import os
+import gzip
+import heapq
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+
+from .config import franklin_config as config
+from .cache import normalize_doi
+from .metadata import ArticleMetadata
+from .version import __version__
+
+
+log = logging.getLogger(__name__)
+
+
+# Prepare default global configuration values
+config.set_defaults('crossref', {
+    # Directory created by ``index-crossref`` (blank to disable)
+    'snapshot': '',
+})
+
+
+index_filename = 'index.bin'
+records_filename = 'records.jsonl'
+index_magic = b'FRCRIDX1'
+_header = struct.Struct('>8sQ')
+_entry = struct.Struct('>8sQI')
+
+# Fields kept from each Crossref work
+work_fields = ['DOI', 'type', 'title', 'author', 'container-title',
+               'publisher', 'issued', 'published-print', 'published-online',
+               'volume', 'issue', 'page', 'ISSN', 'ISBN', 'URL']
+author_fields = ['given', 'family', 'suffix', 'name', 'non-dropping-particle']
+
+# CSL item types for each Crossref work type
+csl_types = {
+    'journal-article': 'article-journal',
+    'proceedings-article': 'paper-conference',
+    'book-chapter': 'chapter',
+    'book': 'book',
+    'monograph': 'book',
+    'edited-book': 'book',
+    'dissertation': 'thesis',
+    'report': 'report',
+}
+
+
+def doi_hash(doi):
+    """The 8-byte key used to find *doi* in the index."""
+    return hashlib.sha1(normalize_doi(doi).encode('utf-8')).digest()[:8]
+
+
+def slim_work(work):
+    """Keep only the parts of a Crossref work that franklin uses."""
+    slim = {key: work[key] for key in work_fields if key in work}
+    if 'author' in slim:
+        slim['author'] = [{key: author[key] for key in author_fields if key in author}
+                          for author in slim['author']]
+    return slim
+
+
+def work_to_csl(work):
+    """Convert a Crossref work to a CSL-JSON item.
+
+    The two are nearly identical, except for the names of the types.
+
+    """
+    csl = dict(work)
+    csl['type'] = csl_types.get(work.get('type'), work.get('type'))
+    return csl
+
+
+class CrossrefSnapshot():
+    """A local, indexed copy of Crossref metadata.
+
+    Parameters
+    ==========
+    directory : str
+      The directory created by :py:func:`build_snapshot`.
+
+    """
+    def __init__(self, directory):
+        self.directory = Path(directory).expanduser()
+        with open(self.directory / index_filename, mode='rb') as fp:
+            magic, self.count = _header.unpack(fp.read(_header.size))
+            if magic != index_magic:
+                raise ValueError("Not a crossref snapshot index: {}".format(fp.name))
+            self._index = self._mmap(fp)
+        with open(self.directory / records_filename, mode='rb') as fp:
+            self._records = self._mmap(fp)
+
+    @staticmethod
+    def _mmap(fp):
+        if os.fstat(fp.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def _key(self, i):
+        start = _header.size + i * _entry.size
+        return self._index[start:start + 8]
+
+    def _entry_at(self, i):
+        return _entry.unpack_from(self._index, _header.size + i * _entry.size)
+
+    def _bisect(self, key):
+        """Find the position of the first entry with a hash >= *key*."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, doi):
+        """Retrieve the Crossref work for *doi*.
+
+        Returns
+        =======
+        work : dict
+          The (trimmed) Crossref work, or ``None`` if this DOI is not
+          in the snapshot.
+
+        """
+        key = doi_hash(doi)
+        doi = normalize_doi(doi)
+        work = None
+        # Different DOIs can share a hash, so check each candidate
+        i = self._bisect(key)
+        while i < self.count and self._key(i) == key:
+            _, offset, length = self._entry_at(i)
+            candidate = json.loads(self._records[offset:offset + length])
+            if normalize_doi(candidate.get('DOI', '')) == doi:
+                # Later copies come from newer dump files
+                work = candidate
+            i += 1
+        return work
+
+    def record(self, doi):
+        """Retrieve the metadata for *doi* as an :py:class:`ArticleMetadata`."""
+        work = self.get(doi)
+        if work is None:
+            return None
+        return ArticleMetadata.from_csl(work_to_csl(work))
+
+    def close(self):
+        for mm in [self._index, self._records]:
+            if isinstance(mm, mmap.mmap):
+                mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _dump_files(paths):
+    """List the gzipped JSON-lines files in *paths*, in order."""
+    for path in paths:
+        path = Path(path).expanduser()
+        if path.is_dir():
+            yield from sorted(p for p in path.iterdir() if p.name.endswith('.gz'))
+        else:
+            yield path
+
+
+def _write_run(entries, directory):
+    entries.sort()
+    fd, path = tempfile.mkstemp(dir=directory, suffix='.run')
+    with os.fdopen(fd, mode='wb') as fp:
+        for entry in entries:
+            fp.write(_entry.pack(*entry))
+    entries.clear()
+    return path
+
+
+def _read_run(path):
+    with open(path, mode='rb') as fp:
+        while True:
+            data = fp.read(_entry.size)
+            if len(data) < _entry.size:
+                break
+            yield _entry.unpack(data)
+
+
+def build_snapshot(dump_paths, directory, run_size=1000000):
+    """Index Crossref dump files into a snapshot directory.
+
+    The entries are sorted in runs of *run_size* and then merged, so
+    memory use does not grow with the size of the dump.
+
+    Parameters
+    ==========
+    dump_paths : list
+      Gzipped JSON-lines files from Crossref, or directories
+      containing them. Later files take priority for repeated DOIs.
+    directory : str
+      Where to save the snapshot.
+    run_size : int
+      How many index entries to sort in memory at a time.
+
+    Returns
+    =======
+    count : int
+      The number of works indexed.
+
+    """
+    directory = Path(directory).expanduser()
+    directory.mkdir(parents=True, exist_ok=True)
+    runs = []
+    entries = []
+    count = 0
+    with tempfile.TemporaryDirectory(dir=directory) as tmpdir:
+        # Save the trimmed records, and sort the index in runs
+        with open(directory / records_filename, mode='wb') as records:
+            for dump_path in _dump_files(dump_paths):
+                log.info("Indexing %s", dump_path)
+                with gzip.open(dump_path, mode='rt', encoding='utf-8') as fp:
+                    for line in fp:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        work = json.loads(line)
+                        if 'DOI' not in work:
+                            continue
+                        data = json.dumps(slim_work(work), separators=(',', ':')).encode('utf-8')
+                        entries.append((doi_hash(work['DOI']), records.tell(), len(data)))
+                        records.write(data + b'\n')
+                        count += 1
+                        if len(entries) >= run_size:
+                            runs.append(_write_run(entries, tmpdir))
+        runs.append(_write_run(entries, tmpdir))
+        # Merge the sorted runs into the final index
+        tmp_index = directory / (index_filename + '.tmp')
+        with open(tmp_index, mode='wb') as fp:
+            fp.write(_header.pack(index_magic, count))
+            for entry in heapq.merge(*(_read_run(run) for run in runs)):
+                fp.write(_entry.pack(*entry))
+        os.replace(tmp_index, directory / index_filename)
+    log.info("Indexed %d works into %s", count, directory)
+    return count
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_snapshot():
+    """Open the snapshot given in the config file.
+
+    Returns ``None`` if no snapshot is configured, or it cannot be
+    opened.
+
+    """
+    global _snapshot
+    directory = config['crossref'].get('snapshot', '').strip()
+    if not directory:
+        return None
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.directory != Path(directory).expanduser():
+            try:
+                _snapshot = CrossrefSnapshot(directory)
+            except (OSError, ValueError) as e:
+                log.warning("Could not open crossref snapshot %s: %s", directory, e)
+                return None
+        return _snapshot
+
+
+def index_crossref_cli(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Index Crossref metadata dumps for offline DOI lookups'
+    )
+    parser.add_argument('dumps', nargs='+', metavar='DUMP',
+                        help='gzipped JSON-lines files, or directories containing them')
+    parser.add_argument('-o', '--output', dest='output', metavar='PATH', default=None,
+                        help='directory in which to save the snapshot')
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                        help="show detailed debug information via the logging platform")
+    parser.add_argument('-V', '--version', action='version', version='%(prog)s v{}'.format(__version__))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    config.read()
+    output = args.output if args.output is not None else config['crossref']['snapshot']
+    if not output:
+        parser.error("an output directory is required (--output or [crossref] snapshot)")
+    count = build_snapshot(args.dumps, output)
+    print("Indexed {} works into {}".format(count, output))
@@ -0,0 +1,393 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""A long-running franklin service, and the client used to reach it.
+
+Each run of ``fetch-doi`` pays for starting python, importing
+franklin's dependencies and opening new HTTP connections, and then
+throws its caches away. ``franklind`` keeps a single process running
+instead, so the HTTP sessions, in-memory caches, bibtex indexes and
+LTWA list are ready for the next request.
+
+The daemon listens on a Unix socket. Each connection carries one
+request: a JSON object on a single line with the name of the command
+and its (already parsed) arguments. The daemon answers with JSON
+lines: any output from the command as it is printed, then the
+outcome.
+
+If enabled in the ``[daemon]`` section of the config file,
+``fetch-doi`` and ``abbreviate-journals`` send their work to the
+daemon if it is running, and otherwise do it themselves. The daemon
+reads the config file once, when it starts, so requests never see it
+half-read.
+
+"""
+
+import os
+import sys
+import json
+import socket
+import logging
+import argparse
+import builtins
+import importlib
+import threading
+import contextlib
+import socketserver
+from pathlib import Path
+
+from .config import franklin_config as config
+from .version import __version__
+from . import exceptions
+from . import cache  # noqa: F401 (provides the [cache] defaults)
+
+
+log = logging.getLogger(__name__)
+
+
+# Prepare default global configuration values
+config.set_defaults('daemon', {
+    # Send work to franklind if it is running
+    'enabled': 'no',
+    # Where franklind listens (blank to use the cache directory)
+    'socket': '',
+})
+
+
+socket_name = 'franklind.sock'
+
+# The function that carries out each command, as "module:function"
+commands = {
+    'fetch-doi': 'franklin.fetch_doi:run_fetch_doi',
+    'abbreviate-journals': 'franklin.journals:run_abbreviate_journals',
+}
+
+
+def socket_path():
+    """Where franklind listens for requests."""
+    path = config['daemon'].get('socket', '').strip()
+    if not path:
+        path = Path(config['cache']['directory']).expanduser() / socket_name
+    return Path(path).expanduser()
+
+
+def prepare_args(args, paths=(), defaults={}):
+    """Prepare parsed command line arguments to be sent to franklind.
+
+    The daemon has its own working directory, so the arguments listed
+    in *paths* are made absolute.
+
+    Parameters
+    ==========
+    args : argparse.Namespace
+      The parsed command line arguments.
+    paths : iterable
+      Names of arguments that hold file paths.
+    defaults : dict
+      Values for arguments that were not given (e.g. from the config
+      file), so that relative paths in them are also resolved against
+      the client's working directory.
+
+    Returns
+    =======
+    args : dict
+      The arguments as a JSON-compatible dictionary.
+
+    """
+    args = dict(vars(args))
+    for key, value in defaults.items():
+        if args.get(key) is None:
+            args[key] = value
+    for key in paths:
+        value = args.get(key)
+        if isinstance(value, (list, tuple)):
+            args[key] = [os.path.abspath(os.path.expanduser(v)) for v in value]
+        elif value is not None:
+            args[key] = os.path.abspath(os.path.expanduser(value))
+    return args
+
+
+def _exception(name, message):
+    """Rebuild an exception raised inside franklind."""
+    for namespace in [exceptions, builtins]:
+        cls = getattr(namespace, name, None)
+        if isinstance(cls, type) and issubclass(cls, Exception):
+            try:
+                return cls(message)
+            except TypeError:
+                break
+    return exceptions.DaemonError("{}: {}".format(name, message))
+
+
+def submit(command, args=None):
+    """Ask franklind to carry out *command*.
+
+    Output from the command is written to this process's stdout and
+    stderr as it arrives, and exceptions raised by the command are
+    raised again here.
+
+    Parameters
+    ==========
+    command : str
+      The name of the command, e.g. ``"fetch-doi"``.
+    args : dict
+      Arguments for the command, usually from :py:func:`prepare_args`.
+
+    Returns
+    =======
+    result
+      Whatever the command returned.
+
+    Raises
+    ======
+    DaemonUnavailable
+      franklind is not running, so the caller should do the work
+      itself.
+
+    """
+    path = socket_path()
+    if not hasattr(socket, 'AF_UNIX'):
+        raise exceptions.DaemonUnavailable("Unix sockets are not supported here")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError as e:
+        sock.close()
+        raise exceptions.DaemonUnavailable("Could not connect to {}: {}".format(path, e))
+    log.debug("Sending %s to franklind at %s", command, path)
+    with sock, sock.makefile(mode='r', encoding='utf-8') as fp:
+        request = {'command': command, 'args': args if args is not None else {}}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        for line in fp:
+            message = json.loads(line)
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+                sys.stdout.flush()
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+                sys.stderr.flush()
+            elif 'error' in message:
+                raise _exception(message['error'], message.get('message', ''))
+            elif 'exit' in message:
+                raise SystemExit(message['exit'])
+            else:
+                return message.get('result')
+    raise exceptions.DaemonError("franklind closed the connection before finishing {}".format(command))
+
+
+class _ThreadStream():
+    """Stand-in for stdout/stderr that sends a worker thread's output to its client.
+
+    Threads that are not handling a request write to the original
+    stream.
+
+    """
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+        self.local = threading.local()
+
+    def write(self, text):
+        send = getattr(self.local, 'send', None)
+        if send is None:
+            return self.stream.write(text)
+        send({self.name: text})
+        return len(text)
+
+    def flush(self):
+        if getattr(self.local, 'send', None) is None:
+            self.stream.flush()
+
+    def isatty(self):
+        if getattr(self.local, 'send', None) is None:
+            return self.stream.isatty()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextlib.contextmanager
+def capture_output():
+    """Let each request's stdout and stderr be sent to its own client."""
+    streams = (sys.stdout, sys.stderr)
+    sys.stdout = _ThreadStream(sys.stdout, 'stdout')
+    sys.stderr = _ThreadStream(sys.stderr, 'stderr')
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = streams
+
+
+def _load_command(name):
+    try:
+        module, function = commands[name].split(':')
+    except KeyError:
+        raise exceptions.DaemonError("Unknown command: {}".format(name))
+    return getattr(importlib.import_module(module), function)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Carry out one request from a franklin client."""
+    def handle(self):
+        self.connected = True
+        try:
+            request = json.loads(self.rfile.readline())
+            command = request['command']
+            args = argparse.Namespace(**request.get('args', {}))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send({'error': 'DaemonError', 'message': "Invalid request: {}".format(e)})
+            return
+        log.info("Received %s request", command)
+        if command == 'ping':
+            self.send({'result': __version__})
+        elif command == 'shutdown':
+            self.send({'result': None})
+            threading.Thread(target=self.server.shutdown).start()
+        else:
+            self.run(command, args)
+
+    def run(self, command, args):
+        streams = [stream for stream in (sys.stdout, sys.stderr)
+                   if isinstance(stream, _ThreadStream)]
+        for stream in streams:
+            stream.local.send = self.send
+        try:
+            result = _load_command(command)(args)
+        except SystemExit as e:
+            self.send({'exit': e.code})
+        except Exception as e:
+            log.info("%s request failed: %s", command, e)
+            self.send({'error': type(e).__name__, 'message': str(e)})
+        else:
+            self.send({'result': result})
+        finally:
+            for stream in streams:
+                stream.local.send = None
+
+    def send(self, message):
+        if not self.connected:
+            return
+        try:
+            self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        except OSError:
+            # The client went away, but finish the work anyway
+            log.warning("Lost connection to client")
+            self.connected = False
+
+
+class FranklinServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Answer requests from franklin clients on a Unix socket.
+
+    Each request is handled in its own thread. A stale socket file
+    left behind by a previous server is replaced.
+
+    Parameters
+    ==========
+    path : str
+      The Unix socket to listen on.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(str(path))
+            except OSError:
+                log.info("Removing stale socket %s", path)
+                path.unlink()
+            else:
+                raise exceptions.DaemonError("franklind is already running at {}".format(path))
+            finally:
+                probe.close()
+        # Only this user may submit requests
+        umask = os.umask(0o077)
+        try:
+            super().__init__(str(path), RequestHandler)
+        finally:
+            os.umask(umask)
+        self.path = path
+
+    def server_close(self):
+        super().server_close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def warm_up():
+    """Load the slowest parts of franklin before the first request."""
+    from . import fetch_doi, journals, bibindex
+    # The command line scripts only import these when they're needed
+    for module in ['bibtexparser', 'pandas', 'tqdm', 'titlecase']:
+        importlib.import_module(module)
+    bibindex.keep_in_memory()
+    bibfile = Path(config['fetch_doi']['bibtex_file']).expanduser()
+    if bibfile.is_file():
+        with open(bibfile, mode='r') as fp:
+            bibindex.BibIndex.for_file(fp)
+    try:
+        journals.ltwa.matcher()
+    except Exception as e:
+        log.warning("Could not load the LTWA list: %s", e)
+    log.info("Finished warming up")
+
+
+def serve(path=None, warm=True):
+    """Run franklind until it is asked to shut down."""
+    path = Path(path) if path is not None else socket_path()
+    with FranklinServer(path) as server, capture_output():
+        if warm:
+            threading.Thread(target=warm_up, daemon=True).start()
+        log.info("Listening on %s", path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    log.info("Stopped listening on %s", path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Keep franklin running to answer fetch-doi and abbreviate-journals quickly'
+    )
+    parser.add_argument('-s', '--socket', dest='socket', metavar='PATH', default=None,
+                        help='the Unix socket to listen on')
+    parser.add_argument('--stop', dest='stop', action='store_true',
+                        help='stop a running franklind')
+    parser.add_argument('--no-warm-up', dest='warm', action='store_false',
+                        help="don't load the bibtex index and LTWA list until they're needed")
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                        help="show detailed debug information via the logging platform")
+    parser.add_argument('-V', '--version', action='version', version='%(prog)s v{}'.format(__version__))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    config.read()
+    if args.socket is not None:
+        config['daemon']['socket'] = args.socket
+    if args.stop:
+        try:
+            submit('shutdown')
+        except exceptions.DaemonUnavailable:
+            print("franklind is not running")
+            return 1
+        return 0
+    serve(warm=args.warm)
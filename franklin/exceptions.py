@@ -1,9 +1,17 @@
+import requests
+
+
 class DOIError(RuntimeError):
     """Resolution of a digital object identifier has encountered an error."""
     pass
 
 
-class BibtexNotDownloaded(RuntimeError):
+class MetadataNotDownloaded(RuntimeError):
+    """Tried to download metadata from DOI but was unsuccessful."""
+    pass
+
+
+class BibtexNotDownloaded(MetadataNotDownloaded):
     """Tried to download bibtex from DOI but was unsuccessful."""
     pass
 
@@ -17,7 +25,12 @@ class BibtexFileNotFoundError(FileNotFoundError):
     pass
 
 
-class BibtexParseError(RuntimeError):
+class MetadataParseError(RuntimeError):
+    """The retrieved metadata could not be parsed properly."""
+    pass
+
+
+class BibtexParseError(MetadataParseError):
     """The bibtex string could not be parsed properly."""
     pass
 
@@ -26,18 +39,75 @@ class CassiError(RuntimeError):
     pass
 
 
+class CassiTermsError(CassiError):
+    """CASSI did not accept its terms of service, so cannot be searched."""
+    pass
+
+
 class MultipleLTWAMatches(RuntimeError):
     pass
 
 
+class LTWANotAvailable(RuntimeError):
+    """The LTWA has not been saved locally, and cannot be downloaded."""
+    pass
+
+
 class PDFNotFoundError(FileNotFoundError):
     pass
 
 
+class InvalidPDFError(PDFNotFoundError):
+    """The publisher responded with something other than a PDF.
+    
+    The start of the response is kept as ``head`` so the reason can
+    be diagnosed.
+    
+    """
+    def __init__(self, *args, head=b''):
+        super().__init__(*args)
+        self.head = head
+
+
+class TruncatedPDFError(PDFNotFoundError):
+    """The PDF is missing its end, probably from an interrupted download."""
+    pass
+
+
+class PDFResumeError(PDFNotFoundError):
+    """The publisher would not continue an interrupted download."""
+    pass
+
+
+class PDFTooLargeError(RuntimeError):
+    """The PDF is larger than the maximum allowed size."""
+    pass
+
+
 class FileExistsError(RuntimeError):
     pass
 
 
+class FileLockError(RuntimeError):
+    """A shared file could not be locked in time."""
+    pass
+
+
+class PDFInProgressError(RuntimeError):
+    """Another process is already downloading to this PDF file."""
+    pass
+
+
+class DaemonError(RuntimeError):
+    """franklind could not carry out a request."""
+    pass
+
+
+class DaemonUnavailable(DaemonError):
+    """franklind is not running."""
+    pass
+
+
 class ConfigError(RuntimeError):
     pass
 
@@ -45,3 +115,7 @@ class ConfigError(RuntimeError):
 class UnknownPublisherError(KeyError):
     pass
 
+
+class HostUnavailableError(requests.exceptions.ConnectionError):
+    """A host has failed too many times recently to be worth contacting."""
+    pass
@@ -17,23 +17,34 @@ import os
 from pathlib import Path
 import argparse
 import re
+import uuid
 import logging
+import threading
+import contextlib
 from typing import List, Iterable
-
-import bibtexparser
+from concurrent.futures import ThreadPoolExecutor
 
 from .article import Article
 from .version import __version__
 from .config import franklin_config as config
-from . import exceptions
+from .ratelimit import interleave
+from .bibindex import BibIndex
+from .locking import FileLock, lock_file, rename_no_clobber
+from . import exceptions, publishers, daemon
 
 log = logging.getLogger(__name__)
 
 
-config['fetch_doi'] = {
+config.set_defaults('fetch_doi', {
     'bibtex_file': "./refs.bib",
     'pdf_dir': "./papers/",
-}
+    # How many DOIs to retrieve at once when using ``--from-file``
+    'workers': '4',
+    # Largest PDF that will be downloaded (bytes), or 0 for no limit
+    'max_pdf_size': '0',
+    # How long to wait for another fetch-doi to finish with the bibtex file (seconds)
+    'lock_timeout': '60',
+})
 
 
 def parse_doi(doi):
@@ -71,6 +82,77 @@ def existing_ids(doi: str, bib_entries: Iterable) -> List:
     return existing_ids
 
 
+class IDAllocator():
+    """Hands out unique bibtex IDs.
+    
+    The IDs already in use are kept in a set, and the next suffix to
+    try is remembered for each base ID, so allocating an ID does not
+    get slower as more entries share the same base (e.g. "wang2020",
+    "wang2020-2", ..., "wang2020-40").
+    
+    Parameters
+    ==========
+    taken : iterable
+      IDs that are already in use.
+    pdf_dir : str
+      If given, IDs are also taken if a PDF with that name exists in
+      this directory.
+    next_suffix : dict
+      The next suffix to try for each base ID, shared with other
+      allocators for the same bibtex file.
+    
+    """
+    def __init__(self, taken=(), pdf_dir=None, next_suffix=None):
+        self.taken = set(taken)
+        self.pdf_dir = pdf_dir
+        self._next_suffix = next_suffix if next_suffix is not None else {}
+        self._lock = threading.RLock()
+    
+    @classmethod
+    def for_index(cls, index, pdf_dir=None):
+        """Create an allocator for the entries in a :py:class:`BibIndex`.
+        
+        PDFs are checked for one at a time, so *pdf_dir* is never
+        listed. The next suffix for each base ID is kept with the
+        index, so later allocators for the same bibtex file (e.g. in
+        ``franklind``) carry on where this one left off.
+        
+        """
+        return cls(index.ids, pdf_dir=pdf_dir, next_suffix=index.next_suffix)
+    
+    @classmethod
+    def from_sources(cls, pdfs=(), bibtex_ids=()):
+        """Create an allocator from PDF filenames and existing bibtex IDs."""
+        allocator = cls(bibtex_ids)
+        allocator.taken.update(os.path.splitext(pdf)[0] for pdf in pdfs)
+        return allocator
+    
+    def __contains__(self, id_):
+        if id_ in self.taken:
+            return True
+        if self.pdf_dir is not None:
+            return os.path.exists(os.path.join(self.pdf_dir, '{}.pdf'.format(id_)))
+        return False
+    
+    def peek(self, base_id):
+        """Find the next available ID for *base_id*, without using it."""
+        with self._lock:
+            if base_id not in self:
+                return base_id
+            idx = self._next_suffix.get(base_id, 2)
+            while "{}-{}".format(base_id, idx) in self:
+                idx += 1
+            self._next_suffix[base_id] = idx
+            return "{}-{}".format(base_id, idx)
+    
+    def allocate(self, base_id):
+        """Find an available ID for *base_id*, and mark it as used."""
+        with self._lock:
+            new_id = self.peek(base_id)
+            self.taken.add(new_id)
+            return new_id
+
+
 def validate_bibtex_id(base_id, pdfs, bibtex_entries):
     """Find a unique identifier for this bibtex entry and PDF file.
     
@@ -90,20 +172,14 @@ def validate_bibtex_id(base_id, pdfs, bibtex_entries):
     new_id : str
       The new, unique identifier for this entry.
     
+    When the entries are already in a :py:class:`BibIndex`,
+    :py:meth:`IDAllocator.for_index` is faster, since the PDF
+    directory isn't listed.
+    
     """
-    # Helper function
-    def id_is_taken(this_id, pdf_ids, bibtext_ids):
-        return (this_id in pdf_ids or this_id in bibtex_ids)
-    # Prepare lists of existing IDs
-    stripped_pdfs = [os.path.splitext(pdf)[0] for pdf in pdfs]
-    bibtex_ids = [entry['ID'] for entry in bibtex_entries]
-    # Iterate through all the indices and check for available IDs
-    idx = 2
-    new_id = base_id
-    while id_is_taken(new_id, stripped_pdfs, bibtex_ids):
-        new_id = "{}-{}".format(base_id, idx)
-        idx += 1
-    return new_id
+    bibtex_ids = (entry['ID'] for entry in bibtex_entries)
+    allocator = IDAllocator.from_sources(pdfs=pdfs, bibtex_ids=bibtex_ids)
+    return allocator.peek(base_id)
 
 
 def add_bibtex_entry(bibtex, bibtexfile):
@@ -124,6 +200,196 @@ def add_bibtex_entry(bibtex, bibtexfile):
     bibtexfile.write(bibtex)
 
 
+class FetchResult():
+    """The outcome of retrieving one DOI as part of a batch.
+    
+    Attributes
+    ==========
+    doi : str
+      The requested digital object identifier.
+    id : str
+      The bibtex ID of the new entry, or ``None`` if retrieval failed.
+    error : Exception
+      The exception that prevented retrieval, or ``None`` on success.
+    
+    """
+    def __init__(self, doi, id=None, error=None):
+        self.doi = doi
+        self.id = id
+        self.error = error
+    
+    @property
+    def succeeded(self):
+        return self.error is None
+    
+    def fail(self, error):
+        """Mark this DOI as not retrieved because of *error*."""
+        log.warning("Could not retrieve DOI '%s': %s", self.doi, error)
+        self.id = None
+        self.error = error
+    
+    def __repr__(self):
+        return "FetchResult(doi={!r}, id={!r}, error={!r})".format(self.doi, self.id, self.error)
+
+
+def _save_pdf(article, pdf_dir, new_id, rename=True):
+    """Download the PDF for *article* to ``<pdf_dir>/<new_id>.pdf``.
+    
+    The PDF is first downloaded to ``<new_id>.pdf.part``, and only
+    renamed once it is complete and valid. If the download fails, the
+    partial file is kept so that the next attempt can resume it. The
+    partial file is locked while downloading, and
+    :py:class:`~franklin.exceptions.PDFInProgressError` is raised if
+    another process is already downloading to it.
+    
+    If *rename* is false, the finished PDF is instead moved to a
+    temporary name (returned) to be put in place later.
+    
+    """
+    pdffile = os.path.join(pdf_dir, '{}.pdf'.format(new_id))
+    partfile = pdffile + '.part'
+    max_size = config['fetch_doi'].getint('max_pdf_size') or None
+    try:
+        # Create the file if needed, but don't truncate it
+        fd = os.open(partfile, os.O_RDWR | os.O_CREAT, 0o666)
+        with open(fd, 'r+b') as pdffp:
+            if not lock_file(pdffp, blocking=False):
+                raise exceptions.PDFInProgressError(
+                    "Another process is downloading {}".format(partfile))
+            resumed = pdffp.seek(0, os.SEEK_END) > 0
+            pdffp.seek(0)
+            try:
+                article.download_pdf(fp=pdffp, max_size=max_size)
+                publishers.validate_pdf_file(pdffp, doi=article.doi)
+            except exceptions.PDFTooLargeError:
+                # Not worth resuming, so start fresh next time
+                pdffp.truncate(0)
+                raise
+            except exceptions.InvalidPDFError:
+                # A bad response (e.g. a captcha) to a resumed download
+                # leaves the earlier part of the PDF worth keeping
+                pdffp.seek(0)
+                if not (resumed and publishers.is_pdf(pdffp.read(len(publishers.pdf_magic)))):
+                    pdffp.truncate(0)
+                raise
+            if not rename:
+                # Move it somewhere nobody else will try to resume it
+                stagedfile = '{}.{}.tmp'.format(pdffile, uuid.uuid4().hex[:8])
+                os.replace(partfile, stagedfile)
+                return stagedfile
+    except exceptions.PDFInProgressError:
+        raise
+    except:
+        # Keep the partial file, unless there's nothing to resume
+        if os.path.exists(partfile) and os.path.getsize(partfile) == 0:
+            os.remove(partfile)
+        raise
+    rename_no_clobber(partfile, pdffile)
+    return pdffile
+
+
+def _stage_pdf(article, pdf_dir, new_id, allocator, base_id):
+    """Download the PDF for *article* to a temporary file.
+    
+    If another process is already downloading a PDF with this ID, a
+    different ID is used.
+    
+    Returns
+    =======
+    new_id : str
+      The ID that was used in the end.
+    stagedfile : str
+      Where the PDF was saved.
+    
+    """
+    while True:
+        try:
+            return new_id, _save_pdf(article, pdf_dir, new_id, rename=False)
+        except exceptions.PDFInProgressError as e:
+            log.info("%s, trying another ID", e)
+            new_id = allocator.allocate(base_id)
+
+
+def _publisher_name(article):
+    """Determine which publisher handler will retrieve *article*'s PDF."""
+    try:
+        return article.get_publisher().__name__
+    except exceptions.UnknownPublisherError:
+        return None
+
+
+def _resolve_article(doi):
+    """Retrieve the metadata for *doi* and determine its default ID."""
+    article = Article(doi=doi)
+    base_id = article.default_id()
+    return article, base_id
+
+
+def _bibfile_lock(bibfile):
+    """Keep other franklin processes from changing the bibtex file."""
+    name = getattr(bibfile, 'name', None)
+    if isinstance(name, (str, os.PathLike)) and os.path.isfile(name):
+        path = Path(name)
+        lockfile = path.parent / '.{}.lock'.format(path.name)
+        return FileLock(lockfile, timeout=config['fetch_doi'].getfloat('lock_timeout'))
+    return contextlib.nullcontext()
+
+
+def _commit(jobs, bibfile, index, pdf_dir):
+    """Add new entries to the bibtex file, and their PDFs to *pdf_dir*.
+    
+    Another process may have added entries since the IDs were
+    allocated, so the bibtex file is locked and the IDs checked again
+    before anything is saved. The lock is only held while checking
+    and saving, not while retrieving anything.
+    
+    Parameters
+    ==========
+    jobs : list
+      ``(result, article, base_id, stagedfile)`` for each new entry,
+      where *stagedfile* is the downloaded PDF (or ``None``).
+    
+    """
+    # Prepare the bibtex before locking, since it may need retrieving
+    prepared = []
+    for result, article, base_id, stagedfile in jobs:
+        try:
+            prepared.append((result, article, base_id, stagedfile, article.bibtex(id=result.id)))
+        except Exception as e:
+            result.fail(e)
+            if stagedfile is not None:
+                os.remove(stagedfile)
+    new_bibtexs = []
+    with _bibfile_lock(bibfile):
+        if index.bibpath is not None:
+            index.refresh()
+        allocator = IDAllocator.for_index(index, pdf_dir=pdf_dir)
+        for result, article, base_id, stagedfile, bibtex in prepared:
+            try:
+                _existing_ids = index.find_doi(result.doi)
+                if _existing_ids:
+                    raise exceptions.DuplicateDOIError(
+                        "Existing entries found for DOI '{}': {}".format(result.doi, _existing_ids))
+                new_id = allocator.allocate(base_id if result.id in allocator else result.id)
+                if new_id != result.id:
+                    log.info("ID %s was taken by another process, using %s", result.id, new_id)
+                    bibtex = article.bibtex(id=new_id)
+                if stagedfile is not None:
+                    rename_no_clobber(stagedfile, os.path.join(pdf_dir, '{}.pdf'.format(new_id)))
+            except Exception as e:
+                result.fail(e)
+                if stagedfile is not None and os.path.exists(stagedfile):
+                    os.remove(stagedfile)
+            else:
+                result.id = new_id
+                new_bibtexs.append(bibtex)
+                index.add(result.id, result.doi)
+        if new_bibtexs:
+            add_bibtex_entry('\n'.join(new_bibtexs), bibfile)
+            bibfile.flush()
+            index.save()
+
+
 def fetch_doi(doi, bibfile, pdf_dir, bibtex_id=None, retrieve_pdf=True):
     """Retrieve a document by its Digital object idetifier.
     
@@ -154,41 +420,127 @@ def fetch_doi(doi, bibfile, pdf_dir, bibtex_id=None, retrieve_pdf=True):
       The bibtex ID for the new entry.
     
     """
-    # Read in the existing bibtex entries
-    bibfile.seek(0)
-    bibdb = bibtexparser.loads(bibfile.read() + ' ')
-    # Create the article class
-    article = Article(doi=doi)
-    # Retrieve the article metdata
-    metadata = article.metadata()
+    # Look up the existing bibtex entries
+    index = BibIndex.for_file(bibfile)
     # Check if the entry already exists in the refs file
-    _existing_ids = existing_ids(doi=doi, bib_entries=bibdb.entries)
+    _existing_ids = index.find_doi(doi)
     if _existing_ids:
         raise exceptions.DuplicateDOIError(
             "Existing entries found for DOI '{}': {}".format(doi, _existing_ids))
+    # Create the article class, and start retrieving its metadata
+    article = Article(doi=doi)
+    article.prefetch(url=retrieve_pdf)
     # Determine a unique ID for this entry/PDF
     default_id = bibtex_id if bibtex_id is not None else article.default_id()
-    new_id = validate_bibtex_id(base_id=default_id,
-                                pdfs=os.listdir(pdf_dir),
-                                bibtex_entries=bibdb.entries)
-    # Download the PDF
+    allocator = IDAllocator.for_index(index, pdf_dir=pdf_dir)
+    new_id = allocator.allocate(default_id)
+    # Download the PDF (while the metadata is still arriving if
+    # ``bibtex_id`` was given)
+    stagedfile = None
     if retrieve_pdf:
-        pdffile = os.path.join(pdf_dir, '{}.pdf'.format(new_id))
+        new_id, stagedfile = _stage_pdf(article, pdf_dir, new_id, allocator, default_id)
+    # Add the bibtex entry to the bibfile
+    result = FetchResult(doi=doi, id=new_id)
+    _commit([(result, article, default_id, stagedfile)], bibfile, index, pdf_dir)
+    if not result.succeeded:
+        raise result.error
+    return result.id
+
+
+def fetch_dois(dois, bibfile, pdf_dir, retrieve_pdf=True, workers=1):
+    """Retrieve many documents by their digital object identifiers.
+    
+    Similar to :py:func:`fetch_doi`, except the bibtex file is only
+    parsed once for the whole batch, and all the new entries are
+    added to the bibtex file in a single write at the end. Failure to
+    retrieve one DOI does not prevent retrieval of the others.
+    
+    Metadata and PDFs are retrieved for up to *workers* DOIs at a
+    time. The bibtex IDs are allocated in the order the DOIs were
+    given, so the results do not depend on the number of workers.
+    
+    Parameters
+    ==========
+    dois : iterable
+      The digital object identifiers to retrieve.
+    bibfile : File-like object
+      An open, writable (``mode='a+'``), text-mode file that will
+      receive the new bibtex entries.
+    pdf_dir : str
+      Directory in which to put the PDFs.
+    retrieve_pdf : bool
+      Whether to attempt to download the PDF of each document
+      (default, True).
+    workers : int
+      How many DOIs to retrieve concurrently.
+    
+    Returns
+    =======
+    results : list
+      A :py:class:`FetchResult` for each requested DOI, in order.
+    
+    """
+    # Look up the existing bibtex entries once for the whole batch
+    index = BibIndex.for_file(bibfile)
+    allocator = IDAllocator.for_index(index, pdf_dir=pdf_dir)
+    # Check for malformed and duplicate DOIs before doing any retrieval
+    results = [FetchResult(doi=doi) for doi in dois]
+    pending = []
+    requested = set()
+    for result in results:
         try:
-            pdffp = open(pdffile, 'wb')
-            article.download_pdf(fp=pdffp)
-        except:
-            # Delete the file if an exception occurred
-            pdffp.close()
-            os.remove(pdffile)
-            raise
+            result.doi = parse_doi(result.doi)
+            _existing_ids = index.find_doi(result.doi)
+            if _existing_ids:
+                raise exceptions.DuplicateDOIError(
+                    "Existing entries found for DOI '{}': {}".format(result.doi, _existing_ids))
+            if result.doi.lower() in requested:
+                raise exceptions.DuplicateDOIError(
+                    "DOI '{}' requested more than once".format(result.doi))
+        except (exceptions.DOIError, exceptions.DuplicateDOIError) as e:
+            result.error = e
         else:
-            # Upon successful download, just close the file
-            pdffp.close()
-    # Add the bibtex entry to the bibfile
-    bibtex = article.bibtex(id=new_id)
-    add_bibtex_entry(bibtex, bibfile)
-    return new_id
+            requested.add(result.doi.lower())
+            pending.append(result)
+    jobs = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Retrieve the metadata for all the articles concurrently
+        futures = [executor.submit(_resolve_article, result.doi) for result in pending]
+        for result, future in zip(pending, futures):
+            try:
+                article, base_id = future.result()
+            except Exception as e:
+                result.fail(e)
+            else:
+                jobs.append([result, article, base_id, None])
+        # Allocate IDs in order so the output is reproducible
+        for job in jobs:
+            result, article, base_id, _ = job
+            result.id = allocator.allocate(base_id)
+        # Download the PDFs concurrently, alternating between publishers
+        if retrieve_pdf:
+            downloads = interleave(jobs, key=lambda job: _publisher_name(job[1]))
+            futures = [executor.submit(_stage_pdf, job[1], pdf_dir, job[0].id, allocator, job[2])
+                       for job in downloads]
+            for job, future in zip(downloads, futures):
+                try:
+                    job[0].id, job[3] = future.result()
+                except Exception as e:
+                    job[0].fail(e)
+            jobs = [job for job in jobs if job[0].succeeded]
+    # Save all the new entries in one go
+    _commit(jobs, bibfile, index, pdf_dir)
+    return results
+
+
+def read_doi_file(fp):
+    """Read a list of DOIs, one per line, from an open text file.
+    
+    Blank lines and lines starting with ``#`` are ignored.
+    
+    """
+    dois = [line.strip() for line in fp]
+    return [doi for doi in dois if doi and not doi.startswith('#')]
 
 
 def main(argv=None):
@@ -196,8 +548,12 @@ def main(argv=None):
     parser = argparse.ArgumentParser(
         description='Fetch an article by its digital object identifier'
     )
-    parser.add_argument('doi', type=str,
+    parser.add_argument('doi', type=str, nargs='?',
                         help='the digital object identifier to retrieve')
+    parser.add_argument('--from-file', dest='doi_file', metavar='FILE',
+                        help='retrieve all the DOIs listed in this file, one per line')
+    parser.add_argument('-j', '--jobs', dest='workers', type=int, default=None,
+                        help='how many DOIs from --from-file to retrieve concurrently')
     parser.add_argument('-p', '--pdf-dir', dest='pdf_dir',
                         metavar='PATH',
                         help='where to store the downloaded PDF')
@@ -212,6 +568,8 @@ def main(argv=None):
                         help="show detailed debug information via the logging platform")
     parser.add_argument('-f', '--force', dest='force', action='store_true',
                         help="force creation of files, directories, etc.")
+    parser.add_argument('--no-daemon', dest='use_daemon', action='store_false',
+                        help="do the work in this process, even if franklind is running")
     parser.add_argument('-V', '--version', action='version', version='%(prog)s v{}'.format(__version__))
     # Parse the command line arguments
     args = parser.parse_args(argv)
@@ -222,8 +580,29 @@ def main(argv=None):
     else:
         level = logging.WARNING
     logging.basicConfig(level=level)
+    if args.doi is None and args.doi_file is None:
+        parser.error("a DOI or --from-file is required")
     # Load the franklin rc file if available
     config.read()
+    # Let franklind do the work if it's running
+    if args.use_daemon and config['daemon'].getboolean('enabled'):
+        defaults = {'bibfile': config['fetch_doi']['bibtex_file'],
+                    'pdf_dir': config['fetch_doi']['pdf_dir']}
+        remote_args = daemon.prepare_args(args, paths=['doi_file', 'pdf_dir', 'bibfile'],
+                                          defaults=defaults)
+        try:
+            return daemon.submit('fetch-doi', remote_args)
+        except exceptions.DaemonUnavailable as e:
+            log.debug("Not using franklind: %s", e)
+    return run_fetch_doi(args)
+
+
+def run_fetch_doi(args):
+    """Fetch DOIs as requested by parsed command line arguments.
+    
+    Used by ``fetch-doi`` and by ``franklind``.
+    
+    """
     # Prepare the metadata from the CLI arguments, etc
     force = args.force
     bibfile = args.bibfile if args.bibfile is not None else config['fetch_doi']['bibtex_file']
@@ -232,7 +611,7 @@ def main(argv=None):
     pdf_dir = args.pdf_dir if args.pdf_dir is not None else config['fetch_doi']['pdf_dir']
     pdf_dir = Path(pdf_dir).expanduser().resolve()
     retrieve_pdf = args.retrieve_pdf
-    doi = parse_doi(args.doi)
+    workers = args.workers if args.workers is not None else config['fetch_doi'].getint('workers')
     # Check if the file exists
     if not os.path.exists(bibfile) and not force:
         raise exceptions.BibtexFileNotFoundError("Cannot find bibtex file: {}".format(bibfile))
@@ -242,7 +621,27 @@ def main(argv=None):
             os.makedirs(pdf_dir)
         else:
             raise exceptions.BibtexFileNotFoundError("Cannot find PDF folder: {}".format(pdf_dir))
+    # Retrieve a whole batch of DOIs
+    if args.doi_file is not None:
+        with open(args.doi_file, mode='r') as fp:
+            dois = read_doi_file(fp)
+        if args.doi is not None:
+            dois.insert(0, args.doi)
+        logging.debug("Opening bibfile '%s'", bibfile)
+        with open(bibfile, mode='a+') as bibfp:
+            results = fetch_dois(dois=dois, bibfile=bibfp, pdf_dir=pdf_dir,
+                                 retrieve_pdf=retrieve_pdf, workers=workers)
+        # Report on how each DOI went
+        for result in results:
+            if result.succeeded:
+                print("Saved {} as {} ({}.pdf)".format(result.doi, result.id, os.path.join(pdf_dir, result.id)))
+            else:
+                print("Failed {}: {}".format(result.doi, result.error))
+        failures = [r for r in results if not r.succeeded]
+        print("Retrieved {}/{} DOIs".format(len(results) - len(failures), len(results)))
+        return 1 if failures else 0
     # Do the actual DOI fetching
+    doi = parse_doi(args.doi)
     logging.debug("Opening bibfile '%s'", bibfile) 
     with open(bibfile, mode='a+') as bibfp:
         new_id = fetch_doi(doi=doi, bibfile=bibfp, pdf_dir=pdf_dir,
@@ -1,23 +1,33 @@
 import os
+import time
 import logging
 import re
-import io
 import argparse
+import threading
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import pandas as pd
 from html.parser import HTMLParser
 import requests
-import bibtexparser
-import tqdm
-from titlecase import titlecase as titlecase_
 
-from . import exceptions
+# pandas, bibtexparser, tqdm and titlecase are slow to import, so they
+# are imported when first needed instead of here
+from . import exceptions, sessions, daemon
+from .cache import memory_cache, abbreviation_store
+from .ltwa import ltwa_dataframe, ltwa_matcher
+from .config import franklin_config as config
 
 
 log = logging.getLogger(__name__)
 
 
+# Prepare default global configuration values
+config.set_defaults('journals', {
+    # How many journal names to look up at once
+    'workers': '4',
+})
+
+
 local_abbreviations = {
     'journal of small papers': 'J. Sm. Papers',
     'materials today nano': 'Mater. Today Nano',
@@ -57,6 +67,86 @@ local_abbreviations = {
 }
 
 
+class CassiSession():
+    """The state needed to search the CASSI website.
+    
+    CASSI only answers searches that include a validation code from
+    its terms-of-service page, and the cookies that go with it. These
+    are retrieved once and reused for later searches, until CASSI
+    rejects them.
+    
+    """
+    terms_url = 'https://cassi.cas.org/search.jsp'
+    search_url = 'https://cassi.cas.org/searching.jsp'
+    code_re = re.compile('<input type="hidden" name="c" value="([^"]+)"')
+    
+    def __init__(self):
+        self.validation_code = None
+        self.cookies = None
+        self._lock = threading.Lock()
+    
+    def accept_terms(self):
+        """Retrieve a new validation code for having accepted the terms of service."""
+        cookies = {'UserAccepted': 'YES'}
+        response = sessions.get(self.terms_url, cookies=cookies)
+        content = str(response.content)
+        if 'You have to enable JavaScript' in content:
+            raise exceptions.CassiTermsError("Could not accept CASSI terms.")
+        # Extract the validation code from the response
+        match = self.code_re.search(content)
+        if match is None:
+            raise exceptions.CassiTermsError("Could not extract CASSI terms validation code.")
+        log.debug("Accepted CASSI terms of service")
+        cookies.update(response.cookies.get_dict())
+        self.validation_code = match.group(1)
+        self.cookies = cookies
+    
+    def _credentials(self, expired=None):
+        with self._lock:
+            if self.validation_code is None or self.validation_code == expired:
+                self.accept_terms()
+            return self.validation_code, self.cookies
+    
+    def is_rejected(self, response):
+        """Whether CASSI sent back its terms of service instead of search results."""
+        if response.status_code in (401, 403):
+            return True
+        if response.url.split('?')[0] == self.terms_url:
+            return True
+        return 'You have to enable JavaScript' in response.text
+    
+    def search(self, data):
+        """Submit a search to CASSI.
+        
+        The validation code is only retrieved again if CASSI rejects
+        the one already held.
+        
+        Parameters
+        ==========
+        data : dict
+          The search form's fields, except for the validation code.
+        
+        Returns
+        =======
+        response : requests.Response
+          CASSI's answer to the search.
+        
+        """
+        code = None
+        for attempt in range(2):
+            code, cookies = self._credentials(expired=code)
+            response = sessions.post(self.search_url, data={**data, 'c': code},
+                                     cookies=cookies)
+            if not self.is_rejected(response):
+                return response
+            log.debug("CASSI rejected validation code, accepting terms again")
+        raise exceptions.CassiTermsError("CASSI rejected the search for '{}'".format(data.get('searchFor')))
+
+
+# Shared so the validation code is reused between lookups
+cassi_session = CassiSession()
+
+
 class CassiAbbreviation():
     span_re = re.compile('<span style="background-color:#7FFFD4">([^<]*)</span>')
     whitespace_re = re.compile(r'\s+')
@@ -113,6 +203,9 @@ class CassiAbbreviation():
                 self._current_journal = None
                 self._current_coden = None
     
+    def __init__(self, session=None):
+        self.session = session if session is not None else cassi_session
+    
     def parse_multiple_sources(self, html_response, journal):
         log.debug("Parsing CASSI response for mutliple results.")
         # Sort through the HTML
@@ -143,30 +236,33 @@ class CassiAbbreviation():
             raise exceptions.CassiError("Could not parse single hit for '{journal}'".format(journal=journal))
         return abbr
     
-    @lru_cache()
     def __getitem__(self, journal):
         """Retrieve abbreviated journal name from CASSI."""
-        # Ask for a validation code for having accepted the terms of service
-        cookies = {'UserAccepted': 'YES'}
-        response = requests.get('https://cassi.cas.org/search.jsp', cookies=cookies)
-        content = str(response.content)
-        if 'You have to enable JavaScript' in content:
-            raise exceptions.CASSIError("Could not accept CASSI terms.")
-        # Extract the validation code from the response
-        r_str = '<input type="hidden" name="c" value="([^"]+)"'
-        match = re.search(r_str, content)
-        if match:
-            c_code = match.group(1)
-        else:
-            raise exceptions.CASSIError("Could not extract CASSI terms validation code.")
-        # Perform the actual search
+        key = ('cassi', journal)
+        abbr = memory_cache.get(key)
+        if abbr is None:
+            # Raises KeyError if CASSI recently had nothing for this journal
+            abbr = abbreviation_store.get('cassi', journal)
+            if abbr is None:
+                try:
+                    abbr = self.search(journal)
+                except exceptions.CassiTermsError:
+                    # Not a problem with this journal, so try again next time
+                    raise
+                except (KeyError, exceptions.CassiError) as e:
+                    abbreviation_store.put_negative('cassi', journal, error=e)
+                    raise
+                abbreviation_store.put('cassi', journal, abbr)
+            memory_cache.put(key, abbr)
+        return abbr
+    
+    def search(self, journal):
+        """Look up the abbreviated journal name on the CASSI website."""
         post_data = {'searchIn': 'titles',
-                     'searchFor': journal,
-                     'c': c_code}
+                     'searchFor': journal}
         if '&' not in journal:
             post_data['exactMatch'] = 'on'
-        response = requests.post('https://cassi.cas.org/searching.jsp',
-                                 data=post_data)
+        response = self.session.search(post_data)
         # Strip out the background highlighting and extra whitespace
         response_text = self.span_re.sub(r'\1', response.text)
         response_text = self.whitespace_re.sub(r' ', response_text)
@@ -180,15 +276,17 @@ class CassiAbbreviation():
 
 
 @lru_cache()
-def abbreviate_journal(journal, use_native, use_cassi, use_ltwa):
+def abbreviate_journal(journal, use_native, use_cassi, use_ltwa, offline=None):
+    if offline is None:
+        offline = config['ltwa'].getboolean('offline')
     # Build a list of which databases to query
     abbr_dbs = []
     if use_native:
         abbr_dbs.append(local_abbreviations)
-    if use_cassi:
-        abbr_dbs.append(CassiAbbreviation())
+    if use_cassi and not offline:
+        abbr_dbs.append(cassi)
     if use_ltwa:
-        abbr_dbs.append(LTWAAbbreviation())
+        abbr_dbs.append(ltwa_offline if offline else ltwa)
     # Clean up the journal title a little
     journal = journal.strip()
     if journal.lower()[0:3] == 'the':
@@ -201,7 +299,8 @@ def abbreviate_journal(journal, use_native, use_cassi, use_ltwa):
             new_journal = abbrs[journal.lower()]
         except KeyError:
             continue
-        except (exceptions.CassiError, requests.exceptions.ConnectionError) as e:
+        except (exceptions.CassiError, exceptions.LTWANotAvailable,
+                requests.exceptions.ConnectionError) as e:
             log.warning(e)
         else:
             break
@@ -214,9 +313,14 @@ def abbreviate_journal(journal, use_native, use_cassi, use_ltwa):
 def abbreviate_bibtex_journals(bibfile: str, output: str=None,
                                latex_aux_files=[], fix_titlecase=True,
                                use_native=True, use_cassi=True,
-                               use_ltwa=True, skip_bibtex_fields=[]):
+                               use_ltwa=True, skip_bibtex_fields=[], workers=1,
+                               offline=None):
     """Parse a bibtex file and abbreviate journal titles.
     
+    Each distinct journal name is first looked up, with up to
+    *workers* lookups running at once. The abbreviations are then
+    applied to the entries.
+    
     Parameters
     ==========
     bibfile
@@ -238,8 +342,16 @@ def abbreviate_bibtex_journals(bibfile: str, output: str=None,
       Use the ISSN list of title word abbreviations (LTWA).
     skip_bibtex_fields
       These fields will not be included in the output file.
+    workers
+      How many journal names to look up concurrently.
+    offline
+      Don't use the network: skip CASSI, and only use a local
+      snapshot of the LTWA. If ``None``, the ``[ltwa]`` section of the
+      config file decides.
 
     """
+    import bibtexparser
+    import tqdm
     olddb = bibtexparser.load(bibfile)
     newdb = bibtexparser.bibdatabase.BibDatabase()
     # Parse the LaTeX .aux files
@@ -256,13 +368,23 @@ def abbreviate_bibtex_journals(bibfile: str, output: str=None,
         old_entries = [e for e in olddb.entries if e['ID'] in aux_refs]
     else:
         old_entries = olddb.entries
-    for entry in tqdm.tqdm(old_entries):
-        # Fix any entries with double curly braces
+    # Fix any entries with double curly braces
+    for entry in old_entries:
         fix_curly_braces(entry)
+    # Look up each journal once, concurrently
+    journal_names = {entry['journal'] for entry in old_entries if 'journal' in entry.keys()}
+    abbreviations = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(abbreviate_journal, journal, use_native=use_native,
+                                   use_cassi=use_cassi, use_ltwa=use_ltwa,
+                                   offline=offline): journal
+                   for journal in journal_names}
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures), desc="Journals"):
+            abbreviations[futures[future]] = future.result()
+    for entry in tqdm.tqdm(old_entries, desc="Entries"):
         # Abbreviate journal titles
         if 'journal' in entry.keys():
-            entry['journal'] = abbreviate_journal(entry['journal'], use_native=use_native,
-                                                  use_cassi=use_cassi, use_ltwa=use_ltwa)
+            entry['journal'] = abbreviations[entry['journal']]
         # Fix the title-case of the journal title
         title_keys = ['title', 'booktitle']
         if fix_titlecase:
@@ -281,7 +403,7 @@ def abbreviate_bibtex_journals(bibfile: str, output: str=None,
 def abbreviate_journals_cli(argv=None):
     # Parse the arguments
     parser = argparse.ArgumentParser(description='Abbreviate journal titles in a Bibtex file.')
-    parser.add_argument('bibfile', help='bibtex input file')
+    parser.add_argument('bibfile', nargs='?', help='bibtex input file')
     parser.add_argument('-o', '--output', help='bibtex output file')
     parser.add_argument('-L', '--latex-aux-file', action='append', help="LaTex .aux file. Only citations found in this file will be output.", dest="latex_aux_files", metavar="FILE")
     parser.add_argument('-d', '--debug', action='store_true', help='Very verbose logging output')
@@ -298,7 +420,20 @@ def abbreviate_journals_cli(argv=None):
                         help='Do not query the CASSI database.')
     parser.add_argument('-l', '--no-ltwa', dest='use_ltwa', action='store_false',
                         help='Do not abbreviate by LTWA.')
+    parser.add_argument('--offline', action='store_true', default=None,
+                        help='Do not use the network: skip CASSI and only use the saved LTWA snapshot.')
+    parser.add_argument('-j', '--jobs', dest='workers', type=int, default=None,
+                        help='How many journal names to look up concurrently.')
     parser.add_argument('--logfile', help='file to receive the debug log')
+    parser.add_argument('--no-daemon', dest='use_daemon', action='store_false',
+                        help='Do the work in this process, even if franklind is running.')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='Summarize the saved journal abbreviations and exit.')
+    parser.add_argument('--show-cache', action='store_true',
+                        help='List the saved journal abbreviations and exit.')
+    parser.add_argument('--prune-cache', nargs='?', const='expired',
+                        choices=['expired', 'missing', 'all'],
+                        help='Remove "expired" (default), "missing" or "all" saved journal abbreviations and exit.')
     args = parser.parse_args(argv)
     # Prepare logging
     if args.debug:
@@ -310,6 +445,65 @@ def abbreviate_journals_cli(argv=None):
     else:
         loglevel = logging.WARNING
     logging.basicConfig(filename=args.logfile, level=loglevel)
+    config.read()
+    # Inspect the saved abbreviations instead of abbreviating
+    if args.cache_stats or args.show_cache or args.prune_cache is not None:
+        return manage_abbreviation_cache(stats=args.cache_stats, show=args.show_cache,
+                                         prune=args.prune_cache)
+    if args.bibfile is None:
+        parser.error("the following arguments are required: bibfile")
+    # Let franklind do the work if it's running
+    if args.use_daemon and config['daemon'].getboolean('enabled'):
+        remote_args = daemon.prepare_args(args, paths=['bibfile', 'output', 'latex_aux_files'])
+        try:
+            return daemon.submit('abbreviate-journals', remote_args)
+        except exceptions.DaemonUnavailable as e:
+            log.debug("Not using franklind: %s", e)
+    return run_abbreviate_journals(args)
+
+
+def manage_abbreviation_cache(stats=False, show=False, prune=None):
+    """Report on, or remove, saved journal abbreviations.
+    
+    Parameters
+    ==========
+    stats
+      Print how many abbreviations are saved from each source.
+    show
+      Print every saved abbreviation.
+    prune
+      Remove these saved abbreviations first: "expired", "missing"
+      (failed lookups) or "all". See
+      :py:meth:`~franklin.cache.AbbreviationStore.prune`.
+    
+    """
+    if prune is not None:
+        count = abbreviation_store.prune(prune)
+        print("Removed {} {} entries from {}".format(count, prune, abbreviation_store.path))
+    if show:
+        now = time.time()
+        for source, title, abbr, error, timestamp in abbreviation_store.entries():
+            if abbr is None:
+                abbr = "(not found: {})".format(error)
+            age = (now - timestamp) / (24 * 60 * 60)
+            print("{}\t{}\t{}\t{:.0f} days old".format(source, title, abbr, age))
+    if stats:
+        print("Saved abbreviations in {}".format(abbreviation_store.path))
+        counts = abbreviation_store.stats()
+        for source, count in counts.items():
+            print("{source}: {found} found, {missing} missing, {expired} expired".format(
+                source=source, **count))
+        if not counts:
+            print("No saved abbreviations")
+    return 0
+
+
+def run_abbreviate_journals(args):
+    """Abbreviate journals as requested by parsed command line arguments.
+    
+    Used by ``abbreviate-journals`` and by ``franklind``.
+    
+    """
     # Get a default output filename if necessary
     output = args.output
     if output is None:
@@ -324,6 +518,7 @@ def abbreviate_journals_cli(argv=None):
     latex_aux_files = [open(fp, mode='r') for fp in latex_aux_files]
     # Call the actual function
     skip_fields = args.skip_fields if args.skip_fields is not None else []
+    workers = args.workers if args.workers is not None else config['journals'].getint('workers')
     with open(args.bibfile, mode='r') as bibfile, open(output, mode='w') as output:
         try:
             abbreviate_bibtex_journals(bibfile=bibfile, output=output,
@@ -332,22 +527,34 @@ def abbreviate_journals_cli(argv=None):
                                        use_native=args.use_native,
                                        use_cassi=args.use_cassi,
                                        use_ltwa=args.use_ltwa,
-                                       skip_bibtex_fields=skip_fields)
+                                       offline=args.offline,
+                                       skip_bibtex_fields=skip_fields,
+                                       workers=workers)
         except:
             raise
         finally:
             [fp.close() for fp in latex_aux_files]
 
+
 class LTWAAbbreviation():
-    ltwa_url = 'https://www.issn.org/wp-content/uploads/2013/09/LTWA_20160915.txt'
+    """Abbreviate journal titles word by word using the LTWA.
+    
+    Parameters
+    ==========
+    offline
+      Only use the local snapshot of the LTWA, never download it (see
+      :py:mod:`franklin.ltwa`). If ``None``, the ``[ltwa]`` section
+      of the config file decides.
+    
+    """
+    def __init__(self, offline=None):
+        self.offline = offline
     
-    @lru_cache()
     def ltwa_list(self):
-        response = requests.get(self.ltwa_url)
-        response.encoding = 'utf-16'
-        fp = io.StringIO(response.text)
-        df = pd.read_csv(fp, delimiter='\t')
-        return df
+        return ltwa_dataframe(offline=self.offline)
+    
+    def matcher(self):
+        return ltwa_matcher(offline=self.offline)
     
     def find_abbrev_in_df(self, word, df):
         lword = word.lower()
@@ -386,14 +593,25 @@ class LTWAAbbreviation():
             abbrev = abbrev[:-1]
         return abbrev
     
-    @lru_cache()
     def __getitem__(self, title):
+        key = ('ltwa', title)
+        new_title = memory_cache.get(key)
+        if new_title is None:
+            new_title = abbreviation_store.get('ltwa', title)
+            if new_title is None:
+                new_title = self.abbreviate(title)
+                abbreviation_store.put('ltwa', title, new_title)
+            memory_cache.put(key, new_title)
+        return new_title
+    
+    def abbreviate(self, title):
+        """Abbreviate each word in *title* using the LTWA list."""
         ignored_words = ['of', 'the', 'a', '&', 'and']
-        df = self.ltwa_list()
+        matcher = self.matcher()
         abbreviations = []
         for word in title.split():
             if word not in ignored_words:
-                abbreviations.append(self.find_abbrev_in_df(word, df))
+                abbreviations.append(matcher.abbreviate(word))
         # Convert the list of matched abbreviations/words to a new journal title
         new_title = ' '.join(abbreviations)
         # Convert to title case (except for initialisms)
@@ -405,6 +623,12 @@ class LTWAAbbreviation():
         return new_title
 
 
+# Shared so the LTWA list is only retrieved once per process
+ltwa = LTWAAbbreviation()
+ltwa_offline = LTWAAbbreviation(offline=True)
+cassi = CassiAbbreviation()
+
+
 def _tex_callback(word, **kwargs):
     # only lower case words get fixed
     if not word.islower():
@@ -412,6 +636,7 @@ def _tex_callback(word, **kwargs):
 
 
 def titlecase(title):
+    from titlecase import titlecase as titlecase_
     new_title = title.replace('\n', ' ')
     new_title = titlecase_(new_title, callback=_tex_callback)
     return new_title
@@ -0,0 +1,188 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Coordinating access to shared files between franklin processes.
+
+The locks are advisory: they only keep out other processes that also
+use them. ``fcntl`` is used where available, then ``msvcrt`` (on
+Windows). Otherwise, a lock file is created exclusively and removed
+when the lock is released.
+
+"""
+
+import os
+import time
+import errno
+import logging
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+from .exceptions import FileLockError
+
+
+log = logging.getLogger(__name__)
+
+
+def lock_file(fp, blocking=True):
+    """Place an exclusive lock on an open file.
+
+    Returns
+    =======
+    locked : bool
+      Whether the lock was acquired. Only false if *blocking* is
+      false and another process holds the lock.
+
+    """
+    if fcntl is not None:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(fp.fileno(), flags)
+        except BlockingIOError:
+            return False
+        return True
+    elif msvcrt is not None:  # pragma: no cover
+        mode = msvcrt.LK_NBLCK
+        while True:
+            try:
+                os.lseek(fp.fileno(), 0, os.SEEK_SET)
+                msvcrt.locking(fp.fileno(), mode, 1)
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.05)
+            else:
+                return True
+    return True
+
+
+def unlock_file(fp):
+    """Release a lock placed by :py:func:`lock_file`."""
+    if fcntl is not None:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+    elif msvcrt is not None:  # pragma: no cover
+        os.lseek(fp.fileno(), 0, os.SEEK_SET)
+        msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FileLock():
+    """An exclusive lock shared between processes, held on *path*.
+
+    Use as a context manager. The lock file itself is left in place
+    (unless neither ``fcntl`` nor ``msvcrt`` is available).
+
+    Parameters
+    ==========
+    path : str
+      The file used for locking.
+    timeout : float
+      Raise :py:class:`~franklin.exceptions.FileLockError` if the lock
+      can't be acquired within this many seconds. If ``None``, wait
+      forever.
+    poll : float
+      How often to check whether the lock is available (seconds).
+    stale_timeout : float
+      Only used when falling back to lock files: a lock file older
+      than this is assumed to have been left behind by a crashed
+      process.
+
+    """
+    def __init__(self, path, timeout=None, poll=0.05, stale_timeout=60):
+        self.path = os.fspath(path)
+        self.timeout = timeout
+        self.poll = poll
+        self.stale_timeout = stale_timeout
+        self._fp = None
+        self._fd = None
+
+    def acquire(self):
+        start = time.monotonic()
+        while not self._try_acquire():
+            if self.timeout is not None and time.monotonic() - start > self.timeout:
+                raise FileLockError("Could not lock {} within {} s".format(self.path, self.timeout))
+            time.sleep(self.poll)
+        log.debug("Acquired lock %s", self.path)
+
+    def _try_acquire(self):
+        if fcntl is not None or msvcrt is not None:
+            fp = open(self.path, mode='a+b')
+            if lock_file(fp, blocking=False):
+                self._fp = fp
+                return True
+            fp.close()
+            return False
+        # Fall back to exclusively creating the lock file
+        try:
+            self._fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            self._remove_stale()
+            return False
+        return True
+
+    def _remove_stale(self):
+        try:
+            age = time.time() - os.path.getmtime(self.path)
+        except OSError:
+            return
+        if age > self.stale_timeout:
+            log.warning("Removing stale lock file %s", self.path)
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def release(self):
+        if self._fp is not None:
+            unlock_file(self._fp)
+            self._fp.close()
+            self._fp = None
+        elif self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            os.remove(self.path)
+        log.debug("Released lock %s", self.path)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def rename_no_clobber(src, dst):
+    """Atomically rename *src* to *dst*, unless *dst* already exists.
+
+    Raises ``FileExistsError`` instead of replacing *dst*.
+
+    """
+    try:
+        os.link(src, dst)
+    except (AttributeError, NotImplementedError, PermissionError):
+        # Hard links aren't supported here, but on Windows rename
+        # already refuses to replace an existing file
+        if os.path.exists(dst):
+            raise FileExistsError(errno.EEXIST, "File exists", dst)
+        os.rename(src, dst)
+    else:
+        os.remove(src)
@@ -0,0 +1,475 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""A local snapshot of the ISSN list of title word abbreviations (LTWA).
+
+The LTWA is published as a large UTF-16 text file. Rather than
+downloading and parsing it every time franklin starts, it is parsed
+once and saved as a snapshot (``ltwa.json`` in the cache
+directory), which loads in a few milliseconds. The snapshot is only
+checked against issn.org when ``update-ltwa`` is run.
+
+In offline mode, the LTWA is never downloaded, so a snapshot must
+already exist::
+
+  [ltwa]
+  offline = yes
+
+"""
+
+import io
+import os
+import re
+import sys
+import time
+import json
+import logging
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+
+from .config import franklin_config as config
+from .version import __version__
+from . import exceptions, sessions, cache
+
+
+log = logging.getLogger(__name__)
+
+
+# Prepare default global configuration values
+config.set_defaults('ltwa', {
+    'url': 'https://www.issn.org/wp-content/uploads/2013/09/LTWA_20160915.txt',
+    # Where to keep the snapshot (blank to use the cache directory)
+    'snapshot': '',
+    # Never download the LTWA, only use the snapshot
+    'offline': 'no',
+})
+
+
+# Increase this when the layout of the snapshot changes
+snapshot_format = 2
+columns = ['WORD', 'ABBREVIATIONS', 'LANGUAGE CODES']
+
+
+def snapshot_path():
+    """Where the LTWA snapshot is kept."""
+    path = config['ltwa'].get('snapshot', '').strip()
+    if not path:
+        path = Path(config['cache']['directory']).expanduser() / 'ltwa.json'
+    return Path(path).expanduser()
+
+
+def parse_ltwa(text):
+    """Parse the tab-separated text of the LTWA.
+
+    Returns
+    =======
+    table : dict
+      Maps each of *columns* to a list of values, with ``None`` for
+      missing values.
+
+    """
+    import pandas as pd
+    df = pd.read_csv(io.StringIO(text), delimiter='\t')
+    table = {}
+    for name in columns:
+        values = [None if pd.isna(value) else str(value) for value in df[name]]
+        # Many values (e.g. language codes) repeat, so share them to save space
+        shared = {}
+        table[name] = [shared.setdefault(value, value) for value in values]
+    return table
+
+
+def load_snapshot(path=None):
+    """Load a saved LTWA snapshot.
+
+    Returns
+    =======
+    snapshot : dict
+      The snapshot, or ``None`` if it is missing, unreadable, or was
+      saved by an incompatible version of franklin.
+
+    """
+    path = Path(path) if path is not None else snapshot_path()
+    try:
+        with open(path, mode='r', encoding='utf-8') as fp:
+            snapshot = json.load(fp)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        # ValueError includes bad JSON and bad UTF-8
+        log.warning("Could not read LTWA snapshot %s: %s", path, e)
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('format') != snapshot_format:
+        log.info("Ignoring LTWA snapshot %s from another version of franklin", path)
+        return None
+    return snapshot
+
+
+def save_snapshot(snapshot, path=None):
+    path = Path(path) if path is not None else snapshot_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    with os.fdopen(fd, mode='w', encoding='utf-8') as fp:
+        json.dump(snapshot, fp, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    log.info("Saved LTWA snapshot to %s", path)
+
+
+def make_snapshot(text, source, etag=None, last_modified=None):
+    """Build a snapshot from the text of the LTWA."""
+    return {
+        'format': snapshot_format,
+        'source': source,
+        'etag': etag,
+        'last_modified': last_modified,
+        'retrieved': time.time(),
+        'table': parse_ltwa(text),
+    }
+
+
+def download_snapshot(previous=None):
+    """Download the LTWA and build a snapshot from it.
+
+    Parameters
+    ==========
+    previous : dict
+      An existing snapshot. If the LTWA has not changed since it was
+      retrieved, it is not downloaded again.
+
+    Returns
+    =======
+    snapshot : dict
+      The new snapshot, or ``None`` if *previous* is still up to date.
+
+    """
+    url = config['ltwa']['url']
+    headers = {}
+    if previous is not None and previous.get('source') == url:
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+    log.info("Downloading LTWA from %s", url)
+    response = sessions.get(url, headers=headers)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    response.encoding = 'utf-16'
+    return make_snapshot(response.text, source=url,
+                         etag=response.headers.get('ETag'),
+                         last_modified=response.headers.get('Last-Modified'))
+
+
+# Characters with a special meaning in the LTWA patterns, which are
+# used as regular expressions
+_special_characters = set('.^$*+?{}[]\\|()')
+_quantifiers = set('*+?{')
+
+
+def _literal_prefix(pattern):
+    """The text that anything matched by regular expression *pattern* starts with."""
+    if '|' in pattern:
+        return ''
+    for idx, char in enumerate(pattern):
+        if char in _special_characters:
+            if char in _quantifiers:
+                # The previous character is optional or repeated
+                idx = max(idx - 1, 0)
+            return pattern[:idx]
+    return pattern
+
+
+def _literal_suffix(pattern):
+    """The text that anything matched by regular expression *pattern* ends with."""
+    if '|' in pattern:
+        return ''
+    for idx in range(len(pattern) - 1, -1, -1):
+        if pattern[idx] in _special_characters:
+            suffix = pattern[idx + 1:]
+            if pattern[idx] == '\\':
+                # The first character is part of an escape sequence
+                suffix = suffix[1:]
+            return suffix
+    return pattern
+
+
+class LTWAMatcher():
+    """Look up the LTWA abbreviation for a word without scanning the whole list.
+
+    Each LTWA word is a pattern, where "-" stands for any other
+    letters (e.g. "journal-" matches "journalism"). Rather than trying
+    every pattern against each word, the patterns are indexed by the
+    literal text they begin with (or end with, for patterns like
+    "-ology"), so only those starting with one of the word's prefixes
+    or ending with one of its suffixes are tried. Looking up a word
+    takes a few dictionary lookups per letter.
+
+    The results are the same as
+    :py:meth:`franklin.journals.LTWAAbbreviation.find_abbrev_in_df`:
+    the first exact match wins, otherwise the last matching pattern in
+    the list.
+
+    Parameters
+    ==========
+    table : dict
+      The LTWA, as from :py:func:`ltwa_table`.
+
+    """
+    def __init__(self, table):
+        self.words = table['WORD']
+        self.abbreviations = table['ABBREVIATIONS']
+        self.exact = {}
+        self.patterns = []
+        self.prefixes = {}
+        self.suffixes = {}
+        self._regexes = {}
+        for row, word in enumerate(self.words):
+            if word is None:
+                # A missing word is formatted as "nan" in the DataFrame version
+                pattern = 'nan'
+            else:
+                self.exact.setdefault(word, row)
+                pattern = word.replace('-', '(.*)')
+            self.patterns.append(pattern)
+            prefix = _literal_prefix(pattern)
+            suffix = _literal_suffix(pattern) if not prefix else ''
+            if suffix:
+                self.suffixes.setdefault(suffix, []).append(row)
+            else:
+                self.prefixes.setdefault(prefix, []).append(row)
+
+    def _regex(self, row):
+        regex = self._regexes.get(row)
+        if regex is None:
+            regex = re.compile(f"^{self.patterns[row]}s?$")
+            self._regexes[row] = regex
+        return regex
+
+    def search(self, lword):
+        """The row of the last pattern matching *lword*, or ``None``."""
+        candidates = []
+        for end in range(len(lword) + 1):
+            candidates.extend(self.prefixes.get(lword[:end], ()))
+        # Patterns also match the plural of the word
+        stems = [lword, lword[:-1]] if lword.endswith('s') else [lword]
+        for stem in stems:
+            for start in range(len(stem)):
+                candidates.extend(self.suffixes.get(stem[start:], ()))
+        found = None
+        for row in sorted(candidates, reverse=True):
+            if self._regex(row).match(lword):
+                found = row
+                break
+        return found
+
+    def substitute(self, row, lword):
+        """Fill in the parts of *lword* matched by wildcards in the abbreviation."""
+        pattern, abbrev = self.words[row], self.abbreviations[row]
+        if '-' in abbrev:
+            idx = 1
+            while '-' in abbrev:
+                abbrev = abbrev.replace('-', f"\\{idx}", 1)
+                idx += 1
+            pattern = pattern.replace('-', '(.*)')
+            abbrev = re.sub(pattern, abbrev, lword)
+        return abbrev
+
+    def abbreviate(self, word):
+        """The abbreviation of *word*, or *word* itself if the LTWA has none."""
+        lword = word.lower()
+        row = self.exact.get(lword)
+        if row is not None:
+            abbrev = self.abbreviations[row]
+        else:
+            row = self.search(lword)
+            if row is None:
+                abbrev = word
+            else:
+                abbrev = self.substitute(row, lword)
+        # Deal with stray ".s" coming from pluralization
+        if abbrev == "n.a.":
+            abbrev = lword
+        if abbrev[-2:] == '.s':
+            abbrev = abbrev[:-1]
+        return abbrev
+
+
+_table = None
+_dataframe = None
+_matcher = None
+_lock = threading.Lock()
+
+
+def ltwa_table(offline=None):
+    """The LTWA, as a dictionary of column lists (see :py:func:`parse_ltwa`).
+
+    The snapshot is used if there is one. Otherwise the LTWA is
+    downloaded and a snapshot saved for next time, unless in offline
+    mode.
+
+    Parameters
+    ==========
+    offline : bool
+      Never download the LTWA. If ``None``, the ``offline`` option in
+      the ``[ltwa]`` section of the config file is used.
+
+    Raises
+    ======
+    LTWANotAvailable
+      There is no snapshot, and the LTWA cannot be downloaded.
+
+    """
+    global _table
+    if offline is None:
+        offline = config['ltwa'].getboolean('offline')
+    with _lock:
+        if _table is None:
+            snapshot = load_snapshot()
+            if snapshot is None:
+                if offline:
+                    raise exceptions.LTWANotAvailable(
+                        "No LTWA snapshot at {}; run ``update-ltwa`` first".format(snapshot_path()))
+                snapshot = download_snapshot()
+                try:
+                    save_snapshot(snapshot)
+                except OSError as e:
+                    log.warning("Could not save LTWA snapshot: %s", e)
+                forget_abbreviations()
+            _table = snapshot['table']
+        return _table
+
+
+def ltwa_dataframe(offline=None):
+    """The LTWA as a pandas DataFrame, with the LTWA's own column names."""
+    global _dataframe
+    table = ltwa_table(offline=offline)
+    with _lock:
+        if _dataframe is None:
+            _dataframe = make_dataframe(table)
+        return _dataframe
+
+
+def make_dataframe(table):
+    import numpy as np
+    import pandas as pd
+    df = pd.DataFrame({name: table[name] for name in columns})
+    return df.where(df.notna(), np.nan)
+
+
+def ltwa_matcher(offline=None):
+    """An indexed :py:class:`LTWAMatcher` for the LTWA."""
+    global _matcher
+    table = ltwa_table(offline=offline)
+    with _lock:
+        if _matcher is None:
+            _matcher = LTWAMatcher(table)
+        return _matcher
+
+
+def forget_abbreviations():
+    """Forget journal titles abbreviated with an earlier copy of the LTWA."""
+    count = cache.abbreviation_store.prune('all', source='ltwa')
+    cache.memory_cache.discard('ltwa')
+    journals = sys.modules.get('franklin.journals')
+    if journals is not None:
+        journals.abbreviate_journal.cache_clear()
+    log.info("Forgot %d saved LTWA abbreviations", count)
+
+
+def clear():
+    """Forget the LTWA loaded into memory, e.g. after a new snapshot is made."""
+    global _table, _dataframe, _matcher
+    with _lock:
+        _table = None
+        _dataframe = None
+        _matcher = None
+
+
+def update_ltwa(source=None, force=False, path=None):
+    """Create or refresh the LTWA snapshot.
+
+    Parameters
+    ==========
+    source : str
+      A local copy of the LTWA text file to use instead of
+      downloading it.
+    force : bool
+      Download the LTWA even if the snapshot appears up to date.
+    path : str
+      Where to save the snapshot.
+
+    Returns
+    =======
+    updated : bool
+      False if the existing snapshot was already up to date.
+
+    """
+    path = Path(path) if path is not None else snapshot_path()
+    if source is not None:
+        with open(source, mode='r', encoding='utf-16') as fp:
+            snapshot = make_snapshot(fp.read(), source=os.path.abspath(source))
+    else:
+        previous = None if force else load_snapshot(path)
+        snapshot = download_snapshot(previous=previous)
+        if snapshot is None:
+            log.info("LTWA snapshot %s is up to date", path)
+            return False
+    save_snapshot(snapshot, path)
+    clear()
+    forget_abbreviations()
+    return True
+
+
+def describe_snapshot(snapshot):
+    retrieved = time.strftime('%Y-%m-%d %H:%M', time.localtime(snapshot['retrieved']))
+    return "{} words from {} (retrieved {})".format(
+        len(snapshot['table']['WORD']), snapshot['source'], retrieved)
+
+
+def update_ltwa_cli(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Save a local snapshot of the list of title word abbreviations (LTWA)'
+    )
+    parser.add_argument('--from-file', dest='source', metavar='FILE', default=None,
+                        help='build the snapshot from a downloaded LTWA text file')
+    parser.add_argument('-f', '--force', dest='force', action='store_true',
+                        help="download the LTWA even if the snapshot is up to date")
+    parser.add_argument('--info', dest='info', action='store_true',
+                        help="describe the current snapshot and exit")
+    parser.add_argument('-o', '--output', dest='output', metavar='PATH', default=None,
+                        help='where to save the snapshot')
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                        help="show detailed debug information via the logging platform")
+    parser.add_argument('-V', '--version', action='version', version='%(prog)s v{}'.format(__version__))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+    config.read()
+    path = Path(args.output) if args.output is not None else snapshot_path()
+    if args.info:
+        snapshot = load_snapshot(path)
+        if snapshot is None:
+            print("No LTWA snapshot at {}".format(path))
+            return 1
+        print("{}: {}".format(path, describe_snapshot(snapshot)))
+        return 0
+    if args.source is None and config['ltwa'].getboolean('offline'):
+        parser.error("cannot download the LTWA in offline mode; use --from-file")
+    if update_ltwa(source=args.source, force=args.force, path=path):
+        print("Saved {}: {}".format(path, describe_snapshot(load_snapshot(path))))
+    else:
+        print("LTWA snapshot {} is up to date".format(path))
+    return 0
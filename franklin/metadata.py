@@ -0,0 +1,258 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""A structured record of an article's bibliographic information."""
+
+import json
+import calendar
+
+from .exceptions import DOIError, BibtexParseError, MetadataParseError
+
+
+# Bibtex entry types for each CSL item type
+csl_entry_types = {
+    'article-journal': 'article',
+    'article': 'article',
+    'paper-conference': 'inproceedings',
+    'book': 'book',
+    'chapter': 'inbook',
+    'thesis': 'phdthesis',
+    'report': 'techreport',
+}
+
+
+def _csl_text(value):
+    """Some CSL values are given as lists of strings, so use the first."""
+    if isinstance(value, (list, tuple)):
+        value = value[0] if len(value) > 0 else ''
+    return str(value) if value is not None else ''
+
+
+def _csl_name(name):
+    """Format one CSL name the way bibtex expects (e.g. "Wolfman, Mark")."""
+    if 'family' in name:
+        parts = [name.get('non-dropping-particle', ''), name['family']]
+        family = ' '.join(p for p in parts if p)
+        if name.get('suffix'):
+            family = '{}, {}'.format(family, name['suffix'])
+        given = name.get('given', '')
+        return '{}, {}'.format(family, given) if given else family
+    return name.get('literal', name.get('name', ''))
+
+
+def _csl_date_parts(csl):
+    """Find the (year, month, day) this item was published."""
+    for key in ['issued', 'published-print', 'published-online', 'created']:
+        try:
+            parts = csl[key]['date-parts'][0]
+        except (KeyError, IndexError, TypeError):
+            continue
+        if parts and parts[0] is not None:
+            return parts
+    return []
+
+
+class ArticleMetadata():
+    """Bibliographic information about one article.
+
+    The commonly used fields are available as attributes, and any
+    other bibtex fields (volume, pages, etc.) are kept in ``fields``
+    so that the record can be converted back to bibtex without losing
+    anything.
+
+    Attributes
+    ==========
+    doi : str
+      The digital object identifier.
+    authors : list
+      Author names, in order, as they appear in bibtex
+      (e.g. "Wolfman, Mark" or "Mark Wolfman").
+    year : str
+      Year of publication.
+    journal : str
+      Name of the journal, if any.
+    publisher : str
+      Name of the publisher, as it appears in bibtex.
+    title : str
+      Title of the article.
+    entry_type : str
+      The bibtex entry type (e.g. "article").
+    fields : dict
+      All other bibtex fields.
+
+    """
+    __slots__ = ('doi', 'authors', 'year', 'journal', 'publisher', 'title',
+                 'entry_type', 'fields')
+    # Bibtex fields that are held as attributes
+    _bibtex_attrs = {
+        'doi': 'doi',
+        'year': 'year',
+        'journal': 'journal',
+        'publisher': 'publisher',
+        'title': 'title',
+    }
+
+    def __init__(self, doi='', authors=(), year='', journal='', publisher='',
+                 title='', entry_type='article', fields=None):
+        self.doi = doi
+        self.authors = list(authors)
+        self.year = year
+        self.journal = journal
+        self.publisher = publisher
+        self.title = title
+        self.entry_type = entry_type
+        self.fields = dict(fields) if fields is not None else {}
+
+    def __repr__(self):
+        return "<ArticleMetadata: {} ({})>".format(self.doi, self.year)
+
+    def __eq__(self, other):
+        if not isinstance(other, ArticleMetadata):
+            return NotImplemented
+        return all(getattr(self, attr) == getattr(other, attr) for attr in self.__slots__)
+
+    @classmethod
+    def from_entry(cls, entry):
+        """Create a record from a bibtexparser entry dictionary."""
+        entry = dict(entry)
+        entry.pop('ID', None)
+        entry_type = entry.pop('ENTRYTYPE', 'article')
+        author = entry.pop('author', '')
+        authors = author.split(' and ') if author else []
+        attrs = {attr: entry.pop(field, '') for field, attr in cls._bibtex_attrs.items()}
+        return cls(authors=authors, entry_type=entry_type, fields=entry, **attrs)
+
+    @classmethod
+    def from_bibtex(cls, bibtex, doi=''):
+        """Parse a bibtex string holding a single entry.
+
+        Parameters
+        ==========
+        bibtex : str
+          The bibtex to parse.
+        doi : str
+          The DOI this bibtex was retrieved for, used in error
+          messages.
+
+        """
+        import bibtexparser
+        try:
+            bibdb = bibtexparser.loads(bibtex)
+        except Exception:
+            msg = "Could not parse bibtex entry: '{}'".format(bibtex)
+            raise BibtexParseError(msg) from None
+        if len(bibdb.entries) != 1:
+            msg = "Found {} bibtex entries for DOI: '{}'".format(len(bibdb.entries), doi)
+            raise DOIError(msg)
+        return cls.from_entry(bibdb.entries[0])
+
+    @classmethod
+    def from_csl(cls, csl):
+        """Create a record from a CSL-JSON item (as a dictionary).
+
+        Fields are named and formatted the same way as in the bibtex
+        provided by the DOI server, so that records created either way
+        can be used interchangeably.
+
+        """
+        entry_type = csl_entry_types.get(csl.get('type'), 'misc')
+        authors = [_csl_name(name) for name in csl.get('author', [])]
+        date_parts = _csl_date_parts(csl)
+        fields = {}
+        # Which field holds the name of the journal, proceedings, etc.
+        container = _csl_text(csl.get('container-title', ''))
+        if container and entry_type == 'article':
+            journal = container
+        else:
+            journal = ''
+            if container and entry_type in ('inproceedings', 'inbook'):
+                fields['booktitle'] = container
+        if len(date_parts) > 1 and date_parts[1]:
+            fields['month'] = calendar.month_name[int(date_parts[1])]
+        simple_fields = [('URL', 'url'), ('volume', 'volume'),
+                         ('issue', 'number'), ('ISBN', 'isbn')]
+        for csl_key, field in simple_fields:
+            value = _csl_text(csl.get(csl_key, ''))
+            if value:
+                fields[field] = value
+        page = _csl_text(csl.get('page', ''))
+        if page:
+            fields['pages'] = page.replace('-', '\u2013', 1)
+        issn = csl.get('ISSN', [])
+        if issn:
+            fields['issn'] = ', '.join(issn) if isinstance(issn, list) else issn
+        return cls(doi=_csl_text(csl.get('DOI', '')),
+                   authors=authors,
+                   year=str(date_parts[0]) if date_parts else '',
+                   journal=journal,
+                   publisher=_csl_text(csl.get('publisher', '')),
+                   title=_csl_text(csl.get('title', '')),
+                   entry_type=entry_type,
+                   fields=fields)
+
+    @classmethod
+    def from_csl_json(cls, text, doi=''):
+        """Parse a CSL-JSON string holding a single item.
+
+        Parameters
+        ==========
+        text : str
+          The CSL-JSON to parse.
+        doi : str
+          The DOI this CSL-JSON was retrieved for, used in error
+          messages.
+
+        """
+        try:
+            csl = json.loads(text)
+        except ValueError:
+            msg = "Could not parse CSL-JSON for DOI '{}': '{}'".format(doi, text)
+            raise MetadataParseError(msg) from None
+        if isinstance(csl, list):
+            if len(csl) != 1:
+                msg = "Found {} CSL-JSON items for DOI: '{}'".format(len(csl), doi)
+                raise DOIError(msg)
+            csl = csl[0]
+        if not isinstance(csl, dict):
+            msg = "Could not parse CSL-JSON for DOI '{}': '{}'".format(doi, text)
+            raise MetadataParseError(msg)
+        return cls.from_csl(csl)
+
+    def as_dict(self):
+        """Convert to a bibtexparser entry dictionary (without an ID)."""
+        entry = {'ENTRYTYPE': self.entry_type}
+        if self.authors:
+            entry['author'] = ' and '.join(self.authors)
+        for field, attr in self._bibtex_attrs.items():
+            value = getattr(self, attr)
+            if value:
+                entry[field] = value
+        entry.update(self.fields)
+        return entry
+
+    def to_bibtex(self, id):
+        """Prepare a bibtex entry with the given *id*."""
+        entry = self.as_dict()
+        import bibtexparser
+        entry['ID'] = id
+        db = bibtexparser.bibdatabase.BibDatabase()
+        db.entries = [entry]
+        return bibtexparser.dumps(db)
+
+    def default_id(self):
+        """Prepare a default ID suitable for bibtex (e.g. "cabana2017")."""
+        lead_author = self.authors[-1]
+        last_name = lead_author.split(',')[0].lower()
+        return '{last_name}{year}'.format(last_name=last_name, year=self.year)
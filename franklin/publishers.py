@@ -14,65 +14,310 @@
 # along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
 
 
-import requests
 import re
 import os
+import io
+import logging
 
 import configparser
 
-from .exceptions import PDFNotFoundError, UnknownPublisherError, ConfigError
+from .exceptions import (PDFNotFoundError, UnknownPublisherError, ConfigError,
+                         InvalidPDFError, TruncatedPDFError, PDFTooLargeError,
+                         PDFResumeError)
 from .config import franklin_config as config
+from . import sessions
 from . import __version__
 
 
+log = logging.getLogger(__name__)
+
+
 default_headers = {
     'User-Agent': 'franklin/{} (https://github.com/canismarko/franklin)'.format(__version__),
 }
 
 
+# How much of a PDF to download at a time (bytes)
+chunk_size = 64 * 1024
+pdf_magic = b'%PDF-'
+# How much of a file to search for the closing "%%EOF" marker (bytes)
+trailer_size = 1024
+# How much of a non-PDF response to decode when looking for the reason (bytes)
+diagnosis_size = 4096
+
+
 # Prepare default global configuration values
-config['Elsevier'] = {
+config.set_defaults('Elsevier', {
     'api_key': '',
-}
+})
+config.set_defaults('pdf', {
+    # Reject PDFs that don't end with "%%EOF" as incomplete
+    'check_trailer': 'yes',
+})
 
 
 def get_publisher(publisher):
-    _pub_dict = {
-        'American Chemical Society ({ACS})': american_chemical_society,
-        'American Chemical Society (ACS)': american_chemical_society,
-        'The Electrochemical Society': iop,
-        '{IOP}': iop,
-        'Elsevier {BV}': elsevier,
-        'Springer Science and Business Media {LLC}': springer,
-        'Royal Society of Chemistry ({RSC})': royal_society_of_chemistry,
-        'Wiley': wiley,
-        'Annual Reviews': annual_reviews,
-        'Institute of Electrical and Electronics Engineers ({IEEE})': ieee,
-        'American Association for the Advancement of Science ({AAAS})': aaas,
-    }
+    """Find the function that retrieves PDFs from the named publisher."""
     try:
-        pub_func = _pub_dict[publisher]
+        pub_func = publisher_names[publisher]
     except KeyError:
         msg = '"{}" (hint: use `--no-pdf` to skip PDF retrieval)'.format(publisher)
         raise UnknownPublisherError(msg) from None
     return pub_func
 
 
-def american_chemical_society(doi, *args, **kwargs):
+def get_publisher_by_doi(doi):
+    """Find the function that retrieves PDFs for this DOI.
+    
+    The publisher is determined from the DOI's registrant prefix
+    (e.g. "10.1021" for ACS) so no metadata need to be retrieved.
+    
+    """
+    prefix = doi.split('/', 1)[0]
+    try:
+        pub_func = doi_prefixes[prefix]
+    except KeyError:
+        raise UnknownPublisherError('No publisher for DOI prefix "{}"'.format(prefix)) from None
+    return pub_func
+
+
+def is_pdf(head):
+    """Check whether *head*, the first bytes of a file, looks like a PDF."""
+    return head.startswith(pdf_magic)
+
+
+def has_pdf_trailer(tail):
+    """Check whether *tail*, the last bytes of a file, ends a PDF.
+    
+    A complete PDF ends with an ``%%EOF`` marker, possibly followed by
+    some whitespace, so a missing marker usually means the download
+    was cut short.
+    
+    """
+    return b'%%EOF' in tail[-trailer_size:]
+
+
+def diagnose_response(head, doi):
+    """Explain why a publisher's response was not a PDF.
+    
+    Only the first ``diagnosis_size`` bytes of *head* are decoded, so
+    this stays cheap even for large responses.
+    
+    Returns
+    =======
+    msg : str
+      A message suitable for an exception.
+    
+    """
+    text = head[:diagnosis_size].decode('utf-8', errors='replace')
+    hint = "(hint: use `--no-pdf` to skip PDF retrieval)"
+    if "you are a bot" in text or "captcha" in text.lower():
+        return "Captcha detected while retrieving PDF for {}. {}".format(doi, hint)
+    elif "Missing resource" in text:
+        return "Publisher has no PDF for {}. {}".format(doi, hint)
+    else:
+        return "No PDF for {}. {}".format(doi, hint)
+
+
+def validate_pdf(data, doi='', check_trailer=False):
+    """Make sure that *data* holds a PDF file.
+    
+    Only the leading (and optionally trailing) bytes are inspected.
+    
+    Raises
+    ======
+    InvalidPDFError
+      *data* does not start with the PDF magic number.
+    TruncatedPDFError
+      *check_trailer* is true and *data* does not end with an
+      ``%%EOF`` marker.
+    
+    """
+    if not is_pdf(data[:len(pdf_magic)]):
+        raise InvalidPDFError(diagnose_response(data, doi=doi), head=data[:diagnosis_size])
+    if check_trailer and not has_pdf_trailer(data[-trailer_size:]):
+        raise TruncatedPDFError("PDF for {} is incomplete".format(doi))
+
+
+def save_pdf(pdf_response, doi, fp=None, max_size=None, check_trailer=None, offset=0,
+             truncate=False):
+    """Stream the body of a PDF response into a file.
+    
+    The start of the response is checked for the ``%PDF-`` magic
+    number before anything is written, so error pages are never saved as PDFs.
+    
+    Parameters
+    ==========
+    pdf_response : requests.Response
+      The response to the PDF request, ideally made with
+      ``stream=True``.
+    doi : str
+      The DOI being retrieved, used for error messages.
+    fp : File-like object
+      Will receive the PDF contents. Must be writable and in a binary
+      mode. If omitted, the PDF will be returned as bytes instead.
+    max_size : int
+      If given, abort once the PDF grows beyond this many bytes.
+    check_trailer : bool
+      Whether to check that the PDF ends with an ``%%EOF`` marker. If
+      omitted, the ``check_trailer`` option in the ``[pdf]`` section
+      of the config file is used.
+    offset : int
+      How many bytes of the PDF are already in *fp*, if this response
+      is resuming an earlier download.
+    truncate : bool
+      Empty *fp* once the response is known to be a PDF, e.g. to
+      replace a partial download that could not be resumed.
+    
+    Returns
+    =======
+    pdf : bytes or int
+      The PDF contents if *fp* is omitted, otherwise the total size
+      of the PDF in *fp*.
+    
+    """
+    if check_trailer is None:
+        check_trailer = config['pdf'].getboolean('check_trailer')
+    # Check the declared size before downloading anything
+    content_length = pdf_response.headers.get('Content-Length', '')
+    if max_size and content_length.isdigit() and offset + int(content_length) > max_size:
+        pdf_response.close()
+        raise PDFTooLargeError("PDF for {} is {} bytes (limit {})".format(
+            doi, offset + int(content_length), max_size))
+    buffered = fp is None
+    if buffered:
+        fp = io.BytesIO()
+    size = offset
+    head = b''
+    tail = b''
+    try:
+        chunks = pdf_response.iter_content(chunk_size=chunk_size)
+        for chunk in chunks:
+            if size == 0:
+                # Wait until there is enough to check the magic number
+                head += chunk
+                if len(head) < len(pdf_magic):
+                    continue
+                if not is_pdf(head):
+                    # Read just enough of the response to say what went wrong
+                    for chunk in chunks:
+                        if len(head) >= diagnosis_size:
+                            break
+                        head += chunk
+                    validate_pdf(head, doi=doi)
+                if truncate:
+                    fp.seek(0)
+                    fp.truncate()
+                chunk, head = head, b''
+            size += len(chunk)
+            if max_size and size > max_size:
+                raise PDFTooLargeError("PDF for {} is larger than {} bytes".format(doi, max_size))
+            fp.write(chunk)
+            tail = (tail + chunk)[-trailer_size:]
+    finally:
+        pdf_response.close()
+    if head:
+        # Too short to even hold the magic number
+        validate_pdf(head, doi=doi)
+    if size == 0:
+        raise InvalidPDFError("Empty response for PDF of {}".format(doi))
+    if check_trailer and not has_pdf_trailer(tail):
+        raise TruncatedPDFError("PDF for {} is incomplete ({} bytes)".format(doi, size))
+    return fp.getvalue() if buffered else size
+
+
+def validate_pdf_file(fp, doi='', check_trailer=None):
+    """Make sure the open binary file *fp* holds a complete PDF.
+    
+    Only the first and last few bytes are read. See
+    :py:func:`validate_pdf` for the exceptions raised.
+    
+    """
+    if check_trailer is None:
+        check_trailer = config['pdf'].getboolean('check_trailer')
+    fp.seek(0)
+    head = fp.read(diagnosis_size)
+    size = fp.seek(0, os.SEEK_END)
+    fp.seek(max(0, size - trailer_size))
+    tail = fp.read(trailer_size)
+    validate_pdf(head, doi=doi)
+    if check_trailer and not has_pdf_trailer(tail):
+        raise TruncatedPDFError("PDF for {} is incomplete ({} bytes)".format(doi, size))
+
+
+def fetch_pdf(pdf_url, doi, fp=None, max_size=None, headers=None):
+    """Download the PDF at *pdf_url* into *fp*.
+    
+    If *fp* already has some content, for example from an earlier
+    download that was interrupted, only the remaining bytes are
+    requested. If the server sends the whole PDF instead, or rejects
+    the range as not fitting the PDF, *fp* is replaced with the whole
+    PDF. Any other response leaves *fp* as it was, so the download
+    can be resumed later.
+    
+    Parameters
+    ==========
+    pdf_url : str
+      The location of the PDF.
+    doi : str
+      The DOI being retrieved, used for error messages.
+    fp : File-like object
+      Will receive the PDF contents. Must be readable, writable,
+      seekable and in a binary mode. If omitted, the PDF will be
+      returned as bytes instead.
+    max_size : int
+      If given, abort once the PDF grows beyond this many bytes.
+    headers : dict
+      Extra HTTP headers to send with the request.
+    
+    Returns
+    =======
+    pdf : bytes or int
+      See :py:func:`save_pdf`.
+    
+    """
+    headers = dict(headers) if headers is not None else {}
+    offset = fp.seek(0, os.SEEK_END) if fp is not None else 0
+    if offset > 0:
+        headers['Range'] = 'bytes={}-'.format(offset)
+    pdf_response = sessions.get(pdf_url, headers=headers, stream=True)
+    truncate = False
+    if offset > 0:
+        status = pdf_response.status_code
+        content_range = pdf_response.headers.get('Content-Range', '')
+        if status == 206 and content_range.startswith('bytes {}-'.format(offset)):
+            log.info("Resuming download of %s after %d bytes", pdf_url, offset)
+        elif status == 200 or (status == 206 and content_range.startswith('bytes 0-')):
+            # The server ignored the range, so replace the partial
+            # file, but only if this really is the PDF
+            log.info("Could not resume download of %s, starting over", pdf_url)
+            offset = 0
+            truncate = True
+        elif status == 416:
+            # The partial file doesn't fit this PDF
+            log.info("Could not resume download of %s, starting over", pdf_url)
+            pdf_response.close()
+            fp.seek(0)
+            fp.truncate()
+            offset = 0
+            del headers['Range']
+            pdf_response = sessions.get(pdf_url, headers=headers, stream=True)
+        else:
+            pdf_response.close()
+            raise PDFResumeError("Could not resume PDF for {} (HTTP {})".format(doi, status))
+    return save_pdf(pdf_response, doi=doi, fp=fp, max_size=max_size, offset=offset,
+                    truncate=truncate)
+
+
+def american_chemical_society(doi, *args, fp=None, max_size=None, **kwargs):
     pdf_url = "https://pubs.acs.org/doi/pdf/{doi}".format(doi=doi)
-    pdf_response = requests.get(pdf_url, headers=default_headers)
-    # Verify that it's a valid PDF
-    if not re.match('%PDF-([-0-9]+)', pdf_response.text[:8]):
-        # Failed, so figure out why
-        if "Missing resource" in pdf_response.text:
-            raise PDFNotFoundError("No PDF for {}".format(doi))
-    return pdf_response.content
+    return fetch_pdf(pdf_url, doi=doi, fp=fp, max_size=max_size, headers=default_headers)
 
 
-def aaas(doi, *args, **kwargs):
+def aaas(doi, *args, fp=None, max_size=None, **kwargs):
     # Go resolve the url to extract the AAAS article ID
     html_url = 'https://www.sciencemag.org/lookup/doi/{}'.format(doi)
-    response = requests.options(html_url)
+    response = sessions.options(html_url)
     # Determine the URL of the article PDF
     article_re = re.match('https?://[a-z.]+/content/([0-9/]+)', response.url)
     if article_re:
@@ -85,31 +330,20 @@ def aaas(doi, *args, **kwargs):
         # AAAS is too restrictive, maybe use sci-hub in the future?
         raise PDFNotFoundError("No PDF for {}".format(doi))
     # Retrieve the PDF
-    pdf_response = requests.get(pdf_url, headers=default_headers)
-    # Verify that it's a valid PDF
-    if not re.match('%PDF-([-0-9]+)', pdf_response.text[:8]):
-        # Failed, so figure out why
-        if "Missing resource" in pdf_response.text:
-            raise PDFNotFoundError("No PDF for {}".format(doi))
-    return pdf_response.content
+    return fetch_pdf(pdf_url, doi=doi, fp=fp, max_size=max_size, headers=default_headers)
 
 
-def electrochemical_society(doi, *args, **kwargs):
+def electrochemical_society(doi, *args, fp=None, max_size=None, **kwargs):
     # Resolve the DOI to an ECS identifier
     lookup_url = 'http://jes.ecsdl.org/lookup/doi/{}'.format(doi)
-    response = requests.get(lookup_url, allow_redirects=False, headers=default_headers)
+    response = sessions.get(lookup_url, allow_redirects=False, headers=default_headers)
     ecs_path = response.headers['Location']
     # Retrieve the PDF
     pdf_url = "http://jes.ecsdl.org/{}.full.pdf".format(ecs_path)
-    pdf_response = requests.get(pdf_url, headers=default_headers)
-    # Verify that it's a valid PDF
-    if not re.match('%PDF-([-0-9]+)', pdf_response.text[:8]):
-        # Failed, so figure out why
-        raise PDFNotFoundError("No PDF for {}".format(doi))
-    return pdf_response.content
+    return fetch_pdf(pdf_url, doi=doi, fp=fp, max_size=max_size, headers=default_headers)
 
 
-def elsevier(doi, api_key=None, *args, **kwargs):
+def elsevier(doi, api_key=None, *args, fp=None, max_size=None, **kwargs):
     # Make sure the API key is set
     if api_key is None:
         config.read()
@@ -124,9 +358,9 @@ def elsevier(doi, api_key=None, *args, **kwargs):
         'Accept': 'application/pdf',
         'apiKey': api_key,
     })
-    pdf_response = requests.get(api_url, headers=headers)
-    # Verify that it's a valid PDF
-    if not re.match('%PDF-([-0-9]+)', pdf_response.text[:8]):
+    try:
+        return fetch_pdf(api_url, doi=doi, fp=fp, max_size=max_size, headers=headers)
+    except InvalidPDFError:
         if not api_key:
             # It probably failed because the API key was not saved
             msg = ("No API key found for Elsevier. See the documentation "
@@ -134,28 +368,21 @@ def elsevier(doi, api_key=None, *args, **kwargs):
                    "https://franklin.readthedocs.io/en/latest/publishers.html#elsevier")
             raise ConfigError(msg)
         else:
-            
             # General failure
-            raise PDFNotFoundError("No PDF for {}".format(doi))
-    return pdf_response.content
+            raise
 
 
-def springer(doi, *args, **kwargs):
+def springer(doi, *args, fp=None, max_size=None, **kwargs):
     pdf_url = "https://link.springer.com/content/pdf/{doi}.pdf"
     pdf_url = pdf_url.format(doi=doi)
-    pdf_response = requests.get(pdf_url, headers=default_headers)
-    # Verify that it's a valid PDF
-    if not re.match('%PDF-([-0-9]+)', pdf_response.text[:8]):
-        # Failed, so figure out why
-        raise PDFNotFoundError("No PDF for {}".format(doi))
-    return pdf_response.content
+    return fetch_pdf(pdf_url, doi=doi, fp=fp, max_size=max_size, headers=default_headers)
 
 
-def royal_society_of_chemistry(doi, url, *args, **kwargs):
+def royal_society_of_chemistry(doi, url, *args, fp=None, max_size=None, **kwargs):
     pdf_url = "https://pubs.rsc.org/en/content/articlepdf/2019/sc/c9sc03417j"
     pdf_url = "https://pubs.rsc.org/en/content/articlepdf/2019/sc/c9sc03417j"
     # Determine RSC url for the PDF
-    response = requests.get(url, allow_redirects=False, headers=default_headers)
+    response = sessions.get(url, allow_redirects=False, headers=default_headers)
     new_url = response.headers['Location']
     url_regex = 'https://pubs.rsc.org/en/content/articlelanding/([0-9a-zA-Z/]+)/?'
     match = re.match(url_regex, new_url)
@@ -165,37 +392,22 @@ def royal_society_of_chemistry(doi, url, *args, **kwargs):
     else:
         raise PDFNotFoundError("Could not parse article URL: '%s' with regex '%s'" % (new_url, url_regex))
     # Retrieve the actual PDF
-    pdf_response = requests.get(pdf_url, headers=default_headers)
-    # Verify that it's a valid PDF
-    if not re.match('%PDF-([-0-9]+)', pdf_response.text[:8]):
-        # Failed, so figure out why
-        raise PDFNotFoundError("No PDF for {}".format(doi))
-    return pdf_response.content
+    return fetch_pdf(pdf_url, doi=doi, fp=fp, max_size=max_size, headers=default_headers)
 
 
-def wiley(doi, *args, **kwargs):
+def wiley(doi, *args, fp=None, max_size=None, **kwargs):
     pdf_url = "https://onlinelibrary.wiley.com/doi/pdfdirect/{}".format(doi)
-    pdf_response = requests.get(pdf_url, headers=default_headers)
-    # Verify that it's a valid PDF
-    if not re.match('%PDF-([-0-9]+)', pdf_response.text[:8]):
-        # Failed, so figure out why
-        raise PDFNotFoundError("No PDF for {}".format(doi))
-    return pdf_response.content
+    return fetch_pdf(pdf_url, doi=doi, fp=fp, max_size=max_size, headers=default_headers)
 
 
-def annual_reviews(doi, *args, **kwargs):
+def annual_reviews(doi, *args, fp=None, max_size=None, **kwargs):
     pdf_url = 'https://www.annualreviews.org/doi/pdf/{}'.format(doi)
-    pdf_response = requests.get(pdf_url)
-    # Verify that it's a valid PDF
-    if not re.match('%PDF-([-0-9]+)', pdf_response.text[:8]):
-        # Failed, so figure out why
-        raise PDFNotFoundError("No PDF for {}".format(doi))
-    return pdf_response.content
+    return fetch_pdf(pdf_url, doi=doi, fp=fp, max_size=max_size)
 
 
-def ieee(doi, url, *args, **kwargs):
+def ieee(doi, url, *args, fp=None, max_size=None, **kwargs):
     # Get the PDF URL from the HTML page
-    html_response = requests.get(url)
+    html_response = sessions.get(url)
     html_regex = '"pdfPath":"([^"]+)"'
     html_re = re.search(html_regex, html_response.text)
     if html_re:
@@ -205,24 +417,48 @@ def ieee(doi, url, *args, **kwargs):
     # This is a kludge to fix a typo(?) in a specific file
     pdf_url = pdf_url.replace('iel7', 'ielx7')
     # Now retrieve the PDF itself
-    pdf_response = requests.get(pdf_url)
-    # Verify that it's a valid PDF
-    if not re.match('%PDF-([-0-9]+)', pdf_response.text[:8]):
-        # Failed, raise a more helpful exception
-        raise PDFNotFoundError("No PDF for {}".format(doi))
-    return pdf_response.content
+    return fetch_pdf(pdf_url, doi=doi, fp=fp, max_size=max_size)
 
 
-def iop(doi, *args, **kwargs):
+def iop(doi, *args, fp=None, max_size=None, **kwargs):
     pdf_url = f'https://iopscience.iop.org/article/{doi}/pdf'
-    pdf_response = requests.get(pdf_url, headers=default_headers)
-    # Verify that it's a valid PDF
-    if not re.match('%PDF-([-0-9]+)', pdf_response.text[:8]):
-        # Failed, so figure out why
-        if "you are a bot" in pdf_response.text:
-            raise PDFNotFoundError("Captcha detected while retrieving PDF for {}. ".format(doi) + 
-                                   "(hint: use `--no-pdf` to skip PDF retrieval)")
-        else:
-            raise PDFNotFoundError("No PDF for {}. (hint: use `--no-pdf` to skip PDF retrieval)".format(doi))
-    return pdf_response.content
-    
+    return fetch_pdf(pdf_url, doi=doi, fp=fp, max_size=max_size, headers=default_headers)
+
+
+# Publishers as named in the bibtex metadata from doi.org
+publisher_names = {
+    'American Chemical Society ({ACS})': american_chemical_society,
+    'American Chemical Society (ACS)': american_chemical_society,
+    'The Electrochemical Society': iop,
+    '{IOP}': iop,
+    'Elsevier {BV}': elsevier,
+    'Springer Science and Business Media {LLC}': springer,
+    'Royal Society of Chemistry ({RSC})': royal_society_of_chemistry,
+    'Wiley': wiley,
+    'Annual Reviews': annual_reviews,
+    'Institute of Electrical and Electronics Engineers ({IEEE})': ieee,
+    'American Association for the Advancement of Science ({AAAS})': aaas,
+}
+
+
+# Publishers by the registrant prefix of their DOIs
+doi_prefixes = {
+    '10.1021': american_chemical_society,
+    '10.1149': iop,  # The Electrochemical Society
+    '10.1088': iop,
+    '10.1016': elsevier,
+    '10.1007': springer,
+    '10.1039': royal_society_of_chemistry,
+    '10.1002': wiley,
+    '10.1111': wiley,
+    '10.1146': annual_reviews,
+    '10.1109': ieee,
+    '10.1126': aaas,
+}
+
+
+# Publishers that need the article's landing page URL to find the PDF
+requires_url = {
+    royal_society_of_chemistry,
+    ieee,
+}
@@ -0,0 +1,157 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Limit how quickly PDFs are requested from each publisher.
+
+Publishers tend to present a captcha if too many PDFs are requested
+too quickly. The defaults are in the ``[rate_limit]`` section of the
+config file, and can be overridden for one publisher handler by a
+``[rate_limit:<handler>]`` section, e.g.::
+
+  [rate_limit:iop]
+  rate = 0.2
+  burst = 1
+  max_concurrency = 1
+
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from .config import franklin_config as config
+
+
+log = logging.getLogger(__name__)
+
+
+# Prepare default global configuration values
+config.set_defaults('rate_limit', {
+    # Average number of PDF requests per second to one publisher
+    'rate': '1',
+    # Number of requests that may be made in quick succession
+    'burst': '2',
+    # Number of PDFs that may be downloaded at once from one publisher
+    'max_concurrency': '2',
+})
+
+
+class TokenBucket():
+    """Allow, on average, *rate* events per second.
+
+    Up to *capacity* events can happen in quick succession before
+    having to wait.
+
+    """
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.last_update = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def acquire(self):
+        """Wait until an event is allowed."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+class PublisherLimiter():
+    """Limits the rate and concurrency of requests to one publisher.
+
+    Use as a context manager around each request::
+
+      with get_limiter('iop'):
+          publishers.iop(doi)
+
+    """
+    def __init__(self, name, rate=1, burst=2, max_concurrency=2, bucket=None):
+        self.name = name
+        self.bucket = bucket if bucket is not None else TokenBucket(rate=rate, capacity=burst)
+        self.max_concurrency = max_concurrency
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    @classmethod
+    def from_config(cls, name):
+        """Create a limiter for the *name* handler from the config file."""
+        section = 'rate_limit:{}'.format(name)
+        if not config.has_section(section):
+            section = 'rate_limit'
+        def get(option, type_):
+            return type_(config.get(section, option, fallback=config['rate_limit'][option]))
+        return cls(name=name, rate=get('rate', float), burst=get('burst', int),
+                   max_concurrency=get('max_concurrency', int))
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        try:
+            self.bucket.acquire()
+        except:
+            self._semaphore.release()
+            raise
+        log.debug("Starting request to %s", self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._semaphore.release()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """Retrieve the limiter shared by all requests to publisher *name*."""
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = PublisherLimiter.from_config(name)
+        return _limiters[name]
+
+
+def interleave(items, key):
+    """Re-order *items* so that consecutive items have different keys.
+
+    Items are taken from each group (as determined by ``key(item)``)
+    in turn, and otherwise keep their original order. Scheduling jobs
+    this way keeps all the workers busy, instead of waiting in line
+    for the same publisher.
+
+    """
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    queues = [iter(group) for group in groups.values()]
+    interleaved = []
+    while queues:
+        for queue in list(queues):
+            try:
+                interleaved.append(next(queue))
+            except StopIteration:
+                queues.remove(queue)
+    return interleaved
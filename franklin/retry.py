@@ -0,0 +1,276 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Retrying failed HTTP requests, with a separate policy for each host.
+
+The defaults are in the ``[retry]`` section of the config file, and
+can be overridden for a single host by a ``[retry:<host>]`` section,
+e.g.::
+
+  [retry:iopscience.iop.org]
+  max_attempts = 2
+  deadline = 20
+
+"""
+
+import time
+import random
+import logging
+import threading
+import email.utils
+
+import requests
+
+from .config import franklin_config as config
+from .exceptions import HostUnavailableError
+
+
+log = logging.getLogger(__name__)
+
+
+# Prepare default global configuration values
+config.set_defaults('retry', {
+    # Total number of attempts, including the first one
+    'max_attempts': '4',
+    # Delay before the first retry, doubled for each retry after (seconds)
+    'backoff': '0.5',
+    'max_backoff': '30',
+    # Give up retrying after this long (seconds)
+    'deadline': '60',
+    # Timeout for each individual attempt (seconds)
+    'timeout': '10',
+    # Stop contacting a host after this many failures in a row...
+    'breaker_threshold': '5',
+    # ...until this long has passed (seconds)
+    'breaker_reset': '60',
+})
+
+
+def retry_after(response):
+    """Determine how long the server asked us to wait, in seconds.
+
+    Returns ``None`` if the response has no valid ``Retry-After``
+    header.
+
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0., retry_date.timestamp() - time.time())
+
+
+class CircuitBreaker():
+    """Stop contacting a host once it has clearly stopped responding.
+
+    After *threshold* failures in a row, the breaker opens and no more
+    requests are allowed until *reset_timeout* seconds have passed. A
+    single trial request is then allowed through: if it succeeds the
+    breaker closes again, otherwise it re-opens.
+
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=60, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        elif self.clock() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        else:
+            return self.OPEN
+
+    def allow(self):
+        """Check whether a request may be sent right now."""
+        with self._lock:
+            state = self.state
+            if state == self.HALF_OPEN:
+                # Let one trial request through, but keep the rest out
+                self.opened_at = self.clock()
+                return True
+            return state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = self.clock()
+
+
+class RetryPolicy():
+    """Decides whether, and when, to retry a failed request to one host.
+
+    Failed attempts are retried with an exponential backoff (with
+    random jitter), or after the delay the server requested with a
+    ``Retry-After`` header. No more attempts are made once *deadline*
+    seconds have passed since the first one. Only idempotent methods
+    are retried.
+
+    Parameters
+    ==========
+    host : str
+      The host this policy applies to (used for logging).
+    max_attempts : int
+      Maximum number of attempts, including the first one.
+    backoff : float
+      Base delay before the first retry, in seconds.
+    max_backoff : float
+      Longest delay between two attempts, in seconds.
+    deadline : float
+      Don't start a new attempt after this many seconds.
+    timeout : float
+      Timeout for each individual attempt, in seconds.
+    breaker : CircuitBreaker
+      Shared record of recent failures for this host.
+
+    """
+    retry_statuses = {429, 500, 502, 503, 504}
+    retry_methods = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+    retry_exceptions = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+    def __init__(self, host='', max_attempts=4, backoff=0.5, max_backoff=30,
+                 deadline=60, timeout=10, breaker=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.host = host
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.timeout = timeout
+        self.breaker = breaker if breaker is not None else CircuitBreaker(clock=clock)
+        self.clock = clock
+        self.sleep = sleep
+
+    @classmethod
+    def from_config(cls, host):
+        """Create a policy for *host* from the franklin config file."""
+        section = 'retry:{}'.format(host)
+        if not config.has_section(section):
+            section = 'retry'
+        def get(option, type_):
+            return type_(config.get(section, option, fallback=config['retry'][option]))
+        breaker = CircuitBreaker(threshold=get('breaker_threshold', int),
+                                 reset_timeout=get('breaker_reset', float))
+        return cls(host=host,
+                   max_attempts=get('max_attempts', int),
+                   backoff=get('backoff', float),
+                   max_backoff=get('max_backoff', float),
+                   deadline=get('deadline', float),
+                   timeout=get('timeout', float),
+                   breaker=breaker)
+
+    def delay(self, attempt, response=None):
+        """How long to wait before retrying after the given attempt."""
+        if response is not None:
+            requested_delay = retry_after(response)
+            if requested_delay is not None:
+                return requested_delay
+        # Exponential backoff with "full jitter"
+        max_delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(0, max_delay)
+
+    def send(self, send_request, method='GET'):
+        """Send a request, retrying according to this policy.
+
+        Parameters
+        ==========
+        send_request : callable
+          Called with no arguments to make each attempt. Should
+          return a :py:class:`requests.Response`.
+        method : str
+          The HTTP method, used to decide if retrying is safe.
+
+        Returns
+        =======
+        response : requests.Response
+          The response from the last attempt. Its status code may
+          still indicate an error.
+
+        """
+        start = self.clock()
+        max_attempts = self.max_attempts if method.upper() in self.retry_methods else 1
+        for attempt in range(max_attempts):
+            if not self.breaker.allow():
+                if attempt > 0:
+                    # Give up, and report the most recent failure
+                    break
+                raise HostUnavailableError(
+                    "Too many recent failures contacting {}, not trying again "
+                    "for {} s".format(self.host, self.breaker.reset_timeout))
+            error = None
+            response = None
+            try:
+                response = send_request()
+            except self.retry_exceptions as e:
+                log.debug("Attempt %d/%d to contact %s failed: %s",
+                          attempt + 1, max_attempts, self.host, e)
+                self.breaker.record_failure()
+                error = e
+            else:
+                if response.status_code not in self.retry_statuses:
+                    self.breaker.record_success()
+                    return response
+                log.debug("Attempt %d/%d to contact %s returned HTTP %d",
+                          attempt + 1, max_attempts, self.host, response.status_code)
+                # Being rate-limited doesn't mean the host is down
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+            # Decide whether there's enough time left to try again
+            if attempt + 1 >= max_attempts:
+                break
+            delay = self.delay(attempt, response=response)
+            if self.clock() - start + delay > self.deadline:
+                log.debug("Not retrying %s: deadline of %s s reached", self.host, self.deadline)
+                break
+            if response is not None:
+                response.close()
+            self.sleep(delay)
+        if error is not None:
+            raise error
+        return response
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def get_policy(host):
+    """Retrieve the retry policy shared by all requests to *host*."""
+    with _policies_lock:
+        if host not in _policies:
+            _policies[host] = RetryPolicy.from_config(host)
+        return _policies[host]
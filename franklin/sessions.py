@@ -0,0 +1,157 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""A shared HTTP session so connections can be re-used between requests.
+
+All network access in franklin should go through the functions in
+this module (e.g. ``sessions.get(url)``) rather than calling
+``requests.get`` directly. This lets TCP and TLS connections be kept
+alive between requests to the same host. Tests can substitute their
+own session using :py:func:`set_session`.
+
+"""
+
+import logging
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .version import __version__
+from .retry import get_policy
+
+
+log = logging.getLogger(__name__)
+
+
+# How many connections to keep open to each host
+default_pool_size = 4
+host_pool_sizes = {
+    # DOI resolution
+    'doi.org': 16,
+    'dx.doi.org': 16,
+    # Publishers
+    'pubs.acs.org': 8,
+    'onlinelibrary.wiley.com': 8,
+    'api.elsevier.com': 8,
+    'link.springer.com': 8,
+    'pubs.rsc.org': 8,
+    'iopscience.iop.org': 4,
+    'ieeexplore.ieee.org': 4,
+    'www.annualreviews.org': 4,
+    'www.sciencemag.org': 4,
+    'science.sciencemag.org': 4,
+    'jes.ecsdl.org': 4,
+    # Journal abbreviations
+    'cassi.cas.org': 4,
+    'www.issn.org': 2,
+}
+
+
+class SessionManager():
+    """Provides a single :py:class:`requests.Session` for all of franklin.
+
+    The session is created on first use, with a separate pool of
+    keep-alive connections for each host in *pool_sizes*.
+
+    Parameters
+    ==========
+    pool_sizes : dict
+      Maps host names to the number of connections to keep open to
+      that host. Defaults to ``host_pool_sizes``.
+    default_pool_size : int
+      Number of connections to keep open for any other host.
+
+    """
+    def __init__(self, pool_sizes=None, default_pool_size=default_pool_size):
+        self.pool_sizes = pool_sizes if pool_sizes is not None else host_pool_sizes
+        self.default_pool_size = default_pool_size
+        self._session = None
+        self._lock = threading.Lock()
+
+    def create_session(self):
+        """Build a new session with connection pools for known hosts."""
+        session = requests.Session()
+        session.headers['User-Agent'] = 'franklin/{} (https://github.com/canismarko/franklin)'.format(__version__)
+        default_adapter = HTTPAdapter(pool_maxsize=self.default_pool_size)
+        session.mount('http://', default_adapter)
+        session.mount('https://', default_adapter)
+        for host, pool_size in self.pool_sizes.items():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://{}/'.format(host), adapter)
+            session.mount('https://{}/'.format(host), adapter)
+        return session
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                log.debug("Creating new HTTP session")
+                self._session = self.create_session()
+            return self._session
+
+    @session.setter
+    def session(self, new_session):
+        with self._lock:
+            self._session = new_session
+
+    def close(self):
+        """Close all open connections."""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+
+
+session_manager = SessionManager()
+
+
+def get_session():
+    """Retrieve the session shared by all of franklin."""
+    return session_manager.session
+
+
+def set_session(session):
+    """Replace the shared session, for example with a mock during testing."""
+    session_manager.session = session
+
+
+def request(method, url, retry=True, **kwargs):
+    """Make an HTTP request using the shared session.
+
+    Accepts the same arguments as :py:func:`requests.request`. Unless
+    *retry* is false, failed requests are retried according to the
+    policy for this host (see :py:mod:`franklin.retry`).
+
+    """
+    session = get_session()
+    if not retry:
+        return session.request(method, url, **kwargs)
+    policy = get_policy(urlparse(url).hostname)
+    kwargs.setdefault('timeout', policy.timeout)
+    return policy.send(lambda: session.request(method, url, **kwargs), method=method)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def options(url, **kwargs):
+    return request('OPTIONS', url, **kwargs)
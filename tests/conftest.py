@@ -0,0 +1,42 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Keep the tests away from the user's own config file and caches."""
+
+import pytest
+
+from franklin import cache, ltwa, daemon  # noqa: F401 (daemon provides the [daemon] defaults)
+from franklin.config import FranklinConfig, franklin_config as config
+
+
+@pytest.fixture(autouse=True)
+def private_cache(tmp_path, monkeypatch):
+    """Point the caches at a temporary directory."""
+    monkeypatch.setattr(FranklinConfig, 'default_filename', tmp_path / 'franklinrc')
+    old_directory = config['cache']['directory']
+    old_daemon = dict(config['daemon'])
+    config['cache']['directory'] = str(tmp_path / 'cache')
+    # Never send work to a franklind that happens to be running
+    config['daemon'].update({'socket': str(tmp_path / 'franklind.sock'), 'enabled': 'no'})
+    try:
+        yield tmp_path / 'cache'
+    finally:
+        config['cache']['directory'] = old_directory
+        config['daemon'].update(old_daemon)
+        # Forget anything the shared instances picked up from this test
+        cache.abbreviation_store.close()
+        cache.metadata_store._total_size = None
+        cache.memory_cache.clear()
+        ltwa.clear()
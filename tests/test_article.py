@@ -14,11 +14,18 @@
 # along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
 
 import unittest
+from unittest import mock
 import io
+import tempfile
+import time
+import json
+import threading
 
 import bibtexparser
 
-from franklin import Article, exceptions
+from franklin import Article, exceptions, sessions
+from franklin.cache import MetadataStore, MemoryCache
+from franklin.config import franklin_config as config
 
 
 class ArticlesTests(unittest.TestCase):
@@ -76,3 +83,166 @@ class ArticlesTests(unittest.TestCase):
     def test_default_id(self):
         article = Article(doi=self.perspective_paper_doi)
         self.assertEqual(article.default_id(), 'cabana2017')
+
+
+class ArticleStoreTests(unittest.TestCase):
+    doi = '10.1021/acs.chemmater.6b05114'
+    bibtex = (
+        '@article{Wolfman_2017,\n'
+        '  doi = {10.1021/acs.chemmater.6b05114},\n'
+        '  year = 2017,\n'
+        '  publisher = {American Chemical Society ({ACS})},\n'
+        '  author = {Mark Wolfman and Brian M. May and Jordi Cabana},\n'
+        '  title = {Visualization of Electrochemical Reactions in Battery Materials with X-ray Microscopy and Mapping},\n'
+        '  journal = {Chemistry of Materials}\n'
+        '}'
+    )
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = MetadataStore(directory=self.tmpdir.name, ttl=60,
+                                   max_size=2**20, enabled=True)
+        # Don't let earlier network failures trip the circuit breakers
+        patcher = mock.patch.dict('franklin.retry._policies', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Don't share cached bibtex with other tests
+        self.memory_cache = MemoryCache(max_size=2**20)
+        patcher = mock.patch('franklin.article.memory_cache', self.memory_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_metadata_from_store(self):
+        self.store.put(self.doi, self.bibtex)
+        session = mock.MagicMock()
+        with mock.patch('franklin.article.metadata_store', self.store), \
+             mock.patch.object(sessions.session_manager, '_session', session):
+            metadata = Article(doi=self.doi).metadata()
+        session.request.assert_not_called()
+        self.assertEqual(metadata['doi'], self.doi)
+    
+    def test_metadata_shared_in_memory(self):
+        session = mock.MagicMock()
+        session.request.return_value = mock.MagicMock(status_code=200, text=self.bibtex)
+        store = MetadataStore(enabled=False)
+        with mock.patch('franklin.article.metadata_store', store), \
+             mock.patch.object(sessions.session_manager, '_session', session):
+            Article(doi=self.doi).metadata()
+            # Another article for the same DOI should re-use the bibtex
+            metadata = Article(doi=self.doi.upper()).metadata()
+        self.assertEqual(session.request.call_count, 1)
+        self.assertEqual(metadata['doi'], self.doi)
+        self.assertEqual(self.memory_cache.hits, 1)
+        self.assertEqual(self.memory_cache.misses, 1)
+    
+    def test_interrupted_result(self):
+        article = Article(doi=self.doi)
+        waiter_errors = []
+        def wait_for_result():
+            try:
+                article._result('bibtex', lambda: 'not called')
+            except Exception as e:
+                waiter_errors.append(e)
+        waiter = threading.Thread(target=wait_for_result, daemon=True)
+        def interrupted():
+            waiter.start()
+            time.sleep(0.05)
+            raise KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            article._result('bibtex', interrupted)
+        # The other thread gives up instead of waiting forever
+        waiter.join(timeout=5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(len(waiter_errors), 1)
+        # The next call tries again
+        self.assertEqual(article._result('bibtex', lambda: '@article{}'), '@article{}')
+    
+    def test_metadata_saved_to_store(self):
+        session = mock.MagicMock()
+        session.request.return_value = mock.MagicMock(status_code=200, text=self.bibtex)
+        with mock.patch('franklin.article.metadata_store', self.store), \
+             mock.patch.object(sessions.session_manager, '_session', session):
+            Article(doi=self.doi).metadata()
+            # A second article should not need to contact the DOI server
+            Article(doi=self.doi).metadata()
+        self.assertEqual(session.request.call_count, 1)
+        self.assertEqual(self.store.get(self.doi), self.bibtex)
+    
+    def test_metadata_from_csl_json(self):
+        csl = json.dumps({
+            'type': 'article-journal',
+            'DOI': self.doi,
+            'author': [{'given': 'Mark', 'family': 'Wolfman'},
+                       {'given': 'Jordi', 'family': 'Cabana'}],
+            'issued': {'date-parts': [[2017, 3]]},
+            'container-title': 'Chemistry of Materials',
+            'publisher': 'American Chemical Society ({ACS})',
+        })
+        session = mock.MagicMock()
+        session.request.return_value = mock.MagicMock(status_code=200, text=csl)
+        config['metadata']['format'] = 'csl-json'
+        try:
+            with mock.patch('franklin.article.metadata_store', self.store), \
+                 mock.patch.object(sessions.session_manager, '_session', session):
+                article = Article(doi=self.doi)
+                self.assertEqual(article.default_id(), 'cabana2017')
+                bibtex = article.bibtex()
+        finally:
+            config['metadata']['format'] = 'bibtex'
+        headers = session.request.call_args[1]['headers']
+        self.assertEqual(headers['Accept'], 'application/vnd.citationstyles.csl+json')
+        self.assertEqual(self.store.get(self.doi, fmt='csl-json'), csl)
+        entry = bibtexparser.loads(bibtex).entries[0]
+        self.assertEqual(entry['ID'], 'cabana2017')
+        self.assertEqual(entry['journal'], 'Chemistry of Materials')
+        self.assertEqual(entry['month'], 'March')
+    
+    def test_csl_json_falls_back_to_bibtex(self):
+        session = mock.MagicMock()
+        session.request.side_effect = [
+            mock.MagicMock(status_code=406, text=''),
+            mock.MagicMock(status_code=200, text=self.bibtex),
+        ]
+        config['metadata']['format'] = 'csl-json'
+        try:
+            with mock.patch('franklin.article.metadata_store', self.store), \
+                 mock.patch.object(sessions.session_manager, '_session', session):
+                metadata = Article(doi=self.doi).metadata()
+        finally:
+            config['metadata']['format'] = 'bibtex'
+        self.assertEqual(session.request.call_count, 2)
+        self.assertEqual(metadata['doi'], self.doi)
+    
+    def test_pdf_without_metadata(self):
+        """Check that the publisher is found from the DOI prefix."""
+        article = Article(doi=self.doi)
+        pub_func = mock.MagicMock(return_value=b'%PDF-1.6', __name__='american_chemical_society')
+        with mock.patch.object(article, 'metadata') as metadata, \
+             mock.patch.object(article, '_load_bibtex', return_value=self.bibtex), \
+             mock.patch.object(article, 'url') as url, \
+             mock.patch.dict('franklin.publishers.doi_prefixes', {'10.1021': pub_func}):
+            article.download_pdf(fp=io.BytesIO())
+        metadata.assert_not_called()
+        # ACS doesn't need the resolved URL
+        url.assert_not_called()
+        pub_func.assert_called_once_with(doi=self.doi, url=None, fp=mock.ANY, max_size=None)
+    
+    def test_pdf_concurrent_with_metadata(self):
+        """Check that the bibtex is retrieved while the PDF downloads."""
+        article = Article(doi=self.doi)
+        def slow_bibtex():
+            time.sleep(0.2)
+            return self.bibtex
+        def slow_pdf(*args, **kwargs):
+            time.sleep(0.2)
+        slow_pdf.__name__ = 'american_chemical_society'
+        start = time.monotonic()
+        with mock.patch.object(article, '_download_bibtex', side_effect=slow_bibtex), \
+             mock.patch('franklin.article.metadata_store', self.store), \
+             mock.patch.dict('franklin.publishers.doi_prefixes', {'10.1021': slow_pdf}):
+            article.download_pdf(fp=io.BytesIO())
+            article.bibtex(id='wolfman2017')
+        self.assertLess(time.monotonic() - start, 0.35)
@@ -0,0 +1,153 @@
+# This file is part of Franklin.
+# 
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import TestCase, mock
+import io
+import os
+import tempfile
+
+import bibtexparser
+
+from franklin import bibindex
+from franklin.bibindex import BibIndex
+
+
+def make_entry(id_, doi=None):
+    doi_line = '  doi = {{{}}},\n'.format(doi) if doi is not None else ''
+    return '@article{{{},\n{}  title = {{Hello, world}},\n}}\n'.format(id_, doi_line)
+
+
+class ParseEntriesTests(TestCase):
+    def test_matches_bibtexparser(self):
+        text = (
+            '@comment{This is not an entry}\n'
+            '@string{acs = "American Chemical Society"}\n'
+            '@article{wolfman2017,\n'
+            '  url = {https://doi.org/10.1021/acs.chemmater.6b05114},\n'
+            '  DOI = {10.1021/acs.chemmater.6b05114},\n'
+            '  publisher = acs,\n'
+            '}\n'
+            '@Book{ cabana2010 ,\n'
+            '  title = {Beyond Intercalation},\n'
+            '}\n'
+            '@inproceedings{may2018, doi = "10.1109/icip.2018.1",\n'
+            '  title = {Hello, world}}\n'
+            '  @misc{smith2020,\n'
+            '  doi={10.1000/smith}}\n'
+        )
+        entries = bibindex.parse_entries(text)
+        expected = [(e['ID'], e.get('doi')) for e in bibtexparser.loads(text).entries]
+        self.assertEqual(entries, expected)
+        self.assertEqual(entries[0], ('wolfman2017', '10.1021/acs.chemmater.6b05114'))
+        self.assertEqual(entries[1], ('cabana2010', None))
+
+
+class BibIndexTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.bibpath = os.path.join(self.tmpdir.name, 'refs.bib')
+        with open(self.bibpath, mode='w') as fp:
+            fp.write(make_entry('wolfman2017', '10.1021/acs.chemmater.6b05114'))
+            fp.write(make_entry('cabana2010'))
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def load(self):
+        with open(self.bibpath, mode='a+') as fp:
+            return BibIndex.for_file(fp)
+    
+    def test_build_index(self):
+        index = self.load()
+        self.assertEqual(index.ids, {'wolfman2017', 'cabana2010'})
+        self.assertEqual(index.find_doi('10.1021/ACS.CHEMMATER.6B05114'), ['wolfman2017'])
+        self.assertIsNone(index.find_doi('10.1000/other'))
+        self.assertTrue(os.path.exists(bibindex.sidecar_path(self.bibpath)))
+    
+    def test_reuse_sidecar(self):
+        self.load()
+        # The bibtex file shouldn't need to be parsed again
+        with mock.patch('franklin.bibindex.parse_entries') as parse_entries:
+            index = self.load()
+        parse_entries.assert_not_called()
+        self.assertEqual(index.ids, {'wolfman2017', 'cabana2010'})
+    
+    def test_appended_entries(self):
+        index = self.load()
+        with open(self.bibpath, mode='a') as fp:
+            fp.write(make_entry('may2018', '10.1000/new'))
+        # Only the new entries should be parsed
+        parse_entries = mock.MagicMock(wraps=bibindex.parse_entries)
+        with mock.patch('franklin.bibindex.parse_entries', parse_entries):
+            index = self.load()
+        parse_entries.assert_called_once()
+        self.assertNotIn('wolfman2017', parse_entries.call_args[0][0])
+        self.assertEqual(index.find_doi('10.1000/new'), ['may2018'])
+        self.assertEqual(len(index), 3)
+    
+    def test_edited_file_rebuilds(self):
+        self.load()
+        with open(self.bibpath, mode='w') as fp:
+            fp.write(make_entry('smith2020', '10.1000/smith'))
+        index = self.load()
+        self.assertEqual(index.ids, {'smith2020'})
+        self.assertIsNone(index.find_doi('10.1021/acs.chemmater.6b05114'))
+    
+    def test_corrupt_sidecar_rebuilds(self):
+        self.load()
+        with open(bibindex.sidecar_path(self.bibpath), mode='w') as fp:
+            fp.write('{"version": 1, "size"')
+        index = self.load()
+        self.assertEqual(index.ids, {'wolfman2017', 'cabana2010'})
+    
+    def test_save_after_append(self):
+        with open(self.bibpath, mode='a+') as fp:
+            index = BibIndex.for_file(fp)
+            fp.write(make_entry('may2018', '10.1000/new'))
+            fp.flush()
+            index.add('may2018', '10.1000/new')
+            index.save()
+        with mock.patch('franklin.bibindex.parse_entries') as parse_entries:
+            index = self.load()
+        parse_entries.assert_not_called()
+        self.assertIn('may2018', index.ids)
+    
+    def test_in_memory_file(self):
+        bibfile = io.StringIO(make_entry('wolfman2017', '10.1021/acs.chemmater.6b05114'))
+        index = BibIndex.for_file(bibfile)
+        self.assertEqual(index.ids, {'wolfman2017'})
+        self.assertEqual(list(index.entries()), [{'ID': 'wolfman2017'}])
+        # Nothing to save
+        index.save()
+    
+    def test_keep_in_memory(self):
+        bibindex.keep_in_memory()
+        try:
+            first = self.load()
+            # Unchanged, so the sidecar isn't read again
+            with mock.patch.object(BibIndex, '_load') as load:
+                index = self.load()
+            load.assert_not_called()
+            self.assertEqual(index.ids, {'wolfman2017', 'cabana2010'})
+            # Each caller gets its own copy
+            index.add('may2018')
+            self.assertNotIn('may2018', first.ids)
+            self.assertNotIn('may2018', self.load().ids)
+            # Changes to the file are still noticed
+            with open(self.bibpath, mode='a') as fp:
+                fp.write(make_entry('smith2020', '10.1000/smith'))
+            self.assertEqual(self.load().find_doi('10.1000/smith'), ['smith2020'])
+        finally:
+            bibindex.keep_in_memory(False)
@@ -0,0 +1,204 @@
+# This file is part of Franklin.
+# 
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import os
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from franklin import cache
+
+
+class NormalizeDOITests(TestCase):
+    def test_normalize_doi(self):
+        doi = cache.normalize_doi(' 10.1021/ACS.ChemMater.6b05114')
+        self.assertEqual(doi, '10.1021/acs.chemmater.6b05114')
+        doi = cache.normalize_doi('https://dx.doi.org/10.1021/acs.chemmater.6b05114')
+        self.assertEqual(doi, '10.1021/acs.chemmater.6b05114')
+
+
+class MetadataStoreTests(TestCase):
+    doi = '10.1021/acs.chemmater.6b05114'
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = cache.MetadataStore(directory=self.tmpdir.name, ttl=60,
+                                         max_size=1024, enabled=True)
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_put_and_get(self):
+        self.assertIs(self.store.get(self.doi), None)
+        self.store.put(self.doi, '@article{cabana2017}')
+        self.assertEqual(self.store.get(self.doi), '@article{cabana2017}')
+        # Check that DOIs are case-insensitive
+        self.assertEqual(self.store.get(self.doi.upper()), '@article{cabana2017}')
+        # Different formats are stored separately
+        self.assertIs(self.store.get(self.doi, fmt='csl-json'), None)
+    
+    def test_stale_entry(self):
+        self.store.put(self.doi, '@article{cabana2017}')
+        self.store._ttl = -1
+        self.assertIs(self.store.get(self.doi), None)
+        self.assertEqual(self.store.get(self.doi, allow_stale=True), '@article{cabana2017}')
+    
+    def test_disabled(self):
+        self.store._enabled = False
+        self.store.put(self.doi, '@article{cabana2017}')
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+        self.assertIs(self.store.get(self.doi), None)
+    
+    def test_eviction(self):
+        # Fill the store past its size limit
+        for idx in range(20):
+            self.store.put('10.1000/{}'.format(idx), 'x' * 100)
+            # Pretend each entry was used one second after the previous one
+            timestamp = time.time() - 100 + idx
+            os.utime(self.store.path('10.1000/{}'.format(idx)), (timestamp, timestamp))
+        total_size = sum(stat.st_size for path, stat in self.store._entries())
+        self.assertLessEqual(total_size, self.store.max_size)
+        # The most recent entries should be kept
+        self.assertIs(self.store.get('10.1000/0'), None)
+        self.assertEqual(self.store.get('10.1000/19'), 'x' * 100)
+
+    
+    def test_concurrent_puts(self):
+        self.store._max_size = 1024 * 1024
+        self.store.put('10.1000/first', 'x')
+        def put_many(thread):
+            for idx in range(20):
+                self.store.put('10.1000/{}-{}'.format(thread, idx), 'x' * 100)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(put_many, range(8)))
+        # No updates to the size were lost
+        total_size = sum(stat.st_size for path, stat in self.store._entries())
+        self.assertEqual(self.store._total_size, total_size)
+
+
+class AbbreviationStoreTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = cache.AbbreviationStore(path=os.path.join(self.tmpdir.name, 'abbrevs.sqlite'),
+                                             ttl=60, negative_ttl=30, enabled=True)
+    
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+    
+    def test_put_and_get(self):
+        self.assertIs(self.store.get('cassi', 'Chemistry of Materials'), None)
+        self.store.put('cassi', 'Chemistry of Materials', 'Chem. Mater.')
+        # Titles are normalized
+        self.assertEqual(self.store.get('cassi', ' chemistry  of MATERIALS'), 'Chem. Mater.')
+        # Different sources are stored separately
+        self.assertIs(self.store.get('ltwa', 'Chemistry of Materials'), None)
+    
+    def test_negative_entry(self):
+        self.store.put_negative('cassi', 'Journal of Small Papers', error='Not found')
+        with self.assertRaises(KeyError):
+            self.store.get('cassi', 'Journal of Small Papers')
+        # Negative entries expire on their own schedule
+        self.store._negative_ttl = -1
+        self.assertIs(self.store.get('cassi', 'Journal of Small Papers'), None)
+    
+    def test_stale_entry(self):
+        self.store.put('cassi', 'Chemistry of Materials', 'Chem. Mater.')
+        self.store._ttl = -1
+        self.assertIs(self.store.get('cassi', 'Chemistry of Materials'), None)
+    
+    def test_disabled(self):
+        self.store._enabled = False
+        self.store.put('cassi', 'Chemistry of Materials', 'Chem. Mater.')
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+        self.assertIs(self.store.get('cassi', 'Chemistry of Materials'), None)
+    
+    def test_stats_and_prune(self):
+        self.store.put('cassi', 'Chemistry of Materials', 'Chem. Mater.')
+        self.store.put('ltwa', 'Journal of Small Papers', 'J. Small Pap.')
+        self.store.put_negative('cassi', 'Journal of Small Papers', error='Not found')
+        self.assertEqual(self.store.stats(), {
+            'cassi': {'found': 1, 'missing': 1, 'expired': 0},
+            'ltwa': {'found': 1, 'missing': 0, 'expired': 0},
+        })
+        self.assertEqual(len(self.store.entries()), 3)
+        # Prune out-of-date entries
+        self.store._negative_ttl = -1
+        self.assertEqual(self.store.stats()['cassi']['expired'], 1)
+        self.assertEqual(self.store.prune('expired'), 1)
+        self.assertEqual(self.store.stats()['cassi'], {'found': 1, 'missing': 0, 'expired': 0})
+        # Prune one source
+        self.store.put('ltwa', 'Journal of Big Papers', 'J. Big Pap.')
+        self.assertEqual(self.store.prune('all', source='ltwa'), 2)
+        self.assertNotIn('ltwa', self.store.stats())
+        # Prune everything
+        self.store.put('ltwa', 'Journal of Small Papers', 'J. Small Pap.')
+        self.assertEqual(self.store.prune('all'), 2)
+        self.assertEqual(self.store.entries(), [])
+        with self.assertRaises(ValueError):
+            self.store.prune('everything')
+
+
+class MemoryCacheTests(TestCase):
+    def test_get_put(self):
+        mem = cache.MemoryCache(max_size=4096)
+        self.assertIsNone(mem.get(('bibtex', 'doi')))
+        mem.put(('bibtex', 'doi'), '@article{...}')
+        self.assertEqual(mem.get(('bibtex', 'doi')), '@article{...}')
+        self.assertEqual(mem.hits, 1)
+        self.assertEqual(mem.misses, 1)
+        self.assertEqual(mem.stats()['entries'], 1)
+        # Replacing an entry shouldn't count it twice
+        size = mem.size
+        mem.put(('bibtex', 'doi'), '@article{...}')
+        self.assertEqual(mem.size, size)
+    
+    def test_eviction(self):
+        value = 'x' * 1000
+        entry_size = cache._sizeof(('ltwa', 'a')) + cache._sizeof(value)
+        mem = cache.MemoryCache(max_size=3 * entry_size)
+        mem.put(('ltwa', 'a'), value)
+        mem.put(('ltwa', 'b'), value)
+        mem.put(('ltwa', 'c'), value)
+        # Using "a" means "b" is now the least recently used
+        mem.get(('ltwa', 'a'))
+        mem.put(('ltwa', 'd'), value)
+        self.assertIn(('ltwa', 'a'), mem)
+        self.assertNotIn(('ltwa', 'b'), mem)
+        self.assertIn(('ltwa', 'd'), mem)
+        self.assertLessEqual(mem.size, mem.max_size)
+        # Values larger than the whole cache aren't kept
+        mem.put(('ltwa', 'e'), value * 4)
+        self.assertNotIn(('ltwa', 'e'), mem)
+        self.assertEqual(len(mem), 3)
+    
+    def test_discard(self):
+        mem = cache.MemoryCache(max_size=4096)
+        mem.put(('ltwa', 'a'), 'A.')
+        mem.put(('cassi', 'a'), 'A.')
+        mem.discard('ltwa')
+        self.assertNotIn(('ltwa', 'a'), mem)
+        self.assertIn(('cassi', 'a'), mem)
+        self.assertEqual(mem.size, cache._sizeof(('cassi', 'a')) + cache._sizeof('A.'))
+    
+    def test_clear(self):
+        mem = cache.MemoryCache(max_size=4096)
+        mem.put('key', 'value')
+        mem.get('key')
+        mem.clear()
+        self.assertEqual(mem.stats()['entries'], 0)
+        self.assertEqual(mem.size, 0)
+        self.assertEqual(mem.hits, 0)
@@ -0,0 +1,44 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+import subprocess
+from pathlib import Path
+
+from franklin.config import FranklinConfig
+
+
+root_dir = Path(__file__).parent.parent
+
+
+def test_set_defaults():
+    config = FranklinConfig()
+    config.read_string("[fetch_doi]\nbibtex_file = /tmp/mine.bib\n")
+    config.set_defaults('fetch_doi', {'bibtex_file': './refs.bib', 'pdf_dir': './papers/'})
+    assert config['fetch_doi']['bibtex_file'] == '/tmp/mine.bib'
+    assert config['fetch_doi']['pdf_dir'] == './papers/'
+
+
+def test_import_keeps_settings():
+    # franklind imports the command modules after reading the config file
+    code = ("from franklin.config import franklin_config as config\n"
+            "config.read_string('[fetch_doi]\\nbibtex_file = /tmp/mine.bib\\n"
+            "[ltwa]\\noffline = yes\\n[retry]\\nmax_attempts = 1\\n')\n"
+            "import franklin.fetch_doi, franklin.journals, franklin.daemon\n"
+            "assert config['fetch_doi']['bibtex_file'] == '/tmp/mine.bib'\n"
+            "assert config['ltwa']['offline'] == 'yes'\n"
+            "assert config['retry']['max_attempts'] == '1'\n"
+            "assert config['fetch_doi']['pdf_dir'] == './papers/'\n")
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=root_dir)
@@ -0,0 +1,114 @@
+# This file is part of Franklin.
+# 
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import TestCase, mock
+import os
+import gzip
+import json
+import tempfile
+
+from franklin import crossref, sessions, Article
+from franklin.config import franklin_config as config
+
+
+def make_work(doi, family='Wolfman', year=2017, **kwargs):
+    work = {
+        'DOI': doi,
+        'type': 'journal-article',
+        'title': ['A Paper about {}'.format(doi)],
+        'author': [{'given': 'Mark', 'family': family, 'sequence': 'first',
+                    'affiliation': [{'name': 'Argonne National Laboratory'}]}],
+        'container-title': ['Chemistry of Materials'],
+        'publisher': 'American Chemical Society (ACS)',
+        'issued': {'date-parts': [[year, 3]]},
+        'reference': [{'key': 'ref1', 'unstructured': 'Something else'}],
+    }
+    work.update(kwargs)
+    return work
+
+
+class CrossrefSnapshotTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dump_dir = os.path.join(self.tmpdir.name, 'dump')
+        self.snapshot_dir = os.path.join(self.tmpdir.name, 'snapshot')
+        os.mkdir(self.dump_dir)
+        self.works = [make_work('10.1021/acs.chemmater.6b{:05d}'.format(i)) for i in range(20)]
+        self.write_dump('0.jsonl.gz', self.works[:12] + [{'title': ['No DOI']}])
+        # A newer copy of one of the works in a later file
+        updated = make_work('10.1021/acs.chemmater.6b00003', year=2018)
+        self.write_dump('1.jsonl.gz', self.works[12:] + [updated])
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def write_dump(self, name, works):
+        with gzip.open(os.path.join(self.dump_dir, name), mode='wt', encoding='utf-8') as fp:
+            for work in works:
+                fp.write(json.dumps(work) + '\n')
+    
+    def test_build_and_lookup(self):
+        # A small run size forces the sorted runs to be merged
+        count = crossref.build_snapshot([self.dump_dir], self.snapshot_dir, run_size=3)
+        self.assertEqual(count, 21)
+        with crossref.CrossrefSnapshot(self.snapshot_dir) as snapshot:
+            self.assertEqual(len(snapshot), 21)
+            for work in self.works:
+                found = snapshot.get(work['DOI'])
+                self.assertEqual(found['DOI'], work['DOI'])
+                # Unused fields aren't kept
+                self.assertNotIn('reference', found)
+                self.assertNotIn('affiliation', found['author'][0])
+            # DOIs are case-insensitive
+            self.assertIsNotNone(snapshot.get('https://doi.org/10.1021/ACS.CHEMMATER.6B00001'))
+            self.assertIsNone(snapshot.get('10.1021/not-a-real-doi'))
+            # The newer copy should be used
+            record = snapshot.record('10.1021/acs.chemmater.6b00003')
+        self.assertEqual(record.year, '2018')
+        self.assertEqual(record.authors, ['Wolfman, Mark'])
+        self.assertEqual(record.journal, 'Chemistry of Materials')
+        self.assertEqual(record.entry_type, 'article')
+        self.assertEqual(record.default_id(), 'wolfman2018')
+    
+    def test_hash_collisions(self):
+        # Pretend every DOI has the same hash
+        with mock.patch('franklin.crossref.doi_hash', return_value=b'\x00' * 8):
+            crossref.build_snapshot([self.dump_dir], self.snapshot_dir)
+            with crossref.CrossrefSnapshot(self.snapshot_dir) as snapshot:
+                work = snapshot.get('10.1021/acs.chemmater.6b00007')
+        self.assertEqual(work['DOI'], '10.1021/acs.chemmater.6b00007')
+    
+    def test_article_uses_snapshot(self):
+        crossref.build_snapshot([self.dump_dir], self.snapshot_dir)
+        session = mock.MagicMock()
+        config['crossref']['snapshot'] = self.snapshot_dir
+        try:
+            with mock.patch.object(sessions.session_manager, '_session', session):
+                article = Article(doi='10.1021/acs.chemmater.6b00005')
+                article.prefetch(url=False)
+                bibtex = article.bibtex()
+        finally:
+            config['crossref']['snapshot'] = ''
+        # No network requests should have been made
+        session.request.assert_not_called()
+        self.assertIn('wolfman2017', bibtex)
+        self.assertIn('10.1021/acs.chemmater.6b00005', bibtex)
+    
+    def test_cli(self):
+        with mock.patch('franklin.crossref.config.read'), \
+             mock.patch('builtins.print') as print_:
+            crossref.index_crossref_cli([self.dump_dir, '-o', self.snapshot_dir])
+        print_.assert_called_once_with('Indexed 21 works into {}'.format(self.snapshot_dir))
+        self.assertTrue(os.path.exists(os.path.join(self.snapshot_dir, 'index.bin')))
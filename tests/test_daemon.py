@@ -0,0 +1,186 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import mock
+from pathlib import Path
+import os
+import sys
+import time
+import socket
+import threading
+import subprocess
+
+import pytest
+
+from franklin import daemon, exceptions, fetch_doi, journals
+from franklin.config import franklin_config as config
+from franklin.version import __version__
+
+
+root_dir = Path(__file__).parent.parent
+
+
+@pytest.fixture()
+def socket_path(tmp_path):
+    path = tmp_path / 'franklind.sock'
+    old_config = dict(config['daemon'])
+    config['daemon'].update({'socket': str(path), 'enabled': 'yes'})
+    try:
+        yield path
+    finally:
+        config['daemon'].update(old_config)
+
+
+@pytest.fixture()
+def server(socket_path):
+    server = daemon.FranklinServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    with daemon.capture_output():
+        thread.start()
+        try:
+            yield server
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+def test_not_running(socket_path):
+    with pytest.raises(exceptions.DaemonUnavailable):
+        daemon.submit('ping')
+
+
+def test_ping(server):
+    assert daemon.submit('ping') == __version__
+    # The socket is private to this user
+    assert os.stat(server.path).st_mode & 0o077 == 0
+
+
+def test_unknown_command(server):
+    with pytest.raises(exceptions.DaemonError):
+        daemon.submit('make-coffee')
+
+
+def test_output_and_result(server, capsys):
+    def run_fetch_doi(args):
+        print("Saved entry as", args.bibtex_id)
+        return 3
+    with mock.patch('franklin.fetch_doi.run_fetch_doi', new=run_fetch_doi):
+        result = fetch_doi.main(['10.1000/first', '--bibtex-id', 'wolfman2017'])
+    assert result == 3
+    assert capsys.readouterr().out == "Saved entry as wolfman2017\n"
+
+
+def test_paths_made_absolute(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    received = []
+    with mock.patch('franklin.fetch_doi.run_fetch_doi', new=received.append):
+        fetch_doi.main(['10.1000/first', '--bibtex-file', 'refs.bib', '--pdf-dir', 'papers'])
+    args, = received
+    assert args.bibfile == str(tmp_path / 'refs.bib')
+    assert args.pdf_dir == str(tmp_path / 'papers')
+    assert args.doi_file is None
+
+
+def test_default_paths_from_client(socket_path, tmp_path, monkeypatch):
+    # A daemon running from a different directory
+    daemon_dir = tmp_path / 'daemon'
+    client_dir = tmp_path / 'client'
+    daemon_dir.mkdir()
+    client_dir.mkdir()
+    (daemon_dir / 'refs.bib').write_text('')
+    env = dict(os.environ, PYTHONPATH=str(root_dir))
+    code = "import sys; from franklin.daemon import main; sys.exit(main(sys.argv[1:]))"
+    process = subprocess.Popen(
+        [sys.executable, '-c', code, '--socket', str(socket_path), '--no-warm-up'],
+        cwd=daemon_dir, env=env, stderr=subprocess.DEVNULL)
+    try:
+        for i in range(100):
+            try:
+                daemon.submit('ping')
+            except exceptions.DaemonUnavailable:
+                time.sleep(0.1)
+            else:
+                break
+        monkeypatch.chdir(client_dir)
+        old_config = dict(config['fetch_doi'])
+        config['fetch_doi'].update({'bibtex_file': './refs.bib', 'pdf_dir': './papers/'})
+        try:
+            # The config file's paths are relative to the client
+            with pytest.raises(exceptions.BibtexFileNotFoundError) as excinfo:
+                fetch_doi.main(['10.1000/first', '--no-pdf'])
+            assert str(client_dir / 'refs.bib') in str(excinfo.value)
+            (client_dir / 'refs.bib').write_text('')
+            with pytest.raises(exceptions.BibtexFileNotFoundError) as excinfo:
+                fetch_doi.main(['10.1000/first'])
+            assert str(client_dir / 'papers') in str(excinfo.value)
+        finally:
+            config['fetch_doi'].update(old_config)
+        daemon.submit('shutdown')
+        process.wait(timeout=10)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def test_error_raised_in_client(server, tmp_path):
+    bibfile = tmp_path / 'refs.bib'
+    bibfile.write_text('')
+    (tmp_path / 'refs-abbrev.bib').write_text('')
+    with pytest.raises(exceptions.FileExistsError):
+        journals.abbreviate_journals_cli([str(bibfile)])
+
+
+def test_disabled(server):
+    config['daemon']['enabled'] = 'no'
+    received = []
+    with mock.patch('franklin.fetch_doi.run_fetch_doi', new=received.append):
+        fetch_doi.main(['10.1000/first'])
+    # Called directly in this thread, not through the daemon
+    assert received[0].use_daemon is True
+
+
+def test_no_daemon(server):
+    received = []
+    with mock.patch('franklin.fetch_doi.run_fetch_doi', new=received.append):
+        fetch_doi.main(['10.1000/first', '--no-daemon'])
+    # Called directly in this thread, not through the daemon
+    assert received[0].use_daemon is False
+
+
+def test_shutdown(socket_path):
+    server = daemon.FranklinServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    daemon.submit('shutdown')
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    server.server_close()
+    assert not socket_path.exists()
+
+
+def test_stale_socket(socket_path):
+    # A socket file left behind by a server that crashed
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(socket_path))
+    stale.close()
+    server = daemon.FranklinServer(socket_path)
+    try:
+        # Only one server at a time
+        with pytest.raises(exceptions.DaemonError):
+            daemon.FranklinServer(socket_path)
+    finally:
+        server.server_close()
@@ -14,13 +14,51 @@
 # along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
 
 from pathlib import Path
-from unittest import TestCase
+from unittest import TestCase, mock
 import io
 import os
 import shutil
+import time
+import tempfile
+import random
+import multiprocessing
 
 import pytest
-from franklin import fetch_doi, exceptions
+import bibtexparser
+
+from franklin import fetch_doi, exceptions, publishers
+from franklin.bibindex import BibIndex, sidecar_path
+from franklin.locking import lock_file
+
+
+class FakeArticle():
+    """Stands in for an article without touching the network."""
+    def __init__(self, doi):
+        self.doi = doi
+    
+    def prefetch(self, url=True):
+        pass
+    
+    def default_id(self):
+        return 'wolfman2017'
+    
+    def bibtex(self, id):
+        return '@article{{{},\n  doi = {{{}}},\n}}\n'.format(id, self.doi)
+    
+    def get_publisher(self):
+        return publishers.get_publisher_by_doi(self.doi)
+    
+    def download_pdf(self, fp, max_size=None):
+        if 'nopdf' in self.doi:
+            raise exceptions.PDFNotFoundError("No PDF for {}".format(self.doi))
+        fp.write(b'%PDF-1.5\n%%EOF')
+
+
+class SlowArticle(FakeArticle):
+    """A fake article whose metadata arrive in an unpredictable order."""
+    def default_id(self):
+        time.sleep(random.uniform(0, 0.02))
+        return super().default_id()
 
 
 class IsDuplicateTests(TestCase):
@@ -82,6 +120,59 @@ class ValidateIDTest(TestCase):
         self.assertEqual(new_id, 'wolf2017-3') 
 
 
+class IDAllocatorTests(TestCase):
+    def test_allocate(self):
+        allocator = fetch_doi.IDAllocator.from_sources(
+            pdfs=['wang2020.pdf', 'wang2020-2.pdf', 'other.pdf.part'],
+            bibtex_ids=['wang2020-3', 'wolf2017'])
+        self.assertEqual(allocator.peek('smith2019'), 'smith2019')
+        self.assertEqual(allocator.allocate('wang2020'), 'wang2020-4')
+        self.assertEqual(allocator.allocate('wang2020'), 'wang2020-5')
+        self.assertEqual(allocator.allocate('wolf2017'), 'wolf2017-2')
+        # Partial downloads don't hold on to an ID
+        self.assertEqual(allocator.allocate('other'), 'other')
+        self.assertIn('wang2020-5', allocator)
+    
+    def test_many_collisions(self):
+        taken = ['wang2020'] + ['wang2020-{}'.format(i) for i in range(2, 1000)]
+        allocator = fetch_doi.IDAllocator(taken)
+        self.assertEqual(allocator.allocate('wang2020'), 'wang2020-1000')
+        # The next suffix is remembered, instead of checking them all again
+        checked = []
+        class CountingSet(set):
+            def __contains__(self, item):
+                checked.append(item)
+                return super().__contains__(item)
+        allocator.taken = CountingSet(allocator.taken)
+        self.assertEqual(allocator.allocate('wang2020'), 'wang2020-1001')
+        self.assertLess(len(checked), 5)
+
+    
+    def test_for_index(self):
+        with tempfile.TemporaryDirectory() as pdf_dir:
+            open(os.path.join(pdf_dir, 'wang2020-2.pdf'), mode='w').close()
+            index = BibIndex()
+            index.add('wang2020')
+            with mock.patch('os.listdir') as listdir:
+                allocator = fetch_doi.IDAllocator.for_index(index, pdf_dir=pdf_dir)
+                self.assertEqual(allocator.allocate('wang2020'), 'wang2020-3')
+            listdir.assert_not_called()
+            # Later allocators for the same index carry on from the last suffix
+            index.add('wang2020-3')
+            allocator = fetch_doi.IDAllocator.for_index(index.copy(), pdf_dir=pdf_dir)
+            checked = []
+            class CountingSet(set):
+                def __contains__(self, item):
+                    checked.append(item)
+                    return super().__contains__(item)
+            allocator.taken = CountingSet(allocator.taken)
+            self.assertEqual(allocator.allocate('wang2020'), 'wang2020-4')
+            self.assertNotIn('wang2020-2', checked)
+        # The PDF directory doesn't have to exist
+        allocator = fetch_doi.IDAllocator.for_index(index, pdf_dir='/nonexistent/papers')
+        self.assertEqual(allocator.peek('smith2019'), 'smith2019')
+
+
 class AddBibtexEntryTests(TestCase):
     def test_add_valid_entry(self):
         bibfile = io.StringIO()
@@ -141,6 +232,8 @@ def bibtex_file():
         yield bibpath
     finally:
         bibpath.unlink()
+        sidecar_path(bibpath).unlink(missing_ok=True)
+        bibpath.with_name('.{}.lock'.format(bibpath.name)).unlink(missing_ok=True)
         paper_path.rmdir()
 
 
@@ -180,3 +273,189 @@ class ParseDOITests(TestCase):
         with self.assertRaises(exceptions.DOIError):
             fetch_doi.parse_doi('hello')
 
+
+@mock.patch('franklin.fetch_doi.Article', new=FakeArticle)
+def test_fetch_dois(tmp_path):
+    bibfile = io.StringIO('@article{wolfman2017,\n'
+                          '  doi = {10.1021/acs.chemmater.6b05114},\n'
+                          '}\n')
+    dois = ['10.1000/first', '10.1021/ACS.CHEMMATER.6B05114',
+            'https://doi.org/10.1000/second', '10.1000/first', 'gibberish']
+    results = fetch_doi.fetch_dois(dois, bibfile=bibfile, pdf_dir=tmp_path)
+    # Check that the right entries succeeded
+    assert [r.id for r in results] == ['wolfman2017-2', None, 'wolfman2017-3', None, None]
+    assert [r.succeeded for r in results] == [True, False, True, False, False]
+    assert isinstance(results[1].error, exceptions.DuplicateDOIError)
+    assert isinstance(results[3].error, exceptions.DuplicateDOIError)
+    assert isinstance(results[4].error, exceptions.DOIError)
+    # Check that the new entries were saved
+    bibfile.seek(0)
+    bibdb = bibtexparser.loads(bibfile.read())
+    assert [e['ID'] for e in bibdb.entries] == ['wolfman2017', 'wolfman2017-2', 'wolfman2017-3']
+    assert sorted(os.listdir(tmp_path)) == ['wolfman2017-2.pdf', 'wolfman2017-3.pdf']
+
+
+@mock.patch('franklin.fetch_doi.Article', new=SlowArticle)
+def test_fetch_dois_concurrent(tmp_path):
+    bibfile = io.StringIO()
+    dois = ['10.1000/{}'.format(idx) for idx in range(10)]
+    dois[3] = '10.1000/nopdf'
+    results = fetch_doi.fetch_dois(dois, bibfile=bibfile, pdf_dir=tmp_path, workers=4)
+    # IDs should be allocated in the order requested
+    expected_ids = ['wolfman2017'] + ['wolfman2017-{}'.format(idx) for idx in range(2, 11)]
+    expected_ids[3] = None
+    assert [r.id for r in results] == expected_ids
+    assert isinstance(results[3].error, exceptions.PDFNotFoundError)
+    # Only the successful entries should be saved
+    bibfile.seek(0)
+    bibdb = bibtexparser.loads(bibfile.read())
+    assert [e['doi'] for e in bibdb.entries] == [d for d in dois if d != '10.1000/nopdf']
+    assert len(os.listdir(tmp_path)) == 9
+
+
+class InterruptedArticle(FakeArticle):
+    """A fake article whose download gets cut short the first time."""
+    def download_pdf(self, fp, max_size=None):
+        offset = fp.seek(0, os.SEEK_END)
+        if offset == 0:
+            fp.write(b'%PDF-1.5\nfirst half ')
+            raise ConnectionError("Connection reset")
+        fp.write(b'second half\n%%EOF')
+
+
+def test_resume_pdf(tmp_path):
+    article = InterruptedArticle(doi='10.1000/first')
+    with pytest.raises(ConnectionError):
+        fetch_doi._save_pdf(article, pdf_dir=tmp_path, new_id='wolfman2017')
+    # The partial download should be kept for next time
+    assert os.listdir(tmp_path) == ['wolfman2017.pdf.part']
+    fetch_doi._save_pdf(article, pdf_dir=tmp_path, new_id='wolfman2017')
+    assert os.listdir(tmp_path) == ['wolfman2017.pdf']
+    assert (tmp_path / 'wolfman2017.pdf').read_bytes() == b'%PDF-1.5\nfirst half second half\n%%EOF'
+
+
+class CaptchaArticle(FakeArticle):
+    """A fake article whose publisher answers with a captcha."""
+    def download_pdf(self, fp, max_size=None):
+        raise exceptions.InvalidPDFError("Captcha")
+
+
+def test_captcha_keeps_partial_pdf(tmp_path):
+    partfile = tmp_path / 'wolfman2017.pdf.part'
+    partfile.write_bytes(b'%PDF-1.5\nfirst half ')
+    with pytest.raises(exceptions.InvalidPDFError):
+        fetch_doi._save_pdf(CaptchaArticle(doi='10.1000/first'), pdf_dir=tmp_path,
+                            new_id='wolfman2017')
+    assert partfile.read_bytes() == b'%PDF-1.5\nfirst half '
+
+
+def test_invalid_pdf_not_kept(tmp_path):
+    article = FakeArticle(doi='10.1000/nopdf')
+    with pytest.raises(exceptions.PDFNotFoundError):
+        fetch_doi._save_pdf(article, pdf_dir=tmp_path, new_id='wolfman2017')
+    assert os.listdir(tmp_path) == []
+
+
+@mock.patch('franklin.fetch_doi.Article', new=FakeArticle)
+def test_fetch_doi_without_pdf_dir(tmp_path):
+    with mock.patch('os.listdir', side_effect=AssertionError("Listed the PDF directory")):
+        new_id = fetch_doi.fetch_doi('10.1000/first', bibfile=io.StringIO(),
+                                     pdf_dir=tmp_path / 'missing', retrieve_pdf=False)
+    assert new_id == 'wolfman2017'
+
+
+def test_read_doi_file():
+    fp = io.StringIO("10.1000/first\n\n# A comment\n  10.1000/second  \n")
+    assert fetch_doi.read_doi_file(fp) == ['10.1000/first', '10.1000/second']
+
+
+@mock.patch('franklin.fetch_doi.Article', new=FakeArticle)
+def test_main_from_file(bibtex_file, tmp_path):
+    doi_file = tmp_path / "dois.txt"
+    doi_file.write_text("10.1000/first\n10.1000/second\n")
+    result = fetch_doi.main(['--from-file', str(doi_file), "--bibtex-file", str(bibtex_file),
+                             "--pdf-dir", str(tmp_path), "--no-pdf"])
+    assert result == 0
+    bibdb = bibtexparser.loads(bibtex_file.read_text())
+    assert [e['ID'] for e in bibdb.entries] == ['wolfman2017', 'wolfman2017-2']
+
+
+@mock.patch('franklin.fetch_doi.Article', new=FakeArticle)
+def test_fetch_dois_updates_index(tmp_path):
+    bibpath = tmp_path / 'refs.bib'
+    bibpath.write_text('@article{wolfman2017,\n'
+                       '  doi = {10.1021/acs.chemmater.6b05114},\n'
+                       '}\n')
+    with open(bibpath, mode='a+') as bibfile:
+        fetch_doi.fetch_dois(['10.1000/first', '10.1000/nopdf'], bibfile=bibfile, pdf_dir=tmp_path)
+    # The index should already know about the new entry
+    with open(bibpath, mode='a+') as bibfile, \
+         mock.patch('franklin.bibindex.parse_entries') as parse_entries:
+        index = BibIndex.for_file(bibfile)
+    parse_entries.assert_not_called()
+    assert index.ids == {'wolfman2017', 'wolfman2017-2'}
+    assert index.find_doi('10.1000/first') == ['wolfman2017-2']
+
+
+def test_pdf_in_progress(tmp_path):
+    """Another process is downloading a PDF with the same ID."""
+    partfile = tmp_path / 'wolfman2017.pdf.part'
+    with open(partfile, mode='wb') as fp:
+        lock_file(fp)
+        with pytest.raises(exceptions.PDFInProgressError):
+            fetch_doi._save_pdf(FakeArticle('10.1000/first'), pdf_dir=tmp_path, new_id='wolfman2017')
+        # Batch retrieval should pick the next ID instead
+        with mock.patch('franklin.fetch_doi.Article', new=FakeArticle):
+            results = fetch_doi.fetch_dois(['10.1000/first'], bibfile=io.StringIO(), pdf_dir=tmp_path)
+    assert results[0].id == 'wolfman2017-2'
+    assert sorted(os.listdir(tmp_path)) == ['wolfman2017-2.pdf', 'wolfman2017.pdf.part']
+
+
+class RacingArticle(FakeArticle):
+    """Another process adds an entry while this article downloads."""
+    def download_pdf(self, fp, max_size=None):
+        with open(self.bibpath, mode='a') as bibfp:
+            bibfp.write('\n@article{wolfman2017,\n  doi = {10.1000/other},\n}\n')
+        super().download_pdf(fp, max_size=max_size)
+
+
+def test_id_taken_while_downloading(tmp_path):
+    bibpath = tmp_path / 'refs.bib'
+    bibpath.write_text(' ')
+    pdf_dir = tmp_path / 'papers'
+    pdf_dir.mkdir()
+    RacingArticle.bibpath = bibpath
+    with mock.patch('franklin.fetch_doi.Article', new=RacingArticle), \
+         open(bibpath, mode='a+') as bibfile:
+        new_id = fetch_doi.fetch_doi('10.1000/first', bibfile=bibfile, pdf_dir=pdf_dir)
+    assert new_id == 'wolfman2017-2'
+    assert os.listdir(pdf_dir) == ['wolfman2017-2.pdf']
+    bibdb = bibtexparser.loads(bibpath.read_text())
+    assert [e['ID'] for e in bibdb.entries] == ['wolfman2017', 'wolfman2017-2']
+
+
+def _fetch_in_process(dois, bibpath, pdf_dir):
+    with mock.patch('franklin.fetch_doi.Article', new=FakeArticle), \
+         open(bibpath, mode='a+') as bibfile:
+        fetch_doi.fetch_dois(dois, bibfile=bibfile, pdf_dir=pdf_dir)
+
+
+def test_parallel_processes(tmp_path):
+    bibpath = tmp_path / 'refs.bib'
+    bibpath.write_text(' ')
+    ctx = multiprocessing.get_context('fork')
+    processes = [ctx.Process(target=_fetch_in_process,
+                             args=(['10.1000/{}-{}'.format(p, i) for i in range(5)], bibpath, tmp_path))
+                 for p in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+    # Every entry should have its own ID and PDF
+    bibdb = bibtexparser.loads(bibpath.read_text())
+    ids = [e['ID'] for e in bibdb.entries]
+    assert len(ids) == 20
+    assert len(set(ids)) == 20
+    pdfs = [f for f in os.listdir(tmp_path) if f.endswith('.pdf')]
+    assert sorted(pdfs) == sorted('{}.pdf'.format(i) for i in ids)
@@ -0,0 +1,98 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Keep the command line scripts quick to start.
+
+Which modules get imported is always checked. Import times depend on
+the machine, so they are only checked against their budgets if the
+``FRANKLIN_CHECK_IMPORT_TIME`` environment variable is set.
+
+"""
+
+import os
+import sys
+import subprocess
+from pathlib import Path
+
+import pytest
+
+
+root_dir = Path(__file__).parent.parent
+
+# Slow to import, so they should only be loaded when first needed
+heavy_modules = ['pandas', 'numpy', 'tqdm', 'titlecase', 'bibtexparser']
+
+# The module behind each console script, and how long importing it
+# may take (seconds)
+entry_points = {
+    'fetch-doi': ('franklin.fetch_doi', 0.5),
+    'abbreviate-journals': ('franklin.journals', 0.5),
+    'dedupe-notes': ('franklin.orgmode', 0.25),
+    'index-crossref': ('franklin.crossref', 0.5),
+    'update-ltwa': ('franklin.ltwa', 0.5),
+    'franklind': ('franklin.daemon', 0.5),
+}
+
+measure_import = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(' '.join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def import_module(module):
+    """Import *module* in a fresh interpreter.
+
+    Returns
+    =======
+    duration : float
+      How long the import took, in seconds.
+    loaded : list
+      Which of the heavy modules were imported along the way.
+
+    """
+    code = measure_import.format(module=module, heavy=heavy_modules)
+    output = subprocess.run([sys.executable, '-c', code], check=True, cwd=root_dir,
+                            capture_output=True, text=True).stdout
+    duration, loaded = output.split('\n')[:2]
+    return float(duration), loaded.split()
+
+
+@pytest.mark.parametrize('script', entry_points)
+def test_no_heavy_imports(script):
+    module, budget = entry_points[script]
+    duration, loaded = import_module(module)
+    assert loaded == []
+
+
+@pytest.mark.skipif(not os.environ.get('FRANKLIN_CHECK_IMPORT_TIME'),
+                    reason="set FRANKLIN_CHECK_IMPORT_TIME to check import times")
+@pytest.mark.parametrize('script', entry_points)
+def test_import_budget(script):
+    module, budget = entry_points[script]
+    # Use the fastest of a few tries, to reduce noise
+    duration = min(import_module(module)[0] for i in range(3))
+    print("{}: {:.0f} ms (budget {:.0f} ms)".format(script, duration * 1000, budget * 1000))
+    assert duration < budget
+
+
+def test_lazy_package_attributes():
+    code = ("import sys, franklin\n"
+            "assert 'franklin.journals' not in sys.modules\n"
+            "assert franklin.abbreviate_bibtex_journals.__module__ == 'franklin.journals'\n"
+            "assert franklin.Article.__module__ == 'franklin.article'\n")
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=root_dir)
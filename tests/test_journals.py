@@ -18,11 +18,15 @@ from unittest import TestCase, mock
 import io
 import os
 import re
+import tempfile
+import threading
+import time
 
 import bibtexparser
 import pandas as pd
+import requests
 
-from franklin import journals
+from franklin import journals, cache, exceptions
 
 
 class JournalTests(TestCase):
@@ -74,6 +78,59 @@ class JournalTests(TestCase):
         bibdb = bibtexparser.load(out_file)
         self.assertEqual(bibdb.entries[1]['journal'], 'J. Sm. Papers')
 
+    def test_concurrent_lookups(self):
+        bib_in = ''.join('@article{{paper{i}, journal = {{Journal {j}}}}}\n'.format(i=i, j=i % 5)
+                         for i in range(20))
+        lock = threading.Lock()
+        looked_up = []
+        running = []
+        most_running = [0]
+        
+        class SlowCassi():
+            def __getitem__(self, journal):
+                with lock:
+                    looked_up.append(journal)
+                    running.append(journal)
+                time.sleep(0.05)
+                with lock:
+                    most_running[0] = max(most_running[0], len(running))
+                    running.remove(journal)
+                return 'J. {}'.format(journal.split()[-1])
+        
+        out_file = io.StringIO()
+        journals.abbreviate_journal.cache_clear()
+        self.addCleanup(journals.abbreviate_journal.cache_clear)
+        with mock.patch('franklin.journals.cassi', new=SlowCassi()):
+            journals.abbreviate_bibtex_journals(bibfile=io.StringIO(bib_in), output=out_file,
+                                                use_native=False, use_cassi=True,
+                                                use_ltwa=False, workers=5)
+        # Each journal is looked up once, several at the same time
+        self.assertEqual(sorted(looked_up), ['journal {}'.format(j) for j in range(5)])
+        self.assertGreater(most_running[0], 1)
+        out_file.seek(0)
+        bibdb = bibtexparser.load(out_file)
+        self.assertEqual({e['ID']: e['journal'] for e in bibdb.entries},
+                         {'paper{}'.format(i): 'J. {}'.format(i % 5) for i in range(20)})
+    
+    def test_many_journals_looked_up_once(self):
+        # More distinct journals than abbreviate_journal's cache can hold
+        bib_in = ''.join('@article{{paper{i}, journal = {{Journal {i}}}}}\n'.format(i=i)
+                         for i in range(300))
+        looked_up = []
+        
+        class CountingCassi():
+            def __getitem__(self, journal):
+                looked_up.append(journal)
+                raise KeyError(journal)
+        
+        journals.abbreviate_journal.cache_clear()
+        self.addCleanup(journals.abbreviate_journal.cache_clear)
+        with mock.patch('franklin.journals.cassi', new=CountingCassi()):
+            journals.abbreviate_bibtex_journals(bibfile=io.StringIO(bib_in), output=io.StringIO(),
+                                                use_native=False, use_cassi=True,
+                                                use_ltwa=False, workers=8)
+        self.assertEqual(len(looked_up), 300)
+    
     def test_latex_aux_file(self):
         bibfile = io.StringIO(self.bib_in)
         out_file = io.StringIO()
@@ -124,6 +181,137 @@ class JournalTests(TestCase):
         self.assertTrue(abbreviate_bibtex_journals.call_args[1]['use_cassi'])
 
 
+def cassi_response(text, url=journals.CassiSession.search_url, status_code=200):
+    response = mock.MagicMock()
+    response.text = text
+    response.content = text.encode('utf-8')
+    response.url = url
+    response.status_code = status_code
+    response.cookies.get_dict.return_value = {'JSESSIONID': 'abc123'}
+    return response
+
+
+class CassiSessionTests(TestCase):
+    terms_page = '<form><input type="hidden" name="c" value="{}"></form>'
+    results_page = ('<tr><td class="name">Abbreviated Title</td>'
+                    '<td class="value">Chem. Mater.</td></tr>')
+    
+    def setUp(self):
+        self.codes = iter(['code1', 'code2'])
+        get = mock.patch('franklin.sessions.get',
+                         side_effect=lambda *args, **kwargs: cassi_response(
+                             self.terms_page.format(next(self.codes)),
+                             url=journals.CassiSession.terms_url))
+        self.get = get.start()
+        self.addCleanup(get.stop)
+        self.session = journals.CassiSession()
+        self.cassi = journals.CassiAbbreviation(session=self.session)
+    
+    def test_code_reused(self):
+        with mock.patch('franklin.sessions.post',
+                        return_value=cassi_response(self.results_page)) as post:
+            self.assertEqual(self.cassi.search('Chemistry of Materials'), 'Chem. Mater.')
+            self.assertEqual(self.cassi.search('Chemistry of Materials'), 'Chem. Mater.')
+        # Only one trip to the terms of service
+        self.assertEqual(self.get.call_count, 1)
+        self.assertEqual(post.call_count, 2)
+        data = post.call_args[1]['data']
+        self.assertEqual(data['c'], 'code1')
+        self.assertEqual(data['searchFor'], 'Chemistry of Materials')
+        self.assertEqual(post.call_args[1]['cookies'],
+                         {'UserAccepted': 'YES', 'JSESSIONID': 'abc123'})
+    
+    def test_rejected_code_refreshed(self):
+        rejected = cassi_response(self.terms_page.format('code2'), url=journals.CassiSession.terms_url)
+        responses = [cassi_response(self.results_page), rejected, cassi_response(self.results_page)]
+        with mock.patch('franklin.sessions.post', side_effect=responses) as post:
+            self.cassi.search('Chemistry of Materials')
+            self.assertEqual(self.cassi.search('Chemistry of Materials'), 'Chem. Mater.')
+        self.assertEqual(self.get.call_count, 2)
+        self.assertEqual([c[1]['data']['c'] for c in post.call_args_list],
+                         ['code1', 'code1', 'code2'])
+    
+    def test_always_rejected(self):
+        rejected = cassi_response('Forbidden', status_code=403)
+        with mock.patch('franklin.sessions.post', return_value=rejected):
+            with self.assertRaises(exceptions.CassiTermsError):
+                self.cassi.search('Chemistry of Materials')
+        self.assertEqual(self.get.call_count, 2)
+
+
+class AbbreviationCacheTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        store = cache.AbbreviationStore(path=os.path.join(self.tmpdir.name, 'abbrevs.sqlite'),
+                                        enabled=True)
+        patches = [
+            mock.patch('franklin.journals.abbreviation_store', new=store),
+            mock.patch('franklin.journals.memory_cache', new=cache.MemoryCache()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(store.close)
+        self.addCleanup(self.tmpdir.cleanup)
+    
+    def test_cassi_saved(self):
+        cassi = journals.CassiAbbreviation()
+        with mock.patch.object(cassi, 'search', return_value='Chem. Mater.') as search:
+            self.assertEqual(cassi['Chemistry of Materials'], 'Chem. Mater.')
+            # A new process would start with an empty memory cache
+            journals.memory_cache.clear()
+            self.assertEqual(cassi['Chemistry of Materials'], 'Chem. Mater.')
+        search.assert_called_once()
+    
+    def test_cassi_miss_saved(self):
+        cassi = journals.CassiAbbreviation()
+        error = exceptions.CassiError("Could not parse single hit")
+        with mock.patch.object(cassi, 'search', side_effect=error) as search:
+            with self.assertRaises(exceptions.CassiError):
+                cassi['Journal of Small Papers']
+            # The failed lookup is not repeated
+            with self.assertRaises(KeyError):
+                cassi['Journal of Small Papers']
+        search.assert_called_once()
+    
+    def test_connection_errors_not_saved(self):
+        cassi = journals.CassiAbbreviation()
+        error = requests.exceptions.ConnectionError()
+        with mock.patch.object(cassi, 'search', side_effect=error) as search:
+            for i in range(2):
+                with self.assertRaises(requests.exceptions.ConnectionError):
+                    cassi['Journal of Small Papers']
+        self.assertEqual(search.call_count, 2)
+    
+    def test_terms_errors_not_saved(self):
+        cassi = journals.CassiAbbreviation()
+        error = exceptions.CassiTermsError("Could not accept CASSI terms.")
+        with mock.patch.object(cassi, 'search', side_effect=error) as search:
+            for i in range(2):
+                with self.assertRaises(exceptions.CassiTermsError):
+                    cassi['Journal of Small Papers']
+        self.assertEqual(search.call_count, 2)
+    
+    def test_ltwa_saved(self):
+        ltwa = journals.LTWAAbbreviation()
+        with mock.patch.object(ltwa, 'abbreviate', return_value='J. Small Pap.') as abbreviate:
+            self.assertEqual(ltwa['journal of small papers'], 'J. Small Pap.')
+            journals.memory_cache.clear()
+            self.assertEqual(ltwa['journal of small papers'], 'J. Small Pap.')
+        abbreviate.assert_called_once()
+    
+    def test_cli(self):
+        journals.abbreviation_store.put('cassi', 'Chemistry of Materials', 'Chem. Mater.')
+        journals.abbreviation_store.put_negative('cassi', 'Journal of Small Papers', 'Not found')
+        with mock.patch('sys.stdout', new=io.StringIO()) as stdout:
+            journals.abbreviate_journals_cli(['--cache-stats', '--show-cache'])
+        self.assertIn('cassi: 1 found, 1 missing, 0 expired', stdout.getvalue())
+        self.assertIn('chemistry of materials\tChem. Mater.', stdout.getvalue())
+        with mock.patch('sys.stdout', new=io.StringIO()) as stdout:
+            journals.abbreviate_journals_cli(['--prune-cache', 'missing'])
+        self.assertEqual(len(journals.abbreviation_store.entries()), 1)
+
+
 class LTWATests(TestCase):
 
     def test_ltwa_list(self):
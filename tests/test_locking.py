@@ -0,0 +1,69 @@
+# This file is part of Franklin.
+# 
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import TestCase, mock
+import os
+import tempfile
+
+from franklin import locking, exceptions
+
+
+class FileLockTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, '.refs.bib.lock')
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_exclusive(self):
+        with locking.FileLock(self.path):
+            with self.assertRaises(exceptions.FileLockError):
+                with locking.FileLock(self.path, timeout=0.1):
+                    pass
+        # Now it's been released
+        with locking.FileLock(self.path, timeout=0.1):
+            pass
+    
+    def test_lock_file_fallback(self):
+        with mock.patch('franklin.locking.fcntl', None), \
+             mock.patch('franklin.locking.msvcrt', None):
+            with locking.FileLock(self.path):
+                self.assertTrue(os.path.exists(self.path))
+                with self.assertRaises(exceptions.FileLockError):
+                    with locking.FileLock(self.path, timeout=0.1):
+                        pass
+            self.assertFalse(os.path.exists(self.path))
+            # Lock files left by crashed processes are eventually ignored
+            open(self.path, mode='w').close()
+            os.utime(self.path, (0, 0))
+            with locking.FileLock(self.path, timeout=1, stale_timeout=60):
+                pass
+    
+    def test_rename_no_clobber(self):
+        src = os.path.join(self.tmpdir.name, 'src.pdf')
+        dst = os.path.join(self.tmpdir.name, 'dst.pdf')
+        for path in [src, dst]:
+            with open(path, mode='w') as fp:
+                fp.write(path)
+        with self.assertRaises(FileExistsError):
+            locking.rename_no_clobber(src, dst)
+        with open(dst) as fp:
+            self.assertEqual(fp.read(), dst)
+        os.remove(dst)
+        locking.rename_no_clobber(src, dst)
+        self.assertFalse(os.path.exists(src))
+        with open(dst) as fp:
+            self.assertEqual(fp.read(), src)
@@ -0,0 +1,232 @@
+# This file is part of Franklin.
+#
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import TestCase, mock
+import io
+import os
+import time
+import json
+import random
+import tempfile
+
+import pandas as pd
+
+from franklin import ltwa, journals, cache, exceptions
+from franklin.config import franklin_config as config
+
+
+ltwa_text = ("WORD\tABBREVIATIONS\tLANGUAGE CODES\n"
+             "journal\tj.\tfre, eng\n"
+             "paper-\tpap.\teng\n"
+             "small\tn.a.\teng\n"
+             "chuck-\tc.-\t\n")
+
+
+def fake_response(text=ltwa_text, status_code=200, headers={}):
+    response = mock.MagicMock()
+    response.text = text
+    response.status_code = status_code
+    response.headers = headers
+    return response
+
+
+class LTWASnapshotTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmpdir.name, 'LTWA.txt')
+        with open(self.source, mode='w', encoding='utf-16') as fp:
+            fp.write(ltwa_text)
+        self.path = os.path.join(self.tmpdir.name, 'ltwa.json')
+        self.old_config = dict(config['ltwa'])
+        config['ltwa']['snapshot'] = self.path
+        config['ltwa']['offline'] = 'no'
+        ltwa.clear()
+
+    def tearDown(self):
+        config['ltwa'].update(self.old_config)
+        ltwa.clear()
+        self.tmpdir.cleanup()
+
+    def test_parse_ltwa(self):
+        table = ltwa.parse_ltwa(ltwa_text)
+        self.assertEqual(table['WORD'], ['journal', 'paper-', 'small', 'chuck-'])
+        self.assertEqual(table['ABBREVIATIONS'], ['j.', 'pap.', 'n.a.', 'c.-'])
+        self.assertEqual(table['LANGUAGE CODES'], ['fre, eng', 'eng', 'eng', None])
+
+    def test_build_from_file(self):
+        self.assertTrue(ltwa.update_ltwa(source=self.source))
+        snapshot = ltwa.load_snapshot()
+        self.assertEqual(snapshot['format'], ltwa.snapshot_format)
+        self.assertEqual(snapshot['source'], self.source)
+        # The DataFrame matches the one parsed from the original text
+        with mock.patch('franklin.sessions.get', side_effect=AssertionError("Used network")):
+            df = ltwa.ltwa_dataframe()
+        expected = pd.read_csv(io.StringIO(ltwa_text), delimiter='\t')
+        self.assertEqual(list(df.columns), ['WORD', 'ABBREVIATIONS', 'LANGUAGE CODES'])
+        pd.testing.assert_frame_equal(df, expected)
+
+    def test_download_saves_snapshot(self):
+        response = fake_response(headers={'ETag': '"abc"'})
+        with mock.patch('franklin.sessions.get', return_value=response) as get:
+            table = ltwa.ltwa_table()
+            # Only downloaded once
+            ltwa.clear()
+            self.assertEqual(ltwa.ltwa_table(), table)
+        get.assert_called_once()
+        self.assertEqual(ltwa.load_snapshot()['etag'], '"abc"')
+
+    def test_offline(self):
+        with mock.patch('franklin.sessions.get') as get:
+            with self.assertRaises(exceptions.LTWANotAvailable):
+                ltwa.ltwa_table(offline=True)
+            config['ltwa']['offline'] = 'yes'
+            with self.assertRaises(exceptions.LTWANotAvailable):
+                ltwa.ltwa_table()
+        get.assert_not_called()
+
+    def test_refresh_unchanged(self):
+        with mock.patch('franklin.sessions.get',
+                        return_value=fake_response(headers={'ETag': '"abc"'})):
+            self.assertTrue(ltwa.update_ltwa())
+        with mock.patch('franklin.sessions.get',
+                        return_value=fake_response(status_code=304)) as get:
+            self.assertFalse(ltwa.update_ltwa())
+        self.assertEqual(get.call_args[1]['headers'], {'If-None-Match': '"abc"'})
+        # Force a new download
+        with mock.patch('franklin.sessions.get', return_value=fake_response()) as get:
+            self.assertTrue(ltwa.update_ltwa(force=True))
+        self.assertEqual(get.call_args[1]['headers'], {})
+
+    def test_other_format_ignored(self):
+        with open(self.path, mode='w') as fp:
+            json.dump({'format': ltwa.snapshot_format + 1}, fp)
+        self.assertIsNone(ltwa.load_snapshot())
+
+    def test_corrupt_snapshot_ignored(self):
+        for contents in [b'{"format": ', b'\x80\x04\x95 not json', b'[]']:
+            with open(self.path, mode='wb') as fp:
+                fp.write(contents)
+            self.assertIsNone(ltwa.load_snapshot())
+
+    def test_offline_abbreviation(self):
+        ltwa.update_ltwa(source=self.source)
+        store = cache.AbbreviationStore(enabled=False)
+        with mock.patch('franklin.journals.abbreviation_store', new=store), \
+             mock.patch('franklin.journals.memory_cache', new=cache.MemoryCache()), \
+             mock.patch('franklin.sessions.get', side_effect=AssertionError("Used network")):
+            abbr = journals.LTWAAbbreviation(offline=True)['journal of small papers']
+        self.assertEqual(abbr, 'J. Small Pap.')
+
+    def test_update_forgets_abbreviations(self):
+        store = cache.abbreviation_store
+        store.put('ltwa', 'journal of small papers', 'J. Small Pap.')
+        store.put('cassi', 'journal of small papers', 'J. Sm. Pap.')
+        cache.memory_cache.put(('ltwa', 'journal of small papers'), 'J. Small Pap.')
+        ltwa.update_ltwa(source=self.source)
+        self.assertIsNone(store.get('ltwa', 'journal of small papers'))
+        self.assertEqual(store.get('cassi', 'journal of small papers'), 'J. Sm. Pap.')
+        self.assertNotIn(('ltwa', 'journal of small papers'), cache.memory_cache)
+    
+    def test_cli(self):
+        with mock.patch('sys.stdout', new=io.StringIO()) as stdout:
+            self.assertEqual(ltwa.update_ltwa_cli(['--info']), 1)
+            ltwa.update_ltwa_cli(['--from-file', self.source])
+            self.assertEqual(ltwa.update_ltwa_cli(['--info']), 0)
+        self.assertIn('4 words from {}'.format(self.source), stdout.getvalue())
+
+
+def random_table(size, seed=0):
+    """A made-up LTWA with plenty of overlapping patterns."""
+    rng = random.Random(seed)
+    words, abbreviations = [], []
+    for i in range(size):
+        stem = ''.join(rng.choice('abcdeos') for i in range(rng.randint(1, 7)))
+        word = rng.choice(['{}', '{}-', '-{}', '-{}-', '{}-{}']).format(stem, stem[::-1])
+        words.append(word)
+        # Wildcards in the abbreviation are filled from those in the word
+        choices = [stem[:3] + '.', 'n.a.', stem + '.s']
+        if '-' in word:
+            choices += ['-' + stem[:2] + '.', stem[:2] + '.-']
+        if word.count('-') == 2:
+            choices.append('-.' + stem[:1] + '-')
+        abbreviations.append(rng.choice(choices))
+    # Patterns with regular expression characters and missing values
+    words += ['s.c.-', 'ab?c', '-c\\.s', '-ol.gy', '(bi)o-', 'e[a-c]-', None, 'doe', 'cod-', 'aoe|eoa']
+    abbreviations += ['s.c.', 'ab.', 'cs.', 'ol.', 'bio.', 'e.', 'nan.', None, None, 'ao.']
+    languages = ['eng'] * len(words)
+    return {'WORD': words, 'ABBREVIATIONS': abbreviations, 'LANGUAGE CODES': languages}
+
+
+def random_words(table, count, seed=1):
+    rng = random.Random(seed)
+    words = ['journal', 'Journals', 'SAXS', 'nan', 'nans', 'abc', 'abbc', 'sxc', 'bio',
+             'biobio', 'eb', 'abc.s', 'biology', 'ologys', 'cod', 'doe', 'codx', 'aoe', 'xeoa', 'a', '']
+    patterns = [word for word in table['WORD'] if word is not None]
+    for i in range(count):
+        word = rng.choice(patterns)
+        while '-' in word:
+            filler = ''.join(rng.choice('abcdeos') for i in range(rng.randint(0, 3)))
+            word = word.replace('-', filler, 1)
+        word += rng.choice(['', '', 's', 'x'])
+        words.append(word.upper() if rng.random() < 0.1 else word)
+    return words
+
+
+def outcome(abbreviate, word):
+    try:
+        return abbreviate(word)
+    except Exception as e:
+        return type(e)
+
+
+class LTWAMatcherTests(TestCase):
+    def test_abbreviate(self):
+        matcher = ltwa.LTWAMatcher(ltwa.parse_ltwa(ltwa_text))
+        self.assertEqual(matcher.abbreviate('Journal'), 'j.')
+        self.assertEqual(matcher.abbreviate('papers'), 'pap.')
+        self.assertEqual(matcher.abbreviate('small'), 'small')
+        self.assertEqual(matcher.abbreviate('chuckles'), 'c.les')
+        self.assertEqual(matcher.abbreviate('Science'), 'Science')
+
+    def test_same_as_dataframe(self):
+        """Check the index gives the same answers as searching the DataFrame."""
+        abbreviator = journals.LTWAAbbreviation()
+        for seed in range(3):
+            table = random_table(400, seed=seed)
+            matcher = ltwa.LTWAMatcher(table)
+            df = ltwa.make_dataframe(table)
+            for word in random_words(table, 200, seed=seed):
+                expected = outcome(lambda w: abbreviator.find_abbrev_in_df(w, df), word)
+                self.assertEqual(outcome(matcher.abbreviate, word), expected, word)
+
+    def test_benchmark(self):
+        table = random_table(1000)
+        words = random_words(table, 20)
+        df = ltwa.make_dataframe(table)
+        abbreviator = journals.LTWAAbbreviation()
+        start = time.perf_counter()
+        for word in words:
+            outcome(lambda w: abbreviator.find_abbrev_in_df(w, df), word)
+        df_time = time.perf_counter() - start
+        start = time.perf_counter()
+        matcher = ltwa.LTWAMatcher(table)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for word in words:
+            outcome(matcher.abbreviate, word)
+        matcher_time = time.perf_counter() - start
+        print("{} words: DataFrame {:.1f} ms, index {:.1f} ms (+{:.1f} ms to build)".format(
+            len(words), df_time * 1000, matcher_time * 1000, build_time * 1000))
+        self.assertLess(matcher_time * 10, df_time)
@@ -0,0 +1,168 @@
+# This file is part of Franklin.
+# 
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import json
+
+import bibtexparser
+
+from franklin.metadata import ArticleMetadata
+from franklin.exceptions import DOIError, MetadataParseError
+
+
+class ArticleMetadataTests(TestCase):
+    bibtex = (
+        '@article{Wolfman_2017,\n'
+        '  doi = {10.1021/acs.chemmater.6b05114},\n'
+        '  url = {https://doi.org/10.1021/acs.chemmater.6b05114},\n'
+        '  year = 2017,\n'
+        '  month = {jan},\n'
+        '  publisher = {American Chemical Society ({ACS})},\n'
+        '  volume = {29},\n'
+        '  number = {8},\n'
+        '  pages = {3347--3362},\n'
+        '  author = {Mark Wolfman and Brian M. May and Jordi Cabana},\n'
+        '  title = {Visualization of Electrochemical Reactions in Battery Materials with X-ray Microscopy and Mapping},\n'
+        '  journal = {Chemistry of Materials}\n'
+        '}'
+    )
+    
+    def test_from_bibtex(self):
+        record = ArticleMetadata.from_bibtex(self.bibtex)
+        self.assertEqual(record.doi, '10.1021/acs.chemmater.6b05114')
+        self.assertEqual(record.authors, ['Mark Wolfman', 'Brian M. May', 'Jordi Cabana'])
+        self.assertEqual(record.year, '2017')
+        self.assertEqual(record.journal, 'Chemistry of Materials')
+        self.assertEqual(record.publisher, 'American Chemical Society ({ACS})')
+        self.assertEqual(record.entry_type, 'article')
+        self.assertEqual(record.fields['pages'], '3347--3362')
+        # Records are slotted, so arbitrary attributes are not allowed
+        with self.assertRaises(AttributeError):
+            record.volume = '29'
+    
+    def test_as_dict(self):
+        # Should match what bibtexparser gives, minus the ID
+        entry = bibtexparser.loads(self.bibtex).entries[0]
+        del entry['ID']
+        record = ArticleMetadata.from_bibtex(self.bibtex)
+        self.assertEqual(record.as_dict(), entry)
+    
+    def test_to_bibtex(self):
+        record = ArticleMetadata.from_bibtex(self.bibtex)
+        bibtex = record.to_bibtex('wolfman2017')
+        entry = bibtexparser.loads(self.bibtex).entries[0]
+        entry['ID'] = 'wolfman2017'
+        db = bibtexparser.bibdatabase.BibDatabase()
+        db.entries = [entry]
+        self.assertEqual(bibtex, bibtexparser.dumps(db))
+        # Round-trip back to the same record
+        self.assertEqual(ArticleMetadata.from_bibtex(bibtex), record)
+    
+    def test_default_id(self):
+        record = ArticleMetadata(authors=['Wolfman, Mark', 'Cabana, Jordi'], year='2017')
+        self.assertEqual(record.default_id(), 'cabana2017')
+    
+    def test_bad_bibtex(self):
+        with self.assertRaises(DOIError):
+            ArticleMetadata.from_bibtex('', doi='10.1021/acs.chemmater.6b05114')
+        with self.assertRaises(DOIError):
+            ArticleMetadata.from_bibtex(self.bibtex + '\n' + self.bibtex.replace('Wolfman_2017', 'other'))
+
+
+class CSLEquivalenceTests(TestCase):
+    """Check that CSL-JSON gives the same record as bibtex from the DOI server."""
+    examples = [
+        # (bibtex, CSL-JSON) as provided by the DOI server for the same DOI
+        (
+            '@article{Wolfman_2017, title={Visualization of Electrochemical Reactions in Battery Materials with X-ray Microscopy and Mapping}, volume={29}, ISSN={1520-5002}, url={http://dx.doi.org/10.1021/acs.chemmater.6b05114}, DOI={10.1021/acs.chemmater.6b05114}, number={8}, journal={Chemistry of Materials}, publisher={American Chemical Society (ACS)}, author={Wolfman, Mark and May, Brian M. and Cabana, Jordi}, year={2017}, month=mar, pages={3347–3362} }',
+            {
+                "type": "article-journal",
+                "title": "Visualization of Electrochemical Reactions in Battery Materials with X-ray Microscopy and Mapping",
+                "volume": "29",
+                "issue": "8",
+                "page": "3347-3362",
+                "ISSN": ["1520-5002"],
+                "URL": "http://dx.doi.org/10.1021/acs.chemmater.6b05114",
+                "DOI": "10.1021/acs.chemmater.6b05114",
+                "container-title": "Chemistry of Materials",
+                "publisher": "American Chemical Society (ACS)",
+                "author": [
+                    {"given": "Mark", "family": "Wolfman", "sequence": "first"},
+                    {"given": "Brian M.", "family": "May", "sequence": "additional"},
+                    {"given": "Jordi", "family": "Cabana", "sequence": "additional"},
+                ],
+                "issued": {"date-parts": [[2017, 3, 29]]},
+            },
+        ),
+        (
+            '@inproceedings{Smith_2019, title={Sparse Reconstruction of Spectral Images}, url={http://dx.doi.org/10.1109/icip.2019.8803000}, DOI={10.1109/icip.2019.8803000}, booktitle={2019 IEEE International Conference on Image Processing (ICIP)}, publisher={IEEE}, author={Smith, Jane and Berg, Piet and Lee, Jr., Sam}, year={2019}, month=sep, pages={1–5} }',
+            {
+                "type": "paper-conference",
+                "title": "Sparse Reconstruction of Spectral Images",
+                "page": "1-5",
+                "URL": "http://dx.doi.org/10.1109/icip.2019.8803000",
+                "DOI": "10.1109/icip.2019.8803000",
+                "container-title": "2019 IEEE International Conference on Image Processing (ICIP)",
+                "publisher": "IEEE",
+                "author": [
+                    {"given": "Jane", "family": "Smith"},
+                    {"given": "Piet", "family": "Berg"},
+                    {"given": "Sam", "family": "Lee", "suffix": "Jr."},
+                ],
+                "issued": {"date-parts": [[2019, 9]]},
+            },
+        ),
+        (
+            '@article{Cabana_2010, title={Beyond Intercalation-Based Li-Ion Batteries}, volume={22}, ISSN={0935-9648, 1521-4095}, url={http://dx.doi.org/10.1002/adma.201000717}, DOI={10.1002/adma.201000717}, journal={Advanced Materials}, publisher={Wiley}, author={Cabana, Jordi}, year={2010}, pages={E170–E192} }',
+            {
+                "type": "article-journal",
+                "title": ["Beyond Intercalation-Based Li-Ion Batteries"],
+                "volume": "22",
+                "page": "E170-E192",
+                "ISSN": ["0935-9648", "1521-4095"],
+                "URL": "http://dx.doi.org/10.1002/adma.201000717",
+                "DOI": "10.1002/adma.201000717",
+                "container-title": ["Advanced Materials"],
+                "publisher": "Wiley",
+                "author": [{"given": "Jordi", "family": "Cabana"}],
+                "issued": {"date-parts": [[2010]]},
+            },
+        ),
+    ]
+    
+    def test_records_match(self):
+        for bibtex, csl in self.examples:
+            with self.subTest(doi=csl['DOI']):
+                from_bibtex = ArticleMetadata.from_bibtex(bibtex)
+                from_csl = ArticleMetadata.from_csl(csl)
+                self.assertEqual(from_csl.as_dict(), from_bibtex.as_dict())
+                self.assertEqual(from_csl, from_bibtex)
+    
+    def test_bibtex_output_matches(self):
+        for bibtex, csl in self.examples:
+            with self.subTest(doi=csl['DOI']):
+                from_bibtex = ArticleMetadata.from_bibtex(bibtex)
+                from_csl = ArticleMetadata.from_csl_json(json.dumps(csl))
+                self.assertEqual(from_csl.default_id(), from_bibtex.default_id())
+                self.assertEqual(from_csl.to_bibtex('someid'), from_bibtex.to_bibtex('someid'))
+    
+    def test_bad_csl_json(self):
+        with self.assertRaises(MetadataParseError):
+            ArticleMetadata.from_csl_json('<html>Not found</html>')
+        with self.assertRaises(DOIError):
+            ArticleMetadata.from_csl_json('[]')
+        # A list with a single item is okay
+        record = ArticleMetadata.from_csl_json(json.dumps([self.examples[0][1]]))
+        self.assertEqual(record.doi, '10.1021/acs.chemmater.6b05114')
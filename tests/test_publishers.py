@@ -15,6 +15,7 @@
 
 
 import unittest
+from unittest import mock
 import io
 
 import PyPDF2
@@ -99,3 +100,153 @@ class PublisherTests(unittest.TestCase):
         pdf = publishers.iop(doi=doi)
         pdf_header = pdf[:8]
         self.assertEqual(pdf_header, b'%PDF-1.7')
+
+
+class GetPublisherTests(unittest.TestCase):
+    def test_get_publisher(self):
+        pub_func = publishers.get_publisher('American Chemical Society ({ACS})')
+        self.assertIs(pub_func, publishers.american_chemical_society)
+        with self.assertRaises(exceptions.UnknownPublisherError):
+            publishers.get_publisher('Vanity Press')
+    
+    def test_get_publisher_by_doi(self):
+        pub_func = publishers.get_publisher_by_doi('10.1021/acs.chemmater.6b05114')
+        self.assertIs(pub_func, publishers.american_chemical_society)
+        pub_func = publishers.get_publisher_by_doi('10.1039/C9SC03417J')
+        self.assertIs(pub_func, publishers.royal_society_of_chemistry)
+        with self.assertRaises(exceptions.UnknownPublisherError):
+            publishers.get_publisher_by_doi('10.9999/unknown')
+
+
+def fake_pdf_response(chunks, headers={}, status_code=200):
+    response = mock.MagicMock(headers=headers, status_code=status_code)
+    response.iter_content.return_value = iter(chunks)
+    return response
+
+
+class SavePDFTests(unittest.TestCase):
+    doi = '10.1021/acs.chemmater.6b05114'
+    
+    def test_stream_to_file(self):
+        response = fake_pdf_response([b'%PDF-1.6\n', b'more stuff', b'%%EOF'])
+        fp = io.BytesIO()
+        size = publishers.save_pdf(response, doi=self.doi, fp=fp)
+        self.assertEqual(fp.getvalue(), b'%PDF-1.6\nmore stuff%%EOF')
+        self.assertEqual(size, 24)
+        response.close.assert_called_once_with()
+    
+    def test_return_bytes(self):
+        response = fake_pdf_response([b'%PDF-1.6\n', b'%%EOF'])
+        pdf = publishers.save_pdf(response, doi=self.doi)
+        self.assertEqual(pdf, b'%PDF-1.6\n%%EOF')
+    
+    def test_short_first_chunk(self):
+        response = fake_pdf_response([b'%PD', b'F-1.6\nbody ', b'more\n%%EOF'])
+        pdf = publishers.save_pdf(response, doi=self.doi, check_trailer=False)
+        self.assertEqual(pdf, b'%PDF-1.6\nbody more\n%%EOF')
+        # Too short to be a PDF at all
+        response = fake_pdf_response([b'%P', b'D'])
+        with self.assertRaises(exceptions.InvalidPDFError):
+            publishers.save_pdf(response, doi=self.doi)
+    
+    def test_not_a_pdf(self):
+        response = fake_pdf_response([b'<html>Missing resource</html>'])
+        fp = io.BytesIO()
+        with self.assertRaises(exceptions.PDFNotFoundError):
+            publishers.save_pdf(response, doi=self.doi, fp=fp)
+        # Nothing should have been written
+        self.assertEqual(fp.getvalue(), b'')
+    
+    def test_max_size(self):
+        # Too big according to the headers
+        response = fake_pdf_response([b'%PDF-1.6\n'], headers={'Content-Length': '2048'})
+        with self.assertRaises(exceptions.PDFTooLargeError):
+            publishers.save_pdf(response, doi=self.doi, fp=io.BytesIO(), max_size=1024)
+        response.iter_content.assert_not_called()
+        # Too big once downloaded
+        response = fake_pdf_response([b'%PDF-1.6\n', b'x' * 1024])
+        with self.assertRaises(exceptions.PDFTooLargeError):
+            publishers.save_pdf(response, doi=self.doi, fp=io.BytesIO(), max_size=1024)
+    
+    def test_truncated(self):
+        response = fake_pdf_response([b'%PDF-1.6\n', b'more stuff'])
+        with self.assertRaises(exceptions.TruncatedPDFError):
+            publishers.save_pdf(response, doi=self.doi, fp=io.BytesIO(), check_trailer=True)
+        # Check that it can be turned off
+        response = fake_pdf_response([b'%PDF-1.6\n', b'more stuff'])
+        publishers.save_pdf(response, doi=self.doi, fp=io.BytesIO(), check_trailer=False)
+    
+    def test_iop_captcha(self):
+        response = fake_pdf_response([b'<html>We think you are a bot</html>'])
+        with mock.patch('franklin.sessions.get', return_value=response):
+            with self.assertRaisesRegex(exceptions.PDFNotFoundError, 'Captcha'):
+                publishers.iop(doi='10.1149/1945-7111/ab6298', fp=io.BytesIO())
+
+
+class FetchPDFTests(unittest.TestCase):
+    doi = '10.1021/acs.chemmater.6b05114'
+    url = 'https://pubs.acs.org/doi/pdf/10.1021/acs.chemmater.6b05114'
+    
+    def test_resume(self):
+        fp = io.BytesIO(b'%PDF-1.6\nfirst half ')
+        response = fake_pdf_response([b'second half\n%%EOF'], status_code=206,
+                                     headers={'Content-Range': 'bytes 20-36/37'})
+        with mock.patch('franklin.sessions.get', return_value=response) as get:
+            size = publishers.fetch_pdf(self.url, doi=self.doi, fp=fp)
+        self.assertEqual(get.call_args[1]['headers']['Range'], 'bytes=20-')
+        self.assertEqual(fp.getvalue(), b'%PDF-1.6\nfirst half second half\n%%EOF')
+        self.assertEqual(size, 37)
+    
+    def test_resume_not_supported(self):
+        fp = io.BytesIO(b'%PDF-1.6\nfirst half ')
+        response = fake_pdf_response([b'%PDF-1.6\nthe whole thing\n%%EOF'], status_code=200)
+        with mock.patch('franklin.sessions.get', return_value=response):
+            publishers.fetch_pdf(self.url, doi=self.doi, fp=fp)
+        self.assertEqual(fp.getvalue(), b'%PDF-1.6\nthe whole thing\n%%EOF')
+    
+    def test_resume_rejected(self):
+        # A temporary error or captcha doesn't lose the partial download
+        for response in [fake_pdf_response([b'Service unavailable'], status_code=503),
+                         fake_pdf_response([b'<html>Please complete the CAPTCHA</html>'], status_code=403),
+                         fake_pdf_response([b'<html>Please complete the CAPTCHA</html>'], status_code=200)]:
+            fp = io.BytesIO(b'%PDF-1.6\nfirst half ')
+            with mock.patch('franklin.sessions.get', return_value=response):
+                with self.assertRaises(exceptions.PDFNotFoundError):
+                    publishers.fetch_pdf(self.url, doi=self.doi, fp=fp)
+            self.assertEqual(fp.getvalue(), b'%PDF-1.6\nfirst half ')
+    
+    def test_range_not_satisfiable(self):
+        fp = io.BytesIO(b'%PDF-1.6\nsomething else entirely')
+        responses = [fake_pdf_response([b''], status_code=416),
+                     fake_pdf_response([b'%PDF-1.6\nthe whole thing\n%%EOF'], status_code=200)]
+        with mock.patch('franklin.sessions.get', side_effect=responses) as get:
+            publishers.fetch_pdf(self.url, doi=self.doi, fp=fp)
+        self.assertNotIn('Range', get.call_args[1]['headers'])
+        self.assertEqual(fp.getvalue(), b'%PDF-1.6\nthe whole thing\n%%EOF')
+    
+    def test_validate_pdf_file(self):
+        publishers.validate_pdf_file(io.BytesIO(b'%PDF-1.6\n...\n%%EOF'), check_trailer=True)
+        with self.assertRaises(exceptions.TruncatedPDFError):
+            publishers.validate_pdf_file(io.BytesIO(b'%PDF-1.6\n...'), check_trailer=True)
+
+
+class ValidatePDFTests(unittest.TestCase):
+    def test_valid_pdf(self):
+        publishers.validate_pdf(b'%PDF-1.6\n...\n%%EOF\n', check_trailer=True)
+    
+    def test_not_a_pdf(self):
+        with self.assertRaisesRegex(exceptions.InvalidPDFError, 'Publisher has no PDF'):
+            publishers.validate_pdf(b'<html>Missing resource</html>', doi='10.1021/xyz')
+        with self.assertRaisesRegex(exceptions.InvalidPDFError, 'Captcha'):
+            publishers.validate_pdf(b'<html>Please complete the CAPTCHA</html>')
+    
+    def test_truncated_pdf(self):
+        publishers.validate_pdf(b'%PDF-1.6\n...')
+        with self.assertRaises(exceptions.TruncatedPDFError):
+            publishers.validate_pdf(b'%PDF-1.6\n...', check_trailer=True)
+    
+    def test_bounded_diagnosis(self):
+        # Clues far into the response shouldn't be decoded
+        head = b'<html>' + b' ' * publishers.diagnosis_size + b'Missing resource'
+        msg = publishers.diagnose_response(head, doi='10.1021/xyz')
+        self.assertTrue(msg.startswith('No PDF for 10.1021/xyz'))
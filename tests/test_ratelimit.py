@@ -0,0 +1,81 @@
+# This file is part of Franklin.
+# 
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import threading
+import time
+
+from franklin import ratelimit
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.
+    
+    def __call__(self):
+        return self.now
+    
+    def sleep(self, delay):
+        self.now += delay
+
+
+class TokenBucketTests(TestCase):
+    def test_rate(self):
+        clock = FakeClock()
+        bucket = ratelimit.TokenBucket(rate=2, capacity=3, clock=clock, sleep=clock.sleep)
+        # The first few should happen right away
+        for i in range(3):
+            bucket.acquire()
+        self.assertEqual(clock.now, 0)
+        # Then limited to the rate
+        for i in range(4):
+            bucket.acquire()
+        self.assertAlmostEqual(clock.now, 2)
+
+
+class PublisherLimiterTests(TestCase):
+    def test_max_concurrency(self):
+        limiter = ratelimit.PublisherLimiter('iop', rate=1000, burst=1000, max_concurrency=2)
+        running = []
+        max_running = []
+        lock = threading.Lock()
+        def job():
+            with limiter:
+                with lock:
+                    running.append(1)
+                    max_running.append(len(running))
+                time.sleep(0.01)
+                with lock:
+                    running.pop()
+        threads = [threading.Thread(target=job) for i in range(6)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(max(max_running), 2)
+    
+    def test_config(self):
+        ratelimit.config['rate_limit:iop'] = {'max_concurrency': '1'}
+        try:
+            limiter = ratelimit.PublisherLimiter.from_config('iop')
+        finally:
+            ratelimit.config.remove_section('rate_limit:iop')
+        self.assertEqual(limiter.max_concurrency, 1)
+        self.assertEqual(limiter.bucket.rate, 1)
+
+
+class InterleaveTests(TestCase):
+    def test_interleave(self):
+        jobs = ['acs1', 'acs2', 'acs3', 'wiley1', 'iop1', 'wiley2']
+        result = ratelimit.interleave(jobs, key=lambda job: job[:-1])
+        self.assertEqual(result, ['acs1', 'wiley1', 'iop1', 'acs2', 'wiley2', 'acs3'])
@@ -0,0 +1,120 @@
+# This file is part of Franklin.
+# 
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import TestCase, mock
+
+import requests
+
+from franklin import retry, exceptions
+
+
+class FakeClock():
+    """A clock that only moves forward when something sleeps."""
+    def __init__(self):
+        self.now = 0.
+    
+    def __call__(self):
+        return self.now
+    
+    def sleep(self, delay):
+        self.now += delay
+
+
+def fake_response(status_code, headers={}):
+    return mock.MagicMock(status_code=status_code, headers=headers)
+
+
+class RetryPolicyTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        breaker = retry.CircuitBreaker(threshold=3, reset_timeout=100, clock=self.clock)
+        self.policy = retry.RetryPolicy(host='doi.org', max_attempts=4, backoff=1,
+                                        max_backoff=8, deadline=60, breaker=breaker,
+                                        clock=self.clock, sleep=self.clock.sleep)
+    
+    def test_success(self):
+        send = mock.MagicMock(return_value=fake_response(200))
+        response = self.policy.send(send)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(send.call_count, 1)
+    
+    def test_retry_status(self):
+        send = mock.MagicMock(side_effect=[fake_response(503), fake_response(200)])
+        response = self.policy.send(send)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(send.call_count, 2)
+    
+    def test_not_found_is_not_retried(self):
+        send = mock.MagicMock(return_value=fake_response(404))
+        response = self.policy.send(send)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(send.call_count, 1)
+    
+    def test_post_is_not_retried(self):
+        send = mock.MagicMock(return_value=fake_response(503))
+        response = self.policy.send(send, method='POST')
+        self.assertEqual(send.call_count, 1)
+    
+    def test_connection_error(self):
+        send = mock.MagicMock(side_effect=requests.exceptions.ConnectionError())
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.policy.send(send)
+        self.assertEqual(send.call_count, 3)
+    
+    def test_retry_after(self):
+        send = mock.MagicMock(side_effect=[fake_response(429, {'Retry-After': '7'}),
+                                           fake_response(200)])
+        self.policy.send(send)
+        self.assertEqual(self.clock.now, 7)
+    
+    def test_backoff(self):
+        with mock.patch('random.uniform', side_effect=lambda a, b: b):
+            delays = [self.policy.delay(attempt) for attempt in range(5)]
+        self.assertEqual(delays, [1, 2, 4, 8, 8])
+    
+    def test_deadline(self):
+        send = mock.MagicMock(return_value=fake_response(429, {'Retry-After': '45'}))
+        response = self.policy.send(send)
+        # Only room for one retry before the deadline
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(response.status_code, 429)
+    
+    def test_circuit_breaker(self):
+        send = mock.MagicMock(return_value=fake_response(500))
+        self.policy.send(send)
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(self.policy.breaker.state, retry.CircuitBreaker.OPEN)
+        # The host should now be avoided
+        with self.assertRaises(exceptions.HostUnavailableError):
+            self.policy.send(send)
+        self.assertEqual(send.call_count, 3)
+        # Eventually a trial request is allowed through
+        self.clock.now += 100
+        send.return_value = fake_response(200)
+        self.policy.send(send)
+        self.assertEqual(self.policy.breaker.state, retry.CircuitBreaker.CLOSED)
+
+
+class RetryConfigTests(TestCase):
+    def test_host_config(self):
+        retry.config['retry:iopscience.iop.org'] = {'max_attempts': '2'}
+        try:
+            policy = retry.RetryPolicy.from_config('iopscience.iop.org')
+        finally:
+            retry.config.remove_section('retry:iopscience.iop.org')
+        self.assertEqual(policy.max_attempts, 2)
+        self.assertEqual(policy.timeout, 10)
+        policy = retry.RetryPolicy.from_config('doi.org')
+        self.assertEqual(policy.max_attempts, 4)
@@ -0,0 +1,45 @@
+# This file is part of Franklin.
+# 
+# Franklin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Franklin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Franklin.  If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import TestCase, mock
+
+from franklin import sessions
+
+
+class SessionManagerTests(TestCase):
+    def test_shared_session(self):
+        manager = sessions.SessionManager()
+        self.assertIs(manager.session, manager.session)
+        manager.close()
+        self.assertIs(manager._session, None)
+    
+    def test_pool_sizes(self):
+        manager = sessions.SessionManager(pool_sizes={'doi.org': 12}, default_pool_size=3)
+        session = manager.session
+        adapter = session.get_adapter('https://doi.org/api/handles/10.1000/1')
+        self.assertEqual(adapter._pool_maxsize, 12)
+        adapter = session.get_adapter('https://example.com/')
+        self.assertEqual(adapter._pool_maxsize, 3)
+    
+    @mock.patch.dict('franklin.retry._policies', clear=True)
+    def test_set_session(self):
+        fake_session = mock.MagicMock()
+        old_session = sessions.session_manager._session
+        try:
+            sessions.set_session(fake_session)
+            sessions.get('https://doi.org/', timeout=3)
+        finally:
+            sessions.set_session(old_session)
+        fake_session.request.assert_called_once_with('GET', 'https://doi.org/', timeout=3)